@@ -1,10 +1,11 @@
 import os
 import threading
 import time
+from datetime import datetime
 from flask import Flask, jsonify
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room, leave_room, emit
 from config import Config
 from models import db
 from routes.auth import auth_bp
@@ -12,7 +13,28 @@ from routes.buses import buses_bp
 from routes.positions import positions_bp
 from routes.stops import stops_bp
 from routes.occupancy import occupancy_bp
+from routes.lines import lines_bp
 from utils.predictions import PredictionEngine
+from utils.prediction_queue import IncrementalPredictionEngine
+from utils.prediction_workers import PredictionWorkerPool
+from utils.position_buffer import PositionBuffer
+from utils.latest_state import LatestStateStore
+from utils.gps_filter import GpsFilterBank
+from utils.speed_estimator import SpeedEstimator
+from utils.spatial_index import StopSpatialIndex
+from utils.route_geometry import RouteGeometryCache
+from utils.segment_model import SegmentTravelModel
+from utils.stop_events import StopEventDetector
+from utils.trip_history import TripHistoryBuilder
+from utils.retention import RetentionManager
+from utils.position_partitions import PositionPartitionManager
+from utils.sqlite_profile import SqliteProfile
+from utils.replicas import ReplicaRouter
+from utils.occupancy_counters import OccupancyCounters
+from utils.realtime import (
+    RealtimePublisher, StopPredictionNotifier, bus_room, route_room, stop_room,
+    position_payload, prediction_entry
+)
 
 def create_app(config_class=Config):
     """Factory pour créer l'application Flask"""
@@ -21,6 +43,8 @@ def create_app(config_class=Config):
     
     # Initialize extensions
     db.init_app(app)
+    SqliteProfile(app)  # WAL et pool de lecture séparé si SQLITE_PRODUCTION
+    ReplicaRouter(app)  # Lectures sur les réplicas si DATABASE_REPLICA_URLS
     jwt = JWTManager(app)
     CORS(app)
     socketio = SocketIO(app, cors_allowed_origins="*")
@@ -31,6 +55,7 @@ def create_app(config_class=Config):
     app.register_blueprint(positions_bp, url_prefix='/api/positions')
     app.register_blueprint(stops_bp, url_prefix='/api/stops')
     app.register_blueprint(occupancy_bp, url_prefix='/api/occupancy')
+    app.register_blueprint(lines_bp, url_prefix='/api/routes')
     
     # Routes principales
     @app.route('/')
@@ -44,7 +69,8 @@ def create_app(config_class=Config):
                 'buses': '/api/buses',
                 'positions': '/api/positions',
                 'stops': '/api/stops',
-                'occupancy': '/api/occupancy'
+                'occupancy': '/api/occupancy',
+                'routes': '/api/routes'
             }
         })
     
@@ -97,6 +123,23 @@ def create_app(config_class=Config):
                 'activity': {
                     'positions_last_hour': recent_positions
                 },
+                'prediction_queue': app.prediction_queue.get_stats(),
+                'prediction_workers': app.prediction_workers.get_stats(),
+                'position_buffer': app.position_buffer.get_stats(),
+                'latest_state': app.latest_state.get_stats(),
+                'gps_filter': app.gps_filter.get_stats(),
+                'speed_estimator': app.speed_estimator.get_stats(),
+                'realtime': app.realtime.get_stats(),
+                'stop_notifications': app.stop_notifier.get_stats(),
+                'stop_index': app.stop_index.get_stats(),
+                'route_geometry': app.route_geometry.get_stats(),
+                'segment_model': app.segment_model.get_stats(),
+                'stop_events': app.stop_events.get_stats(),
+                'trip_history': app.trip_history.get_stats(),
+                'occupancy_counters': app.occupancy_counters.get_stats(),
+                'retention': app.retention.get_stats(),
+                'position_partitions': app.position_partitions.get_stats(),
+                'database': app.db_reader.get_stats(),
                 'timestamp': datetime.utcnow().isoformat()
             })
         except Exception as e:
@@ -111,13 +154,114 @@ def create_app(config_class=Config):
     def handle_disconnect():
         print('Client déconnecté du WebSocket')
     
+    def id_from(data, key):
+        """Identifiant envoyé par le client (entier, comme les clés des états en mémoire) ou None"""
+        try:
+            value = int((data or {}).get(key))
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+    
+    def bus_id_from(data):
+        return id_from(data, 'bus_id')
+    
+    def route_id_from(data):
+        return id_from(data, 'route_id')
+    
+    def stop_id_from(data):
+        return id_from(data, 'stop_id')
+    
     @socketio.on('subscribe_bus')
     def handle_subscribe_bus(data):
         """S'abonne aux mises à jour d'un bus spécifique"""
-        bus_id = data.get('bus_id')
-        if bus_id:
-            print(f'Abonnement aux mises à jour du bus {bus_id}')
-            # Logique d'abonnement à implémenter
+        bus_id = bus_id_from(data)
+        if bus_id is None:
+            return
+        join_room(bus_room(bus_id))
+        
+        # Envoie tout de suite la dernière position connue
+        from models import Bus
+        with app.app_context():
+            bus = Bus.query.get(bus_id)
+            state = app.latest_state.get_position(bus_id) if bus else None
+            if state:
+                emit('bus_position', position_payload(bus_id, bus.current_route_id, state))
+    
+    @socketio.on('unsubscribe_bus')
+    def handle_unsubscribe_bus(data):
+        """Se désabonne des mises à jour d'un bus"""
+        bus_id = bus_id_from(data)
+        if bus_id is not None:
+            leave_room(bus_room(bus_id))
+    
+    @socketio.on('subscribe_route')
+    def handle_subscribe_route(data):
+        """S'abonne aux positions de tous les bus d'une ligne"""
+        route_id = route_id_from(data)
+        if route_id is None:
+            return
+        join_room(route_room(route_id))
+        
+        # Envoie tout de suite les dernières positions connues de la ligne
+        from models import Bus
+        with app.app_context():
+            payloads = []
+            for bus in Bus.query.filter_by(current_route_id=route_id, is_in_service=True).all():
+                state = app.latest_state.get_position(bus.id)
+                if state:
+                    payloads.append(position_payload(bus.id, route_id, state))
+            emit('route_positions', {'route_id': route_id, 'positions': payloads})
+    
+    @socketio.on('unsubscribe_route')
+    def handle_unsubscribe_route(data):
+        """Se désabonne des positions d'une ligne"""
+        route_id = route_id_from(data)
+        if route_id is not None:
+            leave_room(route_room(route_id))
+    
+    @socketio.on('subscribe_stop')
+    def handle_subscribe_stop(data):
+        """S'abonne aux prédictions d'arrivée d'un arrêt"""
+        stop_id = stop_id_from(data)
+        if stop_id is None:
+            emit('error', {'error': 'stop_id invalide'})
+            return
+        
+        # Envoie l'état complet puis seulement les changements
+        from sqlalchemy.orm import joinedload
+        from models import Prediction, Stop
+        with app.app_context():
+            if not db.session.get(Stop, stop_id):
+                emit('error', {'error': 'Arrêt non trouvé', 'stop_id': stop_id})
+                return
+            join_room(stop_room(stop_id))
+            
+            PredictionEngine.refresh_stop_predictions(stop_id)
+            predictions = Prediction.query.options(joinedload(Prediction.bus))\
+                .filter_by(stop_id=stop_id)\
+                .filter(Prediction.arrival_time >= datetime.utcnow())\
+                .order_by(Prediction.arrival_time.asc()).all()
+            entries = [
+                (p.arrival_time, prediction_entry(
+                    p.bus_id, p.bus.number, p.bus.current_route_id, p.arrival_time, p.confidence
+                ))
+                for p in predictions
+            ]
+            app.stop_notifier.seed(stop_id, entries)
+            emit('stop_predictions', {
+                'stop_id': stop_id,
+                'snapshot': True,
+                'added': [entry for _, entry in entries],
+                'updated': [],
+                'removed': []
+            })
+    
+    @socketio.on('unsubscribe_stop')
+    def handle_unsubscribe_stop(data):
+        """Se désabonne des prédictions d'un arrêt"""
+        stop_id = stop_id_from(data)
+        if stop_id is not None:
+            leave_room(stop_room(stop_id))
     
     # Gestionnaire d'erreur JWT
     @jwt.expired_token_loader
@@ -147,6 +291,52 @@ def create_app(config_class=Config):
     prediction_thread = threading.Thread(target=prediction_updater, daemon=True)
     prediction_thread.start()
     
+    # État courant des bus en mémoire (position, occupation, progression)
+    LatestStateStore(app)
+    
+    # Filtre de Kalman par bus (position, vitesse et cap lissés)
+    GpsFilterBank(app)
+    
+    # Vitesse moyenne de chaque bus (moyenne mobile, sauvegardée en base)
+    SpeedEstimator(app)
+    
+    # Index spatial des arrêts actifs
+    StopSpatialIndex(app)
+    
+    # Tracés des lignes (progression des bus en mètres le long du trajet)
+    RouteGeometryCache(app)
+    
+    # Arrivées et départs des bus aux arrêts (table stop_events)
+    StopEventDetector(app)
+    
+    # Historique des trajets (ouverts / fermés aux terminus)
+    TripHistoryBuilder(app)
+    
+    # Compteurs de passagers en mémoire (montées / descentes écrites par lots)
+    OccupancyCounters(app)
+    
+    # Positions rangées par période (partitions MySQL ou tables SQLite)
+    PositionPartitionManager(app)
+    
+    # Rétention : sous-échantillonnage des positions, agrégats d'occupation par minute
+    RetentionManager(app)
+    
+    # Temps de parcours historiques entre arrêts (scripts/build_segment_model.py)
+    SegmentTravelModel(app)
+    
+    # Calcul du cycle complet réparti par ligne sur un pool de processus
+    PredictionWorkerPool(app)
+    
+    # Recalcul incrémental des prédictions déclenché par l'ingestion GPS
+    IncrementalPredictionEngine(app)
+    
+    # Tampon d'écriture différée des positions (actif si POSITION_WRITE_BEHIND)
+    PositionBuffer(app)
+    
+    # Diffusion des positions et des prédictions aux abonnés WebSocket
+    RealtimePublisher(app, socketio)
+    StopPredictionNotifier(app, socketio)
+    
     # Store socketio instance in app for use in other modules
     app.socketio = socketio
     
@@ -7,15 +7,110 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///bus_tracking.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    
+    # Profil SQLite de production (utils/sqlite_profile.py) : WAL, un seul écrivain, pool de lecture séparé
+    SQLITE_PRODUCTION = os.environ.get('SQLITE_PRODUCTION', 'false').lower() == 'true'
+    SQLITE_BUSY_TIMEOUT_MS = 5000  # attente du verrou d'écriture avant "database is locked"
+    SQLITE_CACHE_SIZE_MB = 64  # cache de pages par connexion
+    SQLITE_MMAP_SIZE_MB = 256  # lecture du fichier par mmap
+    SQLITE_READER_POOL_SIZE = 8  # connexions en lecture seule (autant en débordement)
+    SQLITE_WRITER_POOL_SIZE = 1  # connexions d'écriture
+    
+    # Pool de connexions MySQL (primaire et réplicas)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))  # connexions gardées ouvertes
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))  # connexions supplémentaires en pointe
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))  # attente d'une connexion libre (secondes)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # renouvelées avant le wait_timeout du serveur
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'  # connexion testée avant usage
+    
+    if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        if SQLITE_PRODUCTION and ':memory:' not in SQLALCHEMY_DATABASE_URI:
+            SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': SQLITE_WRITER_POOL_SIZE, 'max_overflow': 0}
+    else:
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING
+        }
+    
+    # Réplicas en lecture (utils/replicas.py) : requêtes GET et calcul des prédictions
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))  # au-delà, lecture sur le primaire
+    REPLICA_LAG_CHECK_SECONDS = 5  # mesure du retard de réplication
+    
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-string'
     JWT_ACCESS_TOKEN_EXPIRES = False  # Tokens ne expirent pas pour la démo
     
     # Configuration WebSocket
     SOCKETIO_CORS_ALLOWED_ORIGINS = "*"
+    SOCKET_PUSH_INTERVAL = 1.0  # secondes entre deux envois groupés aux abonnés
+    PREDICTION_PUSH_MIN_DELTA = 60  # écart d'ETA (secondes) déclenchant un envoi aux abonnés d'un arrêt
+    PREDICTION_WRITE_MIN_DELTA = 15  # écart d'ETA (secondes) en dessous duquel une prédiction n'est pas réécrite
+    PREDICTION_WORKERS = int(os.environ.get('PREDICTION_WORKERS', 0))  # processus de calcul des ETA (0 = dans le serveur)
     
     # Configuration GPS
     GPS_UPDATE_INTERVAL = 30  # secondes
     PREDICTION_ACCURACY_THRESHOLD = 0.85
     
+    # Index spatial des arrêts (/api/stops/nearby)
+    STOP_INDEX_CELL_DEG = 0.01  # taille des cellules de la grille (~1 km)
+    STOP_INDEX_REFRESH_SECONDS = 300  # reconstruction périodique
+    
+    # Tracés des lignes (progression en mètres le long du trajet)
+    ROUTE_GEOMETRY_REFRESH_SECONDS = 300  # rechargement des tracés en cache
+    
+    # Temps de parcours historiques entre arrêts (scripts/build_segment_model.py)
+    SEGMENT_MODEL_MIN_SAMPLES = 5  # observations minimum pour utiliser une médiane
+    SEGMENT_MODEL_REFRESH_SECONDS = 600  # rechargement des médianes en cache
+    
+    # Détection des arrivées / départs aux arrêts (table stop_events)
+    STOP_ARRIVAL_RADIUS_M = 40  # distance à l'arrêt pour une arrivée
+    STOP_DEPARTURE_RADIUS_M = 60  # distance au-delà de laquelle le bus est reparti
+    STOP_EVENT_LOOKAHEAD = 3  # prochains arrêts de la ligne examinés à chaque position
+    STOP_EVENT_FLUSH_SECONDS = 5  # écriture groupée des événements
+    
+    # Historique des trajets (table trip_history, construite à partir des positions)
+    TRIP_HISTORY_FLUSH_SECONDS = 30  # écriture groupée des trajets
+    TRIP_MIN_DISTANCE_KM = 0.5  # trajets plus courts abandonnés
+    TRIP_MAX_GAP_SECONDS = 1800  # trajet fermé sans position pendant 30 minutes
+    
+    # Vitesse moyenne de chaque bus (moyenne mobile exponentielle mise à jour à l'ingestion)
+    SPEED_HALF_LIFE_SECONDS = 120  # poids divisé par deux toutes les 2 minutes de roulage
+    SPEED_SNAPSHOT_SECONDS = 60  # sauvegarde des estimations en base (0 = désactivée)
+    
+    # Écriture différée des positions (write-behind avec group commit)
+    POSITION_WRITE_BEHIND = os.environ.get('POSITION_WRITE_BEHIND', 'false').lower() == 'true'
+    POSITION_FLUSH_INTERVAL_MS = int(os.environ.get('POSITION_FLUSH_INTERVAL_MS', 200))
+    POSITION_FLUSH_MAX_ROWS = 500  # lignes par commit
+    POSITION_BUFFER_MAX_ROWS = 10000  # taille max du tampon en mémoire
+    POSITION_BUFFER_PUT_TIMEOUT = 0.5  # secondes d'attente quand le tampon est plein
+    POSITION_FLUSH_MAX_RETRIES = 5  # échecs d'un lot avant d'isoler (et d'écarter) les lignes fautives
+    POSITION_FLUSH_MAX_BACKOFF_SECONDS = 30  # attente max entre deux essais après une erreur
+    POSITION_BULK_MAX_AGE_SECONDS = 3600  # horodatage client le plus ancien accepté en envoi groupé
+    POSITION_MAX_CLOCK_SKEW_SECONDS = 30  # avance tolérée de l'horloge du client
+    
     # Configuration occupation
     MAX_OCCUPANCY_HISTORY = 100  # nombre d'entrées à garder par bus
+    OCCUPANCY_FLUSH_SECONDS = 5  # écriture groupée des compteurs de montées / descentes (une ligne par bus)
+    OCCUPANCY_MAX_HOLD_SECONDS = 1800  # durée max attribuée à un enregistrement dans les stats pondérées par le temps
+    
+    # Rétention des positions et de l'occupation (utils/retention.py, scripts/run_retention.py)
+    POSITION_RAW_RETENTION_DAYS = 7  # positions brutes conservées
+    POSITION_DOWNSAMPLE_METHOD = 'interval'  # 'interval' ou 'douglas_peucker'
+    POSITION_DOWNSAMPLE_SECONDS = 60  # une position par bus et par intervalle au-delà
+    POSITION_DOWNSAMPLE_TOLERANCE_M = 15  # tolérance de Douglas-Peucker
+    POSITION_ARCHIVE_DAYS = 90  # positions sous-échantillonnées supprimées au-delà
+    OCCUPANCY_RAW_RETENTION_DAYS = 7  # occupation brute (agrégats par minute conservés)
+    OCCUPANCY_ROLLUP_DELAY_SECONDS = 30  # marge après OCCUPANCY_FLUSH_SECONDS avant d'agréger une minute
+    RETENTION_CHUNK_SIZE = 1000  # lignes supprimées par transaction
+    RETENTION_CHUNK_PAUSE_SECONDS = 0.05  # pause entre deux transactions
+    RETENTION_WINDOW_MINUTES = 60  # fenêtre de positions traitée en mémoire
+    RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', 3600))  # 0 = cron seulement
+    
+    # Positions par période (utils/position_partitions.py, scripts/manage_partitions.py)
+    POSITION_PARTITIONING = os.environ.get('POSITION_PARTITIONING', 'false').lower() == 'true'
+    POSITION_PARTITION_PERIOD = os.environ.get('POSITION_PARTITION_PERIOD', 'day')  # 'day' ou 'week'
+    POSITION_HOT_PERIODS = 1  # SQLite : périodes terminées gardées dans la table positions
+    POSITION_PARTITIONS_AHEAD = 3  # MySQL : partitions créées à l'avance
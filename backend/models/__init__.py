@@ -1,9 +1,73 @@
+from flask import current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
 
-db = SQLAlchemy()
+class RoutingSession(Session):
+    """
+    Session dont les SELECT passent par le moteur de lecture de l'application
+    (app.db_reader) tant que la transaction en cours n'a rien écrit ; ensuite,
+    tout reste sur la connexion d'écriture (lecture de ses propres écritures)
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if isinstance(clause, Select) and not self._flushing and not self.info.get('wrote'):
+                reader = getattr(current_app, 'db_reader', None) if has_app_context() else None
+                engine = reader.read_bind(self) if reader is not None else None
+                if engine is not None:
+                    return engine
+            else:
+                self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+    
+    def commit(self):
+        super().commit()
+        self.info.pop('wrote', None)
+    
+    def rollback(self):
+        super().rollback()
+        self.info.pop('wrote', None)
+    
+    def close(self):
+        super().close()
+        self.info.pop('wrote', None)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def _latest_state():
+    """LatestStateStore de l'application courante (None hors contexte Flask)"""
+    return getattr(current_app, 'latest_state', None) if has_app_context() else None
+
+def _speed_estimator():
+    """SpeedEstimator de l'application courante (None hors contexte Flask)"""
+    return getattr(current_app, 'speed_estimator', None) if has_app_context() else None
+
+class LatestByBusMixin:
+    """
+    Modèles horodatés par bus (bus_id, timestamp) : dernier enregistrement de chaque bus
+    """
+    
+    @classmethod
+    def latest_by_bus(cls, bus_ids=None):
+        """
+        Dernier enregistrement de chaque bus en une requête (dict bus_id -> enregistrement)
+        """
+        latest = db.session.query(
+            cls.bus_id, db.func.max(cls.timestamp).label('timestamp')
+        ).group_by(cls.bus_id)
+        if bus_ids is not None:
+            latest = latest.filter(cls.bus_id.in_(bus_ids))
+        latest = latest.subquery()
+        
+        records = cls.query.join(
+            latest,
+            (cls.bus_id == latest.c.bus_id) & (cls.timestamp == latest.c.timestamp)
+        ).all()
+        return {record.bus_id: record for record in records}
 
 class Driver(db.Model):
     __tablename__ = 'drivers'
@@ -108,6 +172,28 @@ class RouteStop(db.Model):
             'stop': self.stop.to_dict() if self.stop else None
         }
 
+class RouteShape(db.Model):
+    __tablename__ = 'route_shapes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    route_id = db.Column(db.Integer, db.ForeignKey('routes.id'), unique=True, nullable=False)
+    points = db.Column(db.Text, nullable=False)  # JSON [[lat, lon], ...] dans l'ordre du trajet
+    cumulative_distances = db.Column(db.Text)  # JSON, mètres depuis le premier point
+    stop_distances = db.Column(db.Text)  # JSON [[séquence, stop_id, mètres], ...]
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    route = db.relationship('Route', backref=db.backref('shape', uselist=False, cascade='all, delete-orphan'))
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'route_id': self.route_id,
+            'points': json.loads(self.points) if self.points else [],
+            'cumulative_distances': json.loads(self.cumulative_distances) if self.cumulative_distances else [],
+            'stop_distances': json.loads(self.stop_distances) if self.stop_distances else [],
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
 class Bus(db.Model):
     __tablename__ = 'buses'
     
@@ -124,19 +210,44 @@ class Bus(db.Model):
     # Relations
     positions = db.relationship('Position', backref='bus', lazy=True, cascade='all, delete-orphan')
     occupancy_records = db.relationship('Occupancy', backref='bus', lazy=True, cascade='all, delete-orphan')
+    occupancy_rollups = db.relationship('OccupancyRollup', backref='bus', lazy=True, cascade='all, delete-orphan')
     predictions = db.relationship('Prediction', backref='bus', lazy=True, cascade='all, delete-orphan')
-    trip_history = db.relationship('TripHistory', backref='bus', lazy=True)
+    trip_history = db.relationship('TripHistory', backref='bus', lazy=True, cascade='all, delete-orphan')
+    stop_events = db.relationship('StopEvent', backref='bus', lazy=True, cascade='all, delete-orphan')
+    speed_estimate = db.relationship('BusSpeedEstimate', backref='bus', lazy=True, uselist=False,
+                                     cascade='all, delete-orphan')
     
     def get_current_position(self):
+        # État courant en mémoire (inclut les positions pas encore écrites en base)
+        store = _latest_state()
+        if store is not None:
+            state = store.get_position(self.id)
+            return Position(**state) if state else None
         return Position.query.filter_by(bus_id=self.id).order_by(Position.timestamp.desc()).first()
     
     def get_current_occupancy(self):
+        store = _latest_state()
+        if store is not None:
+            state = store.get_occupancy(self.id)
+            return Occupancy(**state) if state else None
         return Occupancy.query.filter_by(bus_id=self.id).order_by(Occupancy.timestamp.desc()).first()
     
     def to_dict(self):
-        current_position = self.get_current_position()
-        current_occupancy = self.get_current_occupancy()
-        
+        return self._serialize(
+            self.get_current_position(),
+            self.get_current_occupancy(),
+            self.driver,
+            self.route,
+            self.get_speed_estimate()
+        )
+    
+    def get_speed_estimate(self):
+        estimator = _speed_estimator()
+        if estimator is not None:
+            return estimator.get(self.id)
+        return self.speed_estimate.to_dict() if self.speed_estimate else None
+    
+    def _serialize(self, current_position, current_occupancy, driver, route, speed_estimate=None):
         return {
             'id': self.id,
             'number': self.number,
@@ -149,11 +260,63 @@ class Bus(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'current_position': current_position.to_dict() if current_position else None,
             'current_occupancy': current_occupancy.to_dict() if current_occupancy else None,
-            'driver': self.driver.to_dict() if self.driver else None,
-            'route': self.route.to_dict() if self.route else None
+            'speed_estimate': speed_estimate,
+            'driver': driver.to_dict() if driver else None,
+            'route': route.to_dict() if route else None
         }
+    
+    @staticmethod
+    def to_dict_many(buses):
+        """
+        Sérialise une liste de bus (même format que to_dict) avec un nombre
+        de requêtes constant, quel que soit le nombre de bus
+        """
+        buses = list(buses)
+        if not buses:
+            return []
+        
+        bus_ids = [bus.id for bus in buses]
+        store = _latest_state()
+        if store is not None:
+            positions = {}
+            occupancy = {}
+            for bus_id in bus_ids:
+                position_state = store.get_position(bus_id)
+                occupancy_state = store.get_occupancy(bus_id)
+                if position_state:
+                    positions[bus_id] = Position(**position_state)
+                if occupancy_state:
+                    occupancy[bus_id] = Occupancy(**occupancy_state)
+        else:
+            positions = Position.latest_by_bus(bus_ids)
+            occupancy = Occupancy.latest_by_bus(bus_ids)
+        
+        estimator = _speed_estimator()
+        if estimator is not None:
+            speed_estimates = {bus_id: estimator.get(bus_id) for bus_id in bus_ids}
+        else:
+            speed_estimates = {
+                e.bus_id: e.to_dict()
+                for e in BusSpeedEstimate.query.filter(BusSpeedEstimate.bus_id.in_(bus_ids)).all()
+            }
+        
+        driver_ids = {bus.driver_id for bus in buses if bus.driver_id}
+        route_ids = {bus.current_route_id for bus in buses if bus.current_route_id}
+        drivers = {d.id: d for d in Driver.query.filter(Driver.id.in_(driver_ids)).all()} if driver_ids else {}
+        routes = {r.id: r for r in Route.query.filter(Route.id.in_(route_ids)).all()} if route_ids else {}
+        
+        return [
+            bus._serialize(
+                positions.get(bus.id),
+                occupancy.get(bus.id),
+                drivers.get(bus.driver_id),
+                routes.get(bus.current_route_id),
+                speed_estimates.get(bus.id)
+            )
+            for bus in buses
+        ]
 
-class Position(db.Model):
+class Position(LatestByBusMixin, db.Model):
     __tablename__ = 'positions'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -165,6 +328,11 @@ class Position(db.Model):
     accuracy = db.Column(db.Float, default=0.0)  # mètres
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
+    # Dernières positions d'un bus (ORDER BY timestamp DESC)
+    __table_args__ = (
+        db.Index('ix_positions_bus_id_timestamp', bus_id, timestamp.desc()),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -177,7 +345,7 @@ class Position(db.Model):
             'timestamp': self.timestamp.isoformat() if self.timestamp else None
         }
 
-class Occupancy(db.Model):
+class Occupancy(LatestByBusMixin, db.Model):
     __tablename__ = 'occupancy'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -186,6 +354,11 @@ class Occupancy(db.Model):
     capacity_percentage = db.Column(db.Float, default=0.0)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
+    # Dernière occupation / historique d'un bus
+    __table_args__ = (
+        db.Index('ix_occupancy_bus_id_timestamp', bus_id, timestamp.desc()),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -195,6 +368,35 @@ class Occupancy(db.Model):
             'timestamp': self.timestamp.isoformat() if self.timestamp else None
         }
 
+class OccupancyRollup(db.Model):
+    __tablename__ = 'occupancy_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    bus_id = db.Column(db.Integer, db.ForeignKey('buses.id'), nullable=False)
+    minute = db.Column(db.DateTime, nullable=False)  # Début de la minute (UTC)
+    samples = db.Column(db.Integer, default=0)
+    passengers_avg = db.Column(db.Float, default=0.0)
+    passengers_min = db.Column(db.Integer, default=0)
+    passengers_max = db.Column(db.Integer, default=0)
+    passengers_last = db.Column(db.Integer, default=0)
+    capacity_percentage_avg = db.Column(db.Float, default=0.0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('bus_id', 'minute', name='uq_occupancy_rollups_bus_minute'),
+    )
+    
+    def to_dict(self):
+        return {
+            'bus_id': self.bus_id,
+            'minute': self.minute.isoformat() if self.minute else None,
+            'samples': self.samples,
+            'passengers_avg': round(self.passengers_avg, 2) if self.passengers_avg is not None else None,
+            'passengers_min': self.passengers_min,
+            'passengers_max': self.passengers_max,
+            'passengers_last': self.passengers_last,
+            'capacity_percentage_avg': round(self.capacity_percentage_avg, 2) if self.capacity_percentage_avg is not None else None
+        }
+
 class Prediction(db.Model):
     __tablename__ = 'predictions'
     
@@ -205,6 +407,12 @@ class Prediction(db.Model):
     confidence = db.Column(db.Float, default=0.5)  # 0.0 à 1.0
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Prochains passages à un arrêt / prédiction d'un couple bus-arrêt
+    __table_args__ = (
+        db.Index('ix_predictions_stop_id_arrival_time', stop_id, arrival_time),
+        db.Index('ix_predictions_bus_id_stop_id', bus_id, stop_id),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -230,6 +438,11 @@ class TripHistory(db.Model):
     average_speed = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Trajets d'un bus sur une période
+    __table_args__ = (
+        db.Index('ix_trip_history_bus_id_start_time', bus_id, start_time),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -243,6 +456,123 @@ class TripHistory(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+class StopEvent(db.Model):
+    __tablename__ = 'stop_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    bus_id = db.Column(db.Integer, db.ForeignKey('buses.id'), nullable=False)
+    route_id = db.Column(db.Integer, db.ForeignKey('routes.id'), nullable=False)
+    stop_id = db.Column(db.Integer, db.ForeignKey('stops.id'), nullable=False)
+    sequence = db.Column(db.Integer, nullable=False)  # Ordre de l'arrêt sur la ligne
+    arrival_time = db.Column(db.DateTime, nullable=False)
+    departure_time = db.Column(db.DateTime, nullable=False)
+    dwell_seconds = db.Column(db.Float, default=0.0)
+    stopped = db.Column(db.Boolean, default=True)  # False : passage sans position relevée à l'arrêt
+    
+    # Passages à un arrêt / historique d'un bus
+    __table_args__ = (
+        db.Index('ix_stop_events_stop_id_arrival_time', stop_id, arrival_time),
+        db.Index('ix_stop_events_bus_id_arrival_time', bus_id, arrival_time),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'bus_id': self.bus_id,
+            'route_id': self.route_id,
+            'stop_id': self.stop_id,
+            'sequence': self.sequence,
+            'arrival_time': self.arrival_time.isoformat() if self.arrival_time else None,
+            'departure_time': self.departure_time.isoformat() if self.departure_time else None,
+            'dwell_seconds': self.dwell_seconds,
+            'stopped': self.stopped
+        }
+
+class SegmentTravelTime(db.Model):
+    __tablename__ = 'segment_travel_times'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    route_id = db.Column(db.Integer, db.ForeignKey('routes.id'), nullable=False)
+    day_type = db.Column(db.String(10), nullable=False)  # weekday, saturday, sunday
+    segments = db.Column(db.Text, nullable=False)  # JSON [[from_stop_id, to_stop_id], ...]
+    histograms = db.Column(db.LargeBinary(length=2**24))  # uint32 créneaux × segments × classes, zlib
+    medians = db.Column(db.LargeBinary(length=2**24))  # float32 créneaux × segments (secondes, NaN si inconnu)
+    samples = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('route_id', 'day_type', name='uq_segment_travel_times_route_day'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'route_id': self.route_id,
+            'day_type': self.day_type,
+            'segments': json.loads(self.segments) if self.segments else [],
+            'samples': self.samples,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class SegmentModelState(db.Model):
+    __tablename__ = 'segment_model_state'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    last_position_id = db.Column(db.Integer, default=0)  # Dernière position agrégée
+    buses = db.Column(db.Text)  # JSON : état de chaque bus entre deux exécutions
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BusSpeedEstimate(db.Model):
+    __tablename__ = 'bus_speed_estimates'
+    
+    bus_id = db.Column(db.Integer, db.ForeignKey('buses.id'), primary_key=True)
+    speed = db.Column(db.Float)  # km/h, moyenne mobile exponentielle en roulant
+    variance = db.Column(db.Float)  # (km/h)²
+    samples = db.Column(db.Integer, default=0)
+    rejected = db.Column(db.Integer, default=0)
+    last_latitude = db.Column(db.Float)  # Dernière position intégrée
+    last_longitude = db.Column(db.Float)
+    last_timestamp = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'speed': round(self.speed, 1) if self.speed is not None else None,
+            'std': round((self.variance or 0.0) ** 0.5, 1),
+            'samples': self.samples,
+            'moving': self.speed is not None,
+            'updated_at': self.last_timestamp.isoformat() if self.last_timestamp else None
+        }
+
+class RetentionState(db.Model):
+    __tablename__ = 'retention_state'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    positions_downsampled_until = db.Column(db.DateTime)  # Positions plus anciennes déjà sous-échantillonnées
+    occupancy_rolled_until = db.Column(db.DateTime)  # Occupation agrégée par minute jusqu'à cette date
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PositionPartition(db.Model):
+    __tablename__ = 'position_partitions'
+    
+    # Tables de positions par période (SQLite, voir utils/position_partitions.py)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    period_start = db.Column(db.DateTime, nullable=False, index=True)
+    period_end = db.Column(db.DateTime, nullable=False)  # Exclu
+    row_count = db.Column(db.Integer, default=0)
+    downsampled = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'period_start': self.period_start.isoformat(),
+            'period_end': self.period_end.isoformat(),
+            'row_count': self.row_count,
+            'downsampled': self.downsampled
+        }
+
 class UserFavorite(db.Model):
     __tablename__ = 'user_favorites'
     
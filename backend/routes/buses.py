@@ -1,7 +1,7 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, Bus, Driver, Route
-from datetime import datetime
+from models import db, Bus, Driver, Route, TripHistory
+from datetime import datetime, timedelta
 
 buses_bp = Blueprint('buses', __name__)
 
@@ -31,7 +31,7 @@ def get_all_buses():
         )
         
         return jsonify({
-            'buses': [bus.to_dict() for bus in buses.items],
+            'buses': Bus.to_dict_many(buses.items),
             'total': buses.total,
             'pages': buses.pages,
             'current_page': page
@@ -68,7 +68,7 @@ def get_bus_positions(bus_id):
         
         limit = request.args.get('limit', 100, type=int)
         
-        positions = bus.positions.order_by(db.desc('timestamp')).limit(limit).all()
+        positions = current_app.position_partitions.query(bus_id, limit=limit, newest_first=True)
         
         return jsonify({
             'bus_id': bus_id,
@@ -101,6 +101,40 @@ def get_bus_occupancy(bus_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@buses_bp.route('/<int:bus_id>/trips', methods=['GET'])
+def get_bus_trips(bus_id):
+    """
+    Obtient les trajets d'un bus (distance, vitesse moyenne, passagers) sur une période
+    """
+    try:
+        bus = Bus.query.get(bus_id)
+        if not bus:
+            return jsonify({'error': 'Bus non trouvé'}), 404
+        
+        hours = request.args.get('hours', 24, type=int)
+        since_time = datetime.utcnow() - timedelta(hours=hours)
+        
+        trips = TripHistory.query.filter_by(bus_id=bus_id)\
+            .filter(TripHistory.start_time >= since_time)\
+            .order_by(TripHistory.start_time.asc()).all()
+        
+        total_distance = sum(trip.distance_km or 0.0 for trip in trips)
+        
+        return jsonify({
+            'bus_id': bus_id,
+            'trips': [trip.to_dict() for trip in trips],
+            'current_trip': current_app.trip_history.current(bus_id),
+            'summary': {
+                'count': len(trips),
+                'total_distance_km': round(total_distance, 2),
+                'total_passengers': sum(trip.total_passengers or 0 for trip in trips),
+                'period_hours': hours
+            }
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @buses_bp.route('/', methods=['POST'])
 @jwt_required()
 def create_bus():
@@ -156,6 +190,7 @@ def update_bus(bus_id):
         data = request.get_json()
         
         # Met à jour les champs modifiables
+        previous_route_id = bus.current_route_id
         updateable_fields = ['capacity', 'driver_id', 'current_route_id', 'status', 'is_in_service']
         for field in updateable_fields:
             if field in data:
@@ -163,6 +198,10 @@ def update_bus(bus_id):
         
         db.session.commit()
         
+        # Trajet en cours terminé (hors service ou changement de ligne)
+        if not bus.is_in_service or bus.current_route_id != previous_route_id:
+            current_app.trip_history.end_trip(bus_id)
+        
         return jsonify({
             'message': 'Bus mis à jour',
             'bus': bus.to_dict()
@@ -194,6 +233,9 @@ def update_bus_status(bus_id):
         
         db.session.commit()
         
+        if not bus.is_in_service:
+            current_app.trip_history.end_trip(bus_id)
+        
         return jsonify({
             'message': 'Statut mis à jour',
             'bus': bus.to_dict()
@@ -212,7 +254,7 @@ def get_active_buses():
         buses = Bus.query.filter_by(is_in_service=True, status='active').all()
         
         return jsonify({
-            'buses': [bus.to_dict() for bus in buses],
+            'buses': Bus.to_dict_many(buses),
             'count': len(buses)
         })
         
@@ -235,7 +277,7 @@ def get_driver_buses(driver_id):
         buses = Bus.query.filter_by(driver_id=driver_id).all()
         
         return jsonify({
-            'buses': [bus.to_dict() for bus in buses],
+            'buses': Bus.to_dict_many(buses),
             'count': len(buses)
         })
         
@@ -255,6 +297,13 @@ def delete_bus(bus_id):
         
         db.session.delete(bus)
         db.session.commit()
+        current_app.latest_state.forget(bus_id)
+        current_app.gps_filter.forget(bus_id)
+        current_app.speed_estimator.forget(bus_id)
+        current_app.stop_events.forget(bus_id)
+        current_app.trip_history.end_trip(bus_id)
+        current_app.occupancy_counters.forget(bus_id)
+        current_app.position_partitions.delete_bus(bus_id)
         
         return jsonify({'message': 'Bus supprimé'})
         
@@ -0,0 +1,63 @@
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import jwt_required
+from models import db, Route
+from utils.gps_utils import validate_coordinates_array
+from utils.route_geometry import build_route_shape
+
+lines_bp = Blueprint('lines', __name__)
+
+@lines_bp.route('/<int:route_id>/shape', methods=['GET'])
+def get_route_shape(route_id):
+    """
+    Obtient le tracé d'une ligne avec la position des arrêts (mètres depuis le début)
+    """
+    try:
+        route = Route.query.get(route_id)
+        if not route:
+            return jsonify({'error': 'Ligne non trouvée'}), 404
+        
+        geometry = current_app.route_geometry.get(route_id)
+        if geometry is None:
+            return jsonify({'error': 'Aucun tracé ni arrêt pour cette ligne'}), 404
+        
+        return jsonify({'shape': geometry.to_dict()}), 200
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@lines_bp.route('/<int:route_id>/shape', methods=['PUT'])
+@jwt_required()
+def update_route_shape(route_id):
+    """
+    Enregistre le tracé d'une ligne : {"points": [[lat, lon], ...]} dans l'ordre du trajet
+    """
+    try:
+        route = Route.query.get(route_id)
+        if not route:
+            return jsonify({'error': 'Ligne non trouvée'}), 404
+        data = request.get_json()
+        
+        points = data.get('points') if data else None
+        if not points or len(points) < 2:
+            return jsonify({'error': 'Au moins deux points requis'}), 400
+        
+        try:
+            points = [[float(p[0]), float(p[1])] for p in points]
+        except (TypeError, ValueError, IndexError):
+            return jsonify({'error': 'Points invalides'}), 400
+        
+        if not validate_coordinates_array([p[0] for p in points], [p[1] for p in points]).all():
+            return jsonify({'error': 'Coordonnées invalides'}), 400
+        
+        build_route_shape(route_id, points)
+        db.session.commit()
+        current_app.route_geometry.invalidate(route_id)
+        
+        return jsonify({
+            'message': 'Tracé enregistré avec succès',
+            'shape': current_app.route_geometry.get(route_id).to_dict()
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
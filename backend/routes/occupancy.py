@@ -1,8 +1,8 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, Occupancy, Bus
+from models import db, Occupancy, OccupancyRollup, Bus
 from utils.predictions import OccupancyManager
-from datetime import datetime
+from datetime import datetime, timedelta
 
 occupancy_bp = Blueprint('occupancy', __name__)
 
@@ -114,6 +114,33 @@ def get_current_occupancy(bus_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@occupancy_bp.route('/bus/<int:bus_id>/minutes', methods=['GET'])
+def get_bus_occupancy_minutes(bus_id):
+    """
+    Obtient l'occupation agrégée par minute d'un bus (conservée après la rétention)
+    """
+    try:
+        bus = Bus.query.get(bus_id)
+        if not bus:
+            return jsonify({'error': 'Bus non trouvé'}), 404
+        
+        hours = request.args.get('hours', 24, type=int)
+        since = datetime.utcnow() - timedelta(hours=hours)
+        
+        rollups = OccupancyRollup.query.filter_by(bus_id=bus_id)\
+            .filter(OccupancyRollup.minute >= since)\
+            .order_by(OccupancyRollup.minute.asc()).all()
+        
+        return jsonify({
+            'bus_id': bus_id,
+            'minutes': [rollup.to_dict() for rollup in rollups],
+            'count': len(rollups),
+            'period_hours': hours
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @occupancy_bp.route('/increment', methods=['POST'])
 @jwt_required()
 def increment_occupancy():
@@ -131,23 +158,13 @@ def increment_occupancy():
         if not bus:
             return jsonify({'error': 'Bus non trouvé ou non assigné'}), 404
         
-        # Obtient l'occupation actuelle
-        current_occupancy = bus.get_current_occupancy()
-        current_count = current_occupancy.passenger_count if current_occupancy else 0
-        
-        # Incrémente (sans dépasser la capacité)
-        new_count = min(current_count + 1, bus.capacity)
-        
-        success = OccupancyManager.update_occupancy(data['bus_id'], new_count)
+        # Incrémente le compteur en mémoire (sans dépasser la capacité), écrit par lots
+        occupancy = current_app.occupancy_counters.adjust(bus.id, 1, bus.capacity)
         
-        if success:
-            latest_occupancy = bus.get_current_occupancy()
-            return jsonify({
-                'message': 'Passager ajouté',
-                'occupancy': latest_occupancy.to_dict()
-            })
-        else:
-            return jsonify({'error': 'Erreur mise à jour'}), 500
+        return jsonify({
+            'message': 'Passager ajouté',
+            'occupancy': Occupancy(**occupancy).to_dict()
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -169,23 +186,13 @@ def decrement_occupancy():
         if not bus:
             return jsonify({'error': 'Bus non trouvé ou non assigné'}), 404
         
-        # Obtient l'occupation actuelle
-        current_occupancy = bus.get_current_occupancy()
-        current_count = current_occupancy.passenger_count if current_occupancy else 0
+        # Décrémente le compteur en mémoire (minimum 0), écrit par lots
+        occupancy = current_app.occupancy_counters.adjust(bus.id, -1, bus.capacity)
         
-        # Décrémente (minimum 0)
-        new_count = max(current_count - 1, 0)
-        
-        success = OccupancyManager.update_occupancy(data['bus_id'], new_count)
-        
-        if success:
-            latest_occupancy = bus.get_current_occupancy()
-            return jsonify({
-                'message': 'Passager retiré',
-                'occupancy': latest_occupancy.to_dict()
-            })
-        else:
-            return jsonify({'error': 'Erreur mise à jour'}), 500
+        return jsonify({
+            'message': 'Passager retiré',
+            'occupancy': Occupancy(**occupancy).to_dict()
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1,12 +1,55 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import db, Position, Bus
-from datetime import datetime
-from utils.gps_utils import validate_coordinates
-from utils.predictions import PredictionEngine
+from datetime import datetime, timedelta, timezone
+from utils.gps_utils import validate_coordinates, validate_coordinates_array, consecutive_distances
 
 positions_bp = Blueprint('positions', __name__)
 
+def _filtered_dict(estimate):
+    """Estimation lissée (filtre de Kalman) sérialisable"""
+    if estimate is None:
+        return None
+    return {
+        'latitude': round(estimate['latitude'], 6),
+        'longitude': round(estimate['longitude'], 6),
+        'speed': round(estimate['speed'], 1),
+        'heading': round(estimate['heading'], 1),
+        'position_std_m': round(estimate['position_std_m'], 1),
+        'speed_std_kmh': round(estimate['speed_std_kmh'], 1),
+        'timestamp': estimate['timestamp'].isoformat()
+    }
+
+def _client_timestamp(value, now, max_age, max_skew):
+    """
+    Horodatage ISO 8601 envoyé par le client (UTC si sans fuseau) ; now s'il
+    est absent. Hors de [now - max_age, now + max_skew], la position est
+    refusée (ValueError) : l'horodatage n'est jamais réécrit
+    """
+    if value is None:
+        return now
+    timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    if timestamp < now - timedelta(seconds=max_age):
+        raise ValueError(f"horodatage antérieur à {max_age} secondes")
+    if timestamp > now + timedelta(seconds=max_skew):
+        raise ValueError("horodatage dans le futur")
+    return timestamp
+
+def _project_fix(row, route_id):
+    """
+    Projette la position reçue (lissée par le filtre) sur le tracé de la ligne,
+    une fois par position ; gardée dans l'état courant pour les prédictions et
+    la détection des arrêts
+    """
+    estimate = current_app.gps_filter.get(row['bus_id']) or row
+    projection = current_app.route_geometry.track(
+        row['bus_id'], route_id, estimate['latitude'], estimate['longitude'], row['timestamp']
+    )
+    if projection is not None:
+        current_app.latest_state.set_projection(row['bus_id'], projection)
+
 @positions_bp.route('/', methods=['POST'])
 @jwt_required()
 def create_position():
@@ -31,29 +74,44 @@ def create_position():
             return jsonify({'error': 'Coordonnées GPS invalides'}), 400
         
         # Crée la nouvelle position
-        position = Position(
-            bus_id=data['bus_id'],
-            latitude=data['latitude'],
-            longitude=data['longitude'],
-            speed=data.get('speed', 0.0),
-            heading=data.get('heading', 0.0),
-            accuracy=data.get('accuracy', 0.0),
-            timestamp=datetime.utcnow()
-        )
-        
-        db.session.add(position)
-        db.session.commit()
-        
-        # Met à jour les prédictions pour ce bus (async si possible)
-        try:
-            PredictionEngine.update_all_predictions()
-        except Exception as e:
-            print(f"Erreur mise à jour prédictions: {e}")
+        position_data = {
+            'bus_id': bus.id,
+            'latitude': float(data['latitude']),
+            'longitude': float(data['longitude']),
+            'speed': float(data.get('speed') or 0.0),
+            'heading': float(data.get('heading') or 0.0),
+            'accuracy': float(data.get('accuracy') or 0.0),
+            'timestamp': datetime.utcnow()
+        }
+        position = Position(**position_data)
+        
+        buffer = current_app.position_buffer
+        if buffer.enabled:
+            # Mode write-behind : écrite par le prochain group commit
+            if not buffer.put([position_data]):
+                return jsonify({'error': 'Tampon de positions plein, réessayez plus tard'}), 503
+            status_code = 202
+        else:
+            db.session.add(position)
+            db.session.commit()
+            status_code = 201
+        
+        # État courant en mémoire (lu par Bus.to_dict, les prédictions, ...)
+        current_app.gps_filter.update(position_data)
+        _project_fix(position_data, bus.current_route_id)
+        current_app.speed_estimator.update(position_data)
+        events = current_app.stop_events.update(position_data, bus.current_route_id)
+        current_app.trip_history.update(position_data, bus.current_route_id, events, bus.is_in_service)
+        current_app.latest_state.update_position(dict(position_data, id=position.id))
+        current_app.realtime.publish_position(bus.id, bus.current_route_id, position_data)
+        
+        # Signale le déplacement : les ETA de ce bus sont recalculées en arrière-plan
+        current_app.prediction_queue.enqueue(bus.id)
         
         return jsonify({
             'message': 'Position enregistrée',
             'position': position.to_dict()
-        }), 201
+        }), status_code
         
     except Exception as e:
         db.session.rollback()
@@ -72,13 +130,14 @@ def get_bus_positions(bus_id):
         limit = request.args.get('limit', 100, type=int)
         since_minutes = request.args.get('since_minutes', type=int)
         
-        query = Position.query.filter_by(bus_id=bus_id)
-        
+        since_time = None
         if since_minutes:
             since_time = datetime.utcnow() - timedelta(minutes=since_minutes)
-            query = query.filter(Position.timestamp >= since_time)
         
-        positions = query.order_by(Position.timestamp.desc()).limit(limit).all()
+        # Seules les partitions couvrant la période sont lues
+        positions = current_app.position_partitions.query(
+            bus_id, start=since_time, limit=limit, newest_first=True
+        )
         
         return jsonify({
             'bus_id': bus_id,
@@ -99,13 +158,10 @@ def get_current_positions():
         active_buses = Bus.query.filter_by(is_in_service=True).all()
         
         current_positions = []
-        for bus in active_buses:
-            latest_position = Position.query.filter_by(bus_id=bus.id)\
-                .order_by(Position.timestamp.desc()).first()
-            
-            if latest_position:
-                position_data = latest_position.to_dict()
-                position_data['bus'] = bus.to_dict()
+        for bus_data in Bus.to_dict_many(active_buses):
+            if bus_data['current_position']:
+                position_data = dict(bus_data['current_position'])
+                position_data['bus'] = bus_data
                 current_positions.append(position_data)
         
         return jsonify({
@@ -127,14 +183,15 @@ def get_current_position(bus_id):
         if not bus:
             return jsonify({'error': 'Bus non trouvé'}), 404
         
-        position = Position.query.filter_by(bus_id=bus_id)\
-            .order_by(Position.timestamp.desc()).first()
+        position = bus.get_current_position()
         
         if not position:
             return jsonify({'error': 'Aucune position disponible'}), 404
         
         return jsonify({
             'position': position.to_dict(),
+            'filtered': _filtered_dict(current_app.gps_filter.get(bus_id)),
+            'at_stop': current_app.stop_events.current(bus_id),
             'bus': bus.to_dict()
         })
         
@@ -146,51 +203,106 @@ def get_current_position(bus_id):
 def create_bulk_positions():
     """
     Enregistre plusieurs positions en une fois
+    (une seule vérification de propriété, validation vectorisée, INSERT multi-lignes)
     """
     try:
         driver_id = int(get_jwt_identity())
         data = request.get_json()
         
-        if not data or 'positions' not in data:
+        if not data or not isinstance(data.get('positions'), list):
             return jsonify({'error': 'Liste de positions requise'}), 400
         
-        positions_created = 0
         errors = []
+        candidates = []  # (index, bus_id, latitude, longitude, timestamp, pos_data)
         
-        for pos_data in data['positions']:
+        now = datetime.utcnow()
+        max_age = current_app.config.get('POSITION_BULK_MAX_AGE_SECONDS', 3600)
+        max_skew = current_app.config.get('POSITION_MAX_CLOCK_SKEW_SECONDS', 30)
+        
+        # Lecture des champs (horodatage optionnel : positions mises en attente hors réseau)
+        for index, pos_data in enumerate(data['positions']):
             try:
-                # Vérifie que le bus appartient au chauffeur
-                bus = Bus.query.filter_by(id=pos_data['bus_id'], driver_id=driver_id).first()
-                if not bus:
-                    errors.append(f"Bus {pos_data['bus_id']} non assigné")
-                    continue
-                
-                # Valide les coordonnées
-                if not validate_coordinates(pos_data['latitude'], pos_data['longitude']):
-                    errors.append(f"Coordonnées invalides pour bus {pos_data['bus_id']}")
-                    continue
-                
-                position = Position(
-                    bus_id=pos_data['bus_id'],
-                    latitude=pos_data['latitude'],
-                    longitude=pos_data['longitude'],
-                    speed=pos_data.get('speed', 0.0),
-                    heading=pos_data.get('heading', 0.0),
-                    accuracy=pos_data.get('accuracy', 0.0),
-                    timestamp=datetime.utcnow()
-                )
-                
-                db.session.add(position)
-                positions_created += 1
-                
-            except Exception as e:
-                errors.append(f"Erreur position: {str(e)}")
-        
-        db.session.commit()
+                candidates.append((
+                    index,
+                    int(pos_data['bus_id']),
+                    float(pos_data['latitude']),
+                    float(pos_data['longitude']),
+                    _client_timestamp(pos_data.get('timestamp'), now, max_age, max_skew),
+                    pos_data
+                ))
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append({'index': index, 'error': f"Position invalide: {e}"})
+        
+        # Vérifie en une requête les bus appartenant au chauffeur (bus_id -> ligne) et ceux en service
+        bus_ids = {c[1] for c in candidates}
+        owned_bus_ids = {}
+        in_service = set()
+        if bus_ids:
+            for bus_id, route_id, is_in_service in db.session.query(Bus.id, Bus.current_route_id, Bus.is_in_service)\
+                    .filter(Bus.id.in_(bus_ids), Bus.driver_id == driver_id).all():
+                owned_bus_ids[bus_id] = route_id
+                if is_in_service:
+                    in_service.add(bus_id)
+        
+        # Valide toutes les coordonnées en une passe
+        valid_mask = validate_coordinates_array(
+            [c[2] for c in candidates], [c[3] for c in candidates]
+        )
+        
+        rows = []
+        for (index, bus_id, latitude, longitude, timestamp, pos_data), is_valid in zip(candidates, valid_mask):
+            if bus_id not in owned_bus_ids:
+                errors.append({'index': index, 'bus_id': bus_id, 'error': f"Bus {bus_id} non assigné"})
+                continue
+            if not is_valid:
+                errors.append({'index': index, 'bus_id': bus_id, 'error': f"Coordonnées invalides pour bus {bus_id}"})
+                continue
+            
+            rows.append({
+                'bus_id': bus_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'speed': float(pos_data.get('speed') or 0.0),
+                'heading': float(pos_data.get('heading') or 0.0),
+                'accuracy': float(pos_data.get('accuracy') or 0.0),
+                'timestamp': timestamp
+            })
+        
+        buffer = current_app.position_buffer
+        if buffer.enabled:
+            # Mode write-behind : écrites par le prochain group commit
+            if not buffer.put(rows):
+                return jsonify({'error': 'Tampon de positions plein, réessayez plus tard'}), 503
+        else:
+            # Insertion multi-lignes (executemany)
+            if rows:
+                db.session.execute(db.insert(Position), rows)
+            db.session.commit()
+        
+        # Les positions passent par le filtre, l'estimateur de vitesse, la détection des arrêts et les trajets,
+        # une seule par bus et par horodatage (sans horodatage client, toutes valent now : intervalle nul)
+        series = list({(row['bus_id'], row['timestamp']): row for row in rows}.values())
+        for row in sorted(series, key=lambda r: r['timestamp']):
+            current_app.gps_filter.update(row)
+            _project_fix(row, owned_bus_ids[row['bus_id']])
+        current_app.speed_estimator.update_many(series)
+        events = current_app.stop_events.update_many(series, owned_bus_ids)
+        current_app.trip_history.update_many(series, owned_bus_ids, events, in_service)
+        # La plus récente de chaque bus dans l'état courant
+        latest_rows = {}
+        for row in rows:
+            if row['bus_id'] not in latest_rows or row['timestamp'] >= latest_rows[row['bus_id']]['timestamp']:
+                latest_rows[row['bus_id']] = row
+        for bus_id, row in latest_rows.items():
+            current_app.latest_state.update_position(row)
+            current_app.realtime.publish_position(bus_id, owned_bus_ids[bus_id], row)
+            current_app.prediction_queue.enqueue(bus_id)
+        
+        errors.sort(key=lambda e: e['index'])
         
         return jsonify({
-            'message': f'{positions_created} positions créées',
-            'created': positions_created,
+            'message': f'{len(rows)} positions créées',
+            'created': len(rows),
             'errors': errors
         })
         
@@ -214,20 +326,13 @@ def track_bus(bus_id):
         hours = request.args.get('hours', 24, type=int)
         since_time = datetime.utcnow() - timedelta(hours=hours)
         
-        positions = Position.query.filter_by(bus_id=bus_id)\
-            .filter(Position.timestamp >= since_time)\
-            .order_by(Position.timestamp.asc()).all()
+        positions = current_app.position_partitions.query(bus_id, start=since_time)
         
         # Calcule des statistiques
-        total_distance = 0.0
-        if len(positions) > 1:
-            from utils.gps_utils import calculate_distance
-            for i in range(1, len(positions)):
-                distance = calculate_distance(
-                    positions[i-1].latitude, positions[i-1].longitude,
-                    positions[i].latitude, positions[i].longitude
-                )
-                total_distance += distance
+        total_distance = float(consecutive_distances(
+            [pos.latitude for pos in positions],
+            [pos.longitude for pos in positions]
+        ).sum())
         
         return jsonify({
             'bus_id': bus_id,
@@ -1,7 +1,6 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from models import db, Stop, Route, RouteStop, UserFavorite
-from utils.gps_utils import calculate_distance
-import math
+from utils.predictions import PredictionEngine
 
 stops_bp = Blueprint('stops', __name__)
 
@@ -89,21 +88,14 @@ def get_nearby_stops():
         if latitude is None or longitude is None:
             return jsonify({'error': 'Coordonnées GPS requises'}), 400
         
-        # Obtient tous les arrêts actifs
-        stops = Stop.query.filter_by(is_active=True).all()
-        
-        # Calcule les distances et filtre
+        # Arrêts les plus proches via l'index spatial en mémoire
         nearby_stops = []
-        for stop in stops:
-            distance = calculate_distance(latitude, longitude, stop.latitude, stop.longitude)
-            if distance <= radius_km:
-                stop_data = stop.to_dict()
-                stop_data['distance_km'] = round(distance, 3)
-                nearby_stops.append(stop_data)
-        
-        # Trie par distance et limite
-        nearby_stops.sort(key=lambda x: x['distance_km'])
-        nearby_stops = nearby_stops[:limit]
+        for stop_data, distance in current_app.stop_index.nearest(
+            latitude, longitude, limit, max_radius_km=radius_km
+        ):
+            stop_data = dict(stop_data)
+            stop_data['distance_km'] = round(distance, 3)
+            nearby_stops.append(stop_data)
         
         return jsonify({
             'stops': nearby_stops,
@@ -128,6 +120,9 @@ def get_stop_predictions(stop_id):
         if not stop:
             return jsonify({'error': 'Arrêt non trouvé'}), 404
         
+        # Calcule à la demande les prédictions périmées de cet arrêt
+        PredictionEngine.refresh_stop_predictions(stop_id)
+        
         # Obtient les prédictions récentes pour cet arrêt
         predictions = Prediction.query.filter_by(stop_id=stop_id)\
             .filter(Prediction.arrival_time >= datetime.utcnow())\
@@ -156,6 +151,40 @@ def get_stop_predictions(stop_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@stops_bp.route('/<int:stop_id>/events', methods=['GET'])
+def get_stop_events(stop_id):
+    """
+    Obtient les passages réels des bus à un arrêt (arrivée, départ, temps d'arrêt)
+    """
+    try:
+        from models import StopEvent
+        from datetime import datetime, timedelta
+        
+        stop = Stop.query.get(stop_id)
+        if not stop:
+            return jsonify({'error': 'Arrêt non trouvé'}), 404
+        
+        limit = request.args.get('limit', 50, type=int)
+        since_minutes = request.args.get('since_minutes', type=int)
+        route_id = request.args.get('route_id', type=int)
+        
+        query = StopEvent.query.filter_by(stop_id=stop_id)
+        if route_id:
+            query = query.filter_by(route_id=route_id)
+        if since_minutes:
+            query = query.filter(StopEvent.arrival_time >= datetime.utcnow() - timedelta(minutes=since_minutes))
+        
+        events = query.order_by(StopEvent.arrival_time.desc()).limit(limit).all()
+        
+        return jsonify({
+            'stop_id': stop_id,
+            'events': [event.to_dict() for event in events],
+            'count': len(events)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @stops_bp.route('/', methods=['POST'])
 def create_stop():
     """
@@ -183,6 +212,7 @@ def create_stop():
         
         db.session.add(stop)
         db.session.commit()
+        current_app.stop_index.upsert(stop)
         
         return jsonify({
             'message': 'Arrêt créé avec succès',
@@ -216,6 +246,11 @@ def update_stop(stop_id):
                 setattr(stop, field, data[field])
         
         db.session.commit()
+        current_app.stop_index.upsert(stop)
+        if 'latitude' in data or 'longitude' in data:
+            # Arrêt déplacé : distances le long des lignes qui le desservent à recalculer
+            for route_id in current_app.route_geometry.invalidate_stop(stop_id):
+                current_app.stop_events.invalidate(route_id)
         
         return jsonify({
             'message': 'Arrêt mis à jour',
@@ -319,6 +354,7 @@ def delete_stop(stop_id):
         # Désactive au lieu de supprimer
         stop.is_active = False
         db.session.commit()
+        current_app.stop_index.remove(stop_id)
         
         return jsonify({'message': 'Arrêt désactivé'})
         
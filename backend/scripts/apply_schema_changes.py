@@ -14,6 +14,7 @@ def apply_schema():
         print('Creating missing tables (db.create_all())...')
         db.create_all()
         print('Done: db.create_all() executed')
+        print('Note: indexes on existing tables are added by scripts/apply_indexes.py')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Compare les calculs de distance par boucle (geopy.geodesic, calculate_distance)
+aux fonctions vectorisées de utils/gps_utils, et mesure l'écart entre les deux.
+
+Usage:
+  python benchmark_distances.py
+  python benchmark_distances.py --points 20000 --repeat 3
+"""
+import argparse
+import os
+import sys
+import time
+
+# Ensure parent (backend/) is on sys.path so imports work when running from scripts/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from utils.gps_utils import (
+    calculate_distance, distances_from_point, consecutive_distances, distance_matrix
+)
+
+
+def best_time(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def report(name, loop_time, vector_time, loop_result, vector_result):
+    loop_result = np.asarray(loop_result, dtype=float)
+    vector_result = np.asarray(vector_result, dtype=float)
+    mask = loop_result > 0.01
+    max_rel_error = float(np.max(np.abs(vector_result[mask] - loop_result[mask]) / loop_result[mask])) if mask.any() else 0.0
+    print(f'{name:<28} boucle {loop_time * 1000:9.1f} ms   vectorisé {vector_time * 1000:8.2f} ms   '
+          f'x{loop_time / vector_time:7.0f}   erreur max {max_rel_error * 100:.3f} %')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark des distances GPS vectorisées')
+    parser.add_argument('--points', type=int, default=5000, help='Nombre de points (arrêts / positions)')
+    parser.add_argument('--repeat', type=int, default=3, help='Nombre de répétitions (meilleur temps retenu)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    # Points répartis sur ~20 km autour de Toulouse
+    lats = 43.6047 + rng.uniform(-0.1, 0.1, args.points)
+    lons = 1.4442 + rng.uniform(-0.13, 0.13, args.points)
+    center = (43.6047, 1.4442)
+
+    # Un-vers-plusieurs (/api/stops/nearby)
+    loop_time, loop_result = best_time(
+        lambda: [calculate_distance(center[0], center[1], la, lo) for la, lo in zip(lats, lons)], args.repeat)
+    vector_time, vector_result = best_time(
+        lambda: distances_from_point(center[0], center[1], lats, lons), args.repeat)
+    report('un-vers-plusieurs', loop_time, vector_time, loop_result, vector_result)
+
+    # Points consécutifs (track_bus, vitesse moyenne)
+    loop_time, loop_result = best_time(
+        lambda: [calculate_distance(lats[i - 1], lons[i - 1], lats[i], lons[i]) for i in range(1, len(lats))],
+        args.repeat)
+    vector_time, vector_result = best_time(lambda: consecutive_distances(lats, lons), args.repeat)
+    report('consécutifs', loop_time, vector_time, loop_result, vector_result)
+
+    # Plusieurs-vers-plusieurs (bus x arrêts)
+    n = min(200, args.points)
+    m = min(100, args.points)
+    loop_time, loop_result = best_time(
+        lambda: [[calculate_distance(lats[i], lons[i], lats[j], lons[j]) for j in range(m)] for i in range(n)],
+        args.repeat)
+    vector_time, vector_result = best_time(
+        lambda: distance_matrix(lats[:n], lons[:n], lats[:m], lons[:m]), args.repeat)
+    report(f'matrice {n}x{m}', loop_time, vector_time, loop_result, vector_result)
+
+
+if __name__ == '__main__':
+    main()
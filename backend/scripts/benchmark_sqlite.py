@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Débit des lectures concurrentes pendant l'ingestion GPS, avec la
+configuration SQLite par défaut (journal rollback, un seul pool) et avec le
+profil de production (WAL, PRAGMA, un écrivain, pool de lecture séparé ;
+voir utils/sqlite_profile.py).
+
+Pour chaque configuration, les lecteurs (historique des positions d'un bus)
+tournent d'abord seuls, puis pendant qu'un thread insère des positions par
+lots. Base temporaire, supprimée à la fin.
+
+Usage:
+  python benchmark_sqlite.py
+  python benchmark_sqlite.py --readers 8 --seconds 10 --batch 100
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Ensure parent (backend/) is on sys.path so imports work when running from scripts/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from sqlalchemy import create_engine, insert, select
+
+from config import Config
+from models import db, Bus, Position
+from utils.sqlite_profile import sqlite_pragmas, apply_pragmas, create_reader_engine
+
+
+def seed(engine, buses: int, rows: int):
+    db.metadata.create_all(engine)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        connection.execute(insert(Bus.__table__), [
+            {'id': bus_id, 'number': f'B{bus_id}', 'license_plate': f'P-{bus_id}', 'capacity': 50}
+            for bus_id in range(1, buses + 1)
+        ])
+        connection.execute(insert(Position.__table__), [
+            {
+                'bus_id': i % buses + 1,
+                'latitude': 43.6 + random.uniform(-0.05, 0.05),
+                'longitude': 1.44 + random.uniform(-0.05, 0.05),
+                'speed': 30.0, 'heading': 0.0, 'accuracy': 5.0,
+                'timestamp': now - timedelta(seconds=rows - i)
+            }
+            for i in range(rows)
+        ])
+
+
+def run_phase(writer, reader, buses: int, readers: int, seconds: float, batch: int, ingest: bool) -> dict:
+    stop = threading.Event()
+    latencies = [[] for _ in range(readers)]
+    errors = {'read': 0, 'write': 0}
+    written = [0]
+
+    def read_loop(index):
+        table = Position.__table__
+        while not stop.is_set():
+            bus_id = random.randint(1, buses)
+            statement = select(table).where(table.c.bus_id == bus_id)\
+                .order_by(table.c.timestamp.desc()).limit(50)
+            started = time.perf_counter()
+            try:
+                with reader.connect() as connection:
+                    connection.execute(statement).all()
+                latencies[index].append(time.perf_counter() - started)
+            except Exception:
+                errors['read'] += 1
+
+    def write_loop():
+        while not stop.is_set():
+            now = datetime.utcnow()
+            rows = [
+                {
+                    'bus_id': random.randint(1, buses),
+                    'latitude': 43.6, 'longitude': 1.44,
+                    'speed': 30.0, 'heading': 0.0, 'accuracy': 5.0, 'timestamp': now
+                }
+                for _ in range(batch)
+            ]
+            try:
+                with writer.begin() as connection:
+                    connection.execute(insert(Position.__table__), rows)
+                written[0] += batch
+            except Exception:
+                errors['write'] += 1
+
+    threads = [threading.Thread(target=read_loop, args=(i,), daemon=True) for i in range(readers)]
+    if ingest:
+        threads.append(threading.Thread(target=write_loop, daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    merged = np.array([value for values in latencies for value in values]) * 1000
+    return {
+        'reads_per_second': len(merged) / seconds,
+        'p50_ms': float(np.percentile(merged, 50)) if len(merged) else 0.0,
+        'p99_ms': float(np.percentile(merged, 99)) if len(merged) else 0.0,
+        'rows_written_per_second': written[0] / seconds,
+        'read_errors': errors['read'],
+        'write_errors': errors['write']
+    }
+
+
+def engines(path: str, production: bool):
+    if not production:
+        engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+        return engine, engine
+
+    settings = (Config.SQLITE_BUSY_TIMEOUT_MS, Config.SQLITE_CACHE_SIZE_MB, Config.SQLITE_MMAP_SIZE_MB)
+    writer = create_engine(
+        f'sqlite:///{path}', pool_size=Config.SQLITE_WRITER_POOL_SIZE, max_overflow=0,
+        connect_args={'check_same_thread': False}
+    )
+    apply_pragmas(writer, sqlite_pragmas(*settings))
+    with writer.connect() as connection:
+        connection.exec_driver_sql('SELECT 1')
+    reader = create_reader_engine(path, Config.SQLITE_READER_POOL_SIZE, sqlite_pragmas(*settings, read_only=True))
+    return writer, reader
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lectures concurrentes SQLite pendant l\'ingestion')
+    parser.add_argument('--readers', type=int, default=4, help='Threads de lecture')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Durée de chaque mesure')
+    parser.add_argument('--batch', type=int, default=50, help='Positions par transaction d\'ingestion')
+    parser.add_argument('--buses', type=int, default=50, help='Nombre de bus')
+    parser.add_argument('--rows', type=int, default=200000, help='Positions initiales')
+    args = parser.parse_args()
+
+    print(f'{"configuration":<12} {"ingestion":<10} {"lectures/s":>11} {"p50 ms":>8} {"p99 ms":>8} '
+          f'{"écritures/s":>12} {"erreurs L/E":>12}')
+    for production in (False, True):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'benchmark.db')
+        writer, reader = engines(path, production)
+        seed(writer, args.buses, args.rows)
+        name = 'production' if production else 'défaut'
+        for ingest in (False, True):
+            result = run_phase(writer, reader, args.buses, args.readers, args.seconds, args.batch, ingest)
+            print(f'{name:<12} {"oui" if ingest else "non":<10} {result["reads_per_second"]:11.0f} '
+                  f'{result["p50_ms"]:8.2f} {result["p99_ms"]:8.2f} {result["rows_written_per_second"]:12.0f} '
+                  f'{result["read_errors"]:>5}/{result["write_errors"]:<5}')
+        writer.dispose()
+        reader.dispose()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        os.rmdir(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
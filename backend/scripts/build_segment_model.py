@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Met à jour les temps de parcours historiques entre arrêts (table
+segment_travel_times) à partir de l'historique des positions.
+
+Le traitement est incrémental : seules les positions enregistrées depuis la
+dernière exécution sont lues (par lots), l'état de chaque bus étant conservé
+dans la table segment_model_state. À lancer périodiquement (cron), par exemple
+toutes les heures.
+
+Usage:
+  python build_segment_model.py
+  python build_segment_model.py --batch-size 20000 --max-rows 1000000
+  python build_segment_model.py --reset      # repart de zéro (toute l'historique)
+"""
+import argparse
+import os
+import sys
+import time
+
+# Ensure parent (backend/) is on sys.path so imports work when running from scripts/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models import db, SegmentTravelTime, SegmentModelState
+from utils.segment_model import SegmentModelBuilder
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Agrège les temps de parcours entre arrêts')
+    parser.add_argument('--batch-size', type=int, default=50000, help='Positions lues par lot')
+    parser.add_argument('--max-rows', type=int, help='Nombre maximum de positions traitées par exécution')
+    parser.add_argument('--reset', action='store_true', help='Efface le modèle et retraite tout l\'historique')
+    args = parser.parse_args()
+
+    from app import create_app
+    app, _ = create_app()
+    with app.app_context():
+        db.create_all()
+
+        if args.reset:
+            SegmentTravelTime.query.delete()
+            SegmentModelState.query.delete()
+            db.session.commit()
+            print('Modèle effacé.')
+
+        started = time.time()
+        builder = SegmentModelBuilder(
+            batch_size=args.batch_size,
+            min_samples=app.config.get('SEGMENT_MODEL_MIN_SAMPLES', 5)
+        )
+        stats = builder.run(max_rows=args.max_rows)
+        print(f"{stats['positions']} positions, {stats['observations']} temps de parcours "
+              f"en {time.time() - started:.1f}s (dernière position {stats['last_position_id']})")
+
+
+if __name__ == '__main__':
+    main()
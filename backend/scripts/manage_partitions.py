@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Maintenance des positions par période (voir utils/position_partitions.py) :
+crée les partitions des prochaines périodes (MySQL) ou range les périodes
+terminées dans leur table (SQLite), puis affiche les partitions.
+
+La conversion d'une table positions MySQL existante recopie toute la table :
+à lancer une fois, hors des heures de service. La maintenance courante est
+faite à chaque passe de rétention (scripts/run_retention.py).
+
+Usage:
+  POSITION_PARTITIONING=true python manage_partitions.py
+  POSITION_PARTITIONING=true python manage_partitions.py --convert   # MySQL, une seule fois
+  POSITION_PARTITIONING=true python manage_partitions.py --list
+"""
+import argparse
+import json
+import os
+import sys
+
+# Ensure parent (backend/) is on sys.path so imports work when running from scripts/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+os.environ.setdefault('RETENTION_INTERVAL_SECONDS', '0')
+
+from models import db, PositionPartition
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Partitions des positions')
+    parser.add_argument('--convert', action='store_true', help='Partitionne la table positions (MySQL)')
+    parser.add_argument('--list', action='store_true', help='Affiche les partitions sans maintenance')
+    args = parser.parse_args()
+
+    from app import create_app
+    app, _ = create_app()
+    with app.app_context():
+        db.create_all()
+
+        partitions = app.position_partitions
+        if partitions.mode is None:
+            print('Partitionnement désactivé (POSITION_PARTITIONING=true) ou base non supportée')
+            return 1
+
+        if not args.list:
+            print(json.dumps(partitions.maintain(convert=args.convert), indent=2))
+
+        if partitions.mode == 'tables':
+            for record in PositionPartition.query.order_by(PositionPartition.period_start).all():
+                print(json.dumps(record.to_dict()))
+        else:
+            for name, start in partitions._mysql_partitions() or []:
+                print(f'{name}  {start:%Y-%m-%d}')
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
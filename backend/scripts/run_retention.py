@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Applique la rétention des positions et de l'occupation : sous-échantillonnage
+des positions anciennes, suppression des plus anciennes, agrégats d'occupation
+par minute et suppression de l'occupation brute (voir utils/retention.py).
+
+Les suppressions se font par petits lots ; le traitement reprend là où la
+dernière exécution s'est arrêtée (table retention_state). À lancer par cron
+si RETENTION_INTERVAL_SECONDS=0 (plusieurs processus serveur, par exemple).
+
+Usage:
+  python run_retention.py
+  python run_retention.py --max-seconds 300       # limite la durée d'une passe
+  python run_retention.py --method douglas_peucker --chunk-size 500
+"""
+import argparse
+import json
+import os
+import sys
+
+# Ensure parent (backend/) is on sys.path so imports work when running from scripts/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+os.environ.setdefault('RETENTION_INTERVAL_SECONDS', '0')
+
+from models import db
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rétention des positions et de l\'occupation')
+    parser.add_argument('--max-seconds', type=float, help='Durée maximale de la passe')
+    parser.add_argument('--method', choices=['interval', 'douglas_peucker'], help='Méthode de sous-échantillonnage')
+    parser.add_argument('--chunk-size', type=int, help='Lignes supprimées par transaction')
+    args = parser.parse_args()
+
+    from app import create_app
+    app, _ = create_app()
+    with app.app_context():
+        db.create_all()
+
+        retention = app.retention
+        if args.method:
+            retention.method = args.method
+        if args.chunk_size:
+            retention.chunk_size = args.chunk_size
+
+        metrics = retention.run(max_seconds=args.max_seconds)
+        print(json.dumps(metrics, indent=2))
+        return 0 if 'error' not in metrics else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
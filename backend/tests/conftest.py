@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from app import create_app, init_database
+from models import db
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    STOP_EVENT_FLUSH_SECONDS = 0  # écriture des événements appelée par les tests
+    RETENTION_INTERVAL_SECONDS = 0
+
+
+@pytest.fixture(scope='session')
+def app():
+    """Application avec une base SQLite temporaire et les données de test"""
+    app, _ = create_app(TestConfig)
+    init_database(app)
+    return app
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield app
+        db.session.rollback()
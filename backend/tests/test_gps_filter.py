@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from utils.gps_filter import GpsFilterBank, GpsKalmanFilter, METERS_PER_DEGREE, RESET_AFTER_SECONDS
+
+START = datetime(2024, 1, 1, 8, 0, 0)
+LATITUDE = 43.6
+LONGITUDE = 1.44
+
+
+def _row(seconds, north_m=0.0, accuracy=5.0, bus_id=1):
+    return {
+        'bus_id': bus_id,
+        'latitude': LATITUDE + north_m / METERS_PER_DEGREE,
+        'longitude': LONGITUDE,
+        'timestamp': START + timedelta(seconds=seconds),
+        'accuracy': accuracy
+    }
+
+
+def _drive(bank, count, speed_ms=10.0, step=5):
+    """Bus roulant vers le nord à vitesse constante"""
+    for i in range(count):
+        bank.update(_row(i * step, north_m=i * step * speed_ms))
+
+
+def test_constant_speed_is_tracked():
+    bank = GpsFilterBank()
+    _drive(bank, 20)
+
+    estimate = bank.get(1)
+    assert abs(estimate['speed'] - 36.0) < 2.0
+    assert estimate['heading'] < 5 or estimate['heading'] > 355
+    assert estimate['updates'] == 20
+    assert estimate['position_std_m'] < 5.0
+
+
+def test_outlier_is_rejected():
+    bank = GpsFilterBank()
+    _drive(bank, 20)
+    before = bank.get(1)
+
+    # Position attendue vers 1000 m : saut de 2 km en 5 secondes
+    estimate = bank.update(_row(100, north_m=3000))
+    assert bank.get_stats()['rejected_outliers'] == 1
+    assert abs((estimate['latitude'] - before['latitude']) * METERS_PER_DEGREE) < 100
+
+
+def test_repeated_outliers_reset_the_track():
+    filter_ = GpsKalmanFilter(LATITUDE, LONGITUDE, START, 5.0)
+    far = LATITUDE + 5000 / METERS_PER_DEGREE
+    results = [
+        filter_.update(far, LONGITUDE, START + timedelta(seconds=5 * (i + 1)), 5.0)
+        for i in range(4)
+    ]
+    # Rejetées jusqu'à MAX_REJECTED, puis acceptées (le bus a vraiment bougé)
+    assert results == [False, False, False, True]
+
+
+def test_stale_fix_is_ignored():
+    bank = GpsFilterBank()
+    _drive(bank, 10)
+    before = bank.get(1)
+
+    estimate = bank.update(_row(10, north_m=0.0))
+    assert estimate == before
+    assert bank.get_stats()['stale'] == 1
+
+    filter_ = GpsKalmanFilter(LATITUDE, LONGITUDE, START, 5.0)
+    assert filter_.update(LATITUDE, LONGITUDE, START, 5.0) is False
+    assert filter_.updates == 1
+
+
+def test_update_many_sorts_and_skips_stale():
+    bank = GpsFilterBank()
+    bank.update(_row(50, north_m=500))
+    rows = [_row(seconds, north_m=seconds * 10.0) for seconds in (70, 60, 40, 55)]
+    bank.update_many(rows)
+
+    stats = bank.get_stats()
+    assert stats['stale'] == 1
+    assert bank.get(1)['timestamp'] == START + timedelta(seconds=70)
+
+
+def test_long_gap_resets_filter():
+    bank = GpsFilterBank()
+    _drive(bank, 5)
+    estimate = bank.update(_row(20 + RESET_AFTER_SECONDS + 1, north_m=10000))
+
+    assert bank.get_stats()['resets'] == 1
+    assert estimate['updates'] == 1
+    assert abs((estimate['latitude'] - LATITUDE) * METERS_PER_DEGREE - 10000) < 1.0
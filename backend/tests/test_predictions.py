@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, Bus, Prediction
+from utils.predictions import PredictionEngine
+
+
+@pytest.fixture
+def bus(app_context):
+    bus = Bus(number='T-PRED', license_plate='TEST-PRED', capacity=50)
+    db.session.add(bus)
+    db.session.commit()
+    yield bus
+    Prediction.query.filter_by(bus_id=bus.id).delete()
+    db.session.delete(bus)
+    db.session.commit()
+
+
+def _prediction(bus_id, stop_id, arrival_time, confidence=0.8):
+    return {'bus_id': bus_id, 'stop_id': stop_id, 'arrival_time': arrival_time, 'confidence': confidence}
+
+
+def _stored(bus_id):
+    return {
+        prediction.stop_id: prediction
+        for prediction in Prediction.query.filter_by(bus_id=bus_id).all()
+    }
+
+
+def test_apply_predictions_diff(bus):
+    now = datetime.utcnow().replace(microsecond=0)
+    old = now - timedelta(minutes=5)
+    arrival = now + timedelta(minutes=10)
+    for stop_id in (1, 2, 3):
+        db.session.add(Prediction(bus_id=bus.id, stop_id=stop_id, arrival_time=arrival,
+                                  confidence=0.8, created_at=old))
+    db.session.commit()
+
+    results = {bus.id: {
+        'predictions': [
+            _prediction(bus.id, 1, arrival + timedelta(seconds=5)),  # sous PREDICTION_WRITE_MIN_DELTA
+            _prediction(bus.id, 2, arrival + timedelta(minutes=2)),
+            _prediction(bus.id, 4, arrival + timedelta(minutes=4))
+        ],
+        'route_stop_ids': [1, 2, 4]
+    }}
+    counts = PredictionEngine._apply_predictions(results, [bus.id])
+    db.session.commit()
+
+    assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 1, 'deleted': 1}
+    stored = _stored(bus.id)
+    assert set(stored) == {1, 2, 4}
+    # ETA inchangée : non réécrite, mais created_at rafraîchi
+    assert stored[1].arrival_time == arrival
+    assert stored[1].created_at > old
+    assert stored[2].arrival_time == arrival + timedelta(minutes=2)
+    assert stored[4].arrival_time == arrival + timedelta(minutes=4)
+
+
+def test_apply_predictions_confidence_change_rewrites(bus):
+    arrival = datetime.utcnow().replace(microsecond=0) + timedelta(minutes=10)
+    db.session.add(Prediction(bus_id=bus.id, stop_id=1, arrival_time=arrival, confidence=0.8))
+    db.session.commit()
+
+    results = {bus.id: {'predictions': [_prediction(bus.id, 1, arrival, 0.5)], 'route_stop_ids': [1]}}
+    counts = PredictionEngine._apply_predictions(results, [bus.id])
+    db.session.commit()
+
+    assert counts['updated'] == 1
+    assert _stored(bus.id)[1].confidence == 0.5
+
+
+def test_apply_predictions_removes_duplicates(bus):
+    arrival = datetime.utcnow().replace(microsecond=0) + timedelta(minutes=10)
+    for _ in range(2):
+        db.session.add(Prediction(bus_id=bus.id, stop_id=1, arrival_time=arrival, confidence=0.8))
+    db.session.commit()
+
+    results = {bus.id: {'predictions': [_prediction(bus.id, 1, arrival)], 'route_stop_ids': [1]}}
+    counts = PredictionEngine._apply_predictions(results, [bus.id])
+    db.session.commit()
+
+    assert counts == {'inserted': 0, 'updated': 0, 'unchanged': 1, 'deleted': 1}
+    assert Prediction.query.filter_by(bus_id=bus.id).count() == 1
+
+
+def test_apply_predictions_leaves_other_buses(bus):
+    arrival = datetime.utcnow().replace(microsecond=0) + timedelta(minutes=10)
+    db.session.add(Prediction(bus_id=bus.id, stop_id=1, arrival_time=arrival, confidence=0.8))
+    db.session.commit()
+
+    # Cycle incrémental sur un autre bus : la prédiction de ce bus n'est pas obsolète
+    counts = PredictionEngine._apply_predictions({}, [bus.id + 1000])
+    db.session.commit()
+
+    assert counts['deleted'] == 0
+    assert 1 in _stored(bus.id)
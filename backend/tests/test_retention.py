@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from models import db, Bus, Position, Occupancy, OccupancyRollup, RetentionState
+from utils.gps_filter import METERS_PER_DEGREE
+from utils.retention import interval_keep, douglas_peucker_keep
+
+
+@pytest.fixture
+def buses(app_context):
+    buses = [Bus(number=f'T-RET{i}', license_plate=f'TEST-RET{i}', capacity=50) for i in range(2)]
+    db.session.add_all(buses)
+    RetentionState.query.delete()
+    db.session.commit()
+    bus_ids = [bus.id for bus in buses]
+    yield bus_ids
+    for model in (Position, Occupancy, OccupancyRollup):
+        model.query.filter(model.bus_id.in_(bus_ids)).delete(synchronize_session=False)
+    Bus.query.filter(Bus.id.in_(bus_ids)).delete(synchronize_session=False)
+    RetentionState.query.delete()
+    db.session.commit()
+
+
+@pytest.fixture
+def retention(app_context, monkeypatch):
+    monkeypatch.setattr(app_context.retention, 'chunk_pause', 0)
+    return app_context.retention
+
+
+def test_interval_keep_first_fix_per_bus_and_interval():
+    bus_ids = np.array([1, 1, 1, 1, 2, 2])
+    seconds = np.array([0.0, 30.0, 61.0, 119.0, 30.0, 45.0])
+
+    keep = interval_keep(bus_ids, seconds, 60)
+    assert keep.tolist() == [True, False, True, False, True, False]
+
+
+def test_douglas_peucker_keeps_shape():
+    # Ligne droite vers le nord avec un écart de 50 m au milieu
+    north = np.arange(11) * 100.0
+    east = np.zeros(11)
+    east[5] = 50.0
+    latitudes = 43.5 + north / METERS_PER_DEGREE
+    longitudes = 1.5 + east / (METERS_PER_DEGREE * np.cos(np.radians(43.5)))
+
+    keep = douglas_peucker_keep(latitudes, longitudes, 15.0)
+    assert np.flatnonzero(keep).tolist() == [0, 4, 5, 6, 10]
+    assert douglas_peucker_keep(latitudes, longitudes, 100.0).sum() == 2
+
+
+def test_downsample_keeps_one_position_per_interval(buses, retention):
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    old_start = now - timedelta(days=retention.raw_days + 3)
+    recent_start = now - timedelta(hours=1)
+    rows = [
+        {'bus_id': bus_id, 'latitude': 43.5, 'longitude': 1.5, 'timestamp': start + timedelta(seconds=10 * i)}
+        for bus_id in buses for start in (old_start, recent_start) for i in range(18)
+    ]
+    db.session.execute(db.insert(Position), rows)
+    db.session.commit()
+
+    metrics = retention.run(now)
+    assert metrics['completed'] is True
+    for bus_id in buses:
+        old = Position.query.filter(Position.bus_id == bus_id, Position.timestamp < recent_start)\
+            .order_by(Position.timestamp).all()
+        recent = Position.query.filter(Position.bus_id == bus_id, Position.timestamp >= recent_start).count()
+        # 18 positions sur 3 minutes : la première de chaque minute
+        assert [position.timestamp for position in old] == [old_start + timedelta(minutes=m) for m in range(3)]
+        assert recent == 18
+
+
+def test_delete_occupancy_keeps_latest_records_per_bus(buses, retention, monkeypatch):
+    monkeypatch.setattr(retention, 'occupancy_keep', 3)
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    old_start = now - timedelta(days=retention.occupancy_days + 3)
+    counts = {buses[0]: 5, buses[1]: 2}
+    db.session.execute(db.insert(Occupancy), [
+        {'bus_id': bus_id, 'passenger_count': i, 'capacity_percentage': 2 * i,
+         'timestamp': old_start + timedelta(minutes=i)}
+        for bus_id, count in counts.items() for i in range(count)
+    ])
+    db.session.commit()
+
+    retention.run(now)
+    kept = [
+        occupancy.passenger_count for occupancy in
+        Occupancy.query.filter_by(bus_id=buses[0]).order_by(Occupancy.timestamp).all()
+    ]
+    assert kept == [2, 3, 4]
+    assert Occupancy.query.filter_by(bus_id=buses[1]).count() == 2
+    # Enregistrements supprimés conservés dans les agrégats par minute
+    assert OccupancyRollup.query.filter_by(bus_id=buses[0]).count() == 5
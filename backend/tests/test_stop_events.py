@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, Bus, Route, Stop, RouteStop, StopEvent
+from utils.gps_filter import METERS_PER_DEGREE
+from utils.stop_events import StopEventDetector
+
+START = datetime(2024, 1, 1, 8, 0, 0)
+LATITUDE = 43.5  # Loin des arrêts de test
+LONGITUDE = 1.5
+STOP_OFFSETS_M = (0.0, 500.0, 1000.0)  # Arrêts alignés vers le nord
+
+
+@pytest.fixture(scope='module')
+def line(app):
+    """Ligne droite de trois arrêts et un bus, supprimés après les tests"""
+    with app.app_context():
+        route = Route(number='T-STOP', name='Ligne de test')
+        bus = Bus(number='T-STOP', license_plate='TEST-STOP', capacity=50)
+        stops = [
+            Stop(name=f'Arrêt {i}', latitude=LATITUDE + offset / METERS_PER_DEGREE, longitude=LONGITUDE)
+            for i, offset in enumerate(STOP_OFFSETS_M)
+        ]
+        db.session.add_all([route, bus] + stops)
+        db.session.commit()
+        db.session.add_all([
+            RouteStop(route_id=route.id, stop_id=stop.id, sequence=i + 1) for i, stop in enumerate(stops)
+        ])
+        db.session.commit()
+        ids = (route.id, bus.id, [stop.id for stop in stops])
+
+    yield ids
+
+    with app.app_context():
+        route_id, bus_id, stop_ids = ids
+        StopEvent.query.filter_by(bus_id=bus_id).delete()
+        RouteStop.query.filter_by(route_id=route_id).delete()
+        Stop.query.filter(Stop.id.in_(stop_ids)).delete(synchronize_session=False)
+        Bus.query.filter_by(id=bus_id).delete()
+        Route.query.filter_by(id=route_id).delete()
+        db.session.commit()
+        app.route_geometry.invalidate(route_id)
+
+
+@pytest.fixture
+def detector(app_context):
+    return StopEventDetector()
+
+
+def _row(bus_id, seconds, north_m):
+    return {
+        'bus_id': bus_id,
+        'latitude': LATITUDE + north_m / METERS_PER_DEGREE,
+        'longitude': LONGITUDE,
+        'timestamp': START + timedelta(seconds=seconds)
+    }
+
+
+def test_arrival_dwell_and_departure(line, detector):
+    route_id, bus_id, stop_ids = line
+
+    assert detector.update(_row(bus_id, 0, -300), route_id) == []
+    assert detector.update(_row(bus_id, 30, 0), route_id) == []
+    assert detector.current(bus_id)['stop_id'] == stop_ids[0]
+    assert detector.update(_row(bus_id, 60, 5), route_id) == []
+
+    events = detector.update(_row(bus_id, 70, 100), route_id)
+    assert len(events) == 1
+    event = events[0]
+    assert event['stop_id'] == stop_ids[0]
+    assert event['stopped'] is True
+    assert event['arrival_time'] == START + timedelta(seconds=30)
+    assert event['departure_time'] == START + timedelta(seconds=60)
+    assert event['dwell_seconds'] == 30.0
+    assert detector.current(bus_id) is None
+
+
+def test_stop_passed_between_fixes(line, detector):
+    route_id, bus_id, stop_ids = line
+
+    detector.update(_row(bus_id, 0, 100), route_id)
+    events = detector.update(_row(bus_id, 50, 600), route_id)
+
+    assert len(events) == 1
+    event = events[0]
+    assert event['stop_id'] == stop_ids[1]
+    assert event['stopped'] is False
+    assert event['dwell_seconds'] == 0.0
+    # Heure interpolée au point le plus proche de l'arrêt (400 m sur 500 m)
+    assert event['arrival_time'] == START + timedelta(seconds=40)
+
+
+def test_stale_fix_is_ignored(line, detector):
+    route_id, bus_id, stop_ids = line
+
+    detector.update(_row(bus_id, 0, 100), route_id)
+    detector.update(_row(bus_id, 50, 450), route_id)
+
+    # Position antérieure à l'état, au-delà de l'arrêt : aucun passage enregistré
+    assert detector.update(_row(bus_id, 40, 600), route_id) == []
+    assert detector.get_stats()['stale'] == 1
+
+    events = detector.update(_row(bus_id, 60, 700), route_id)
+    assert [event['stop_id'] for event in events] == [stop_ids[1]]
+
+
+def test_update_many_orders_fixes_and_flush_writes(line, detector):
+    route_id, bus_id, stop_ids = line
+
+    rows = [_row(bus_id, seconds, north_m) for seconds, north_m in ((100, 1100), (0, -300), (50, 450))]
+    events = detector.update_many(rows, {bus_id: route_id})
+
+    assert [event['stop_id'] for event in events] == stop_ids
+    assert detector.flush() == 3
+    assert StopEvent.query.filter_by(bus_id=bus_id).count() == 3
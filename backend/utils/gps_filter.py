@@ -0,0 +1,195 @@
+import math
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+METERS_PER_DEGREE = 111190.0
+
+DEFAULT_ACCURACY_M = 10.0  # Écart-type d'une position sans précision fournie
+ACCELERATION_NOISE = 0.5  # Densité spectrale de l'accélération (m²/s³)
+INITIAL_SPEED_STD = 10.0  # Incertitude initiale sur la vitesse (m/s)
+RESET_AFTER_SECONDS = 300  # Au-delà, le bus est considéré comme réinitialisé
+GATE = 25.0  # Seuil de distance de Mahalanobis² (2 degrés de liberté, ~5 sigma)
+MAX_REJECTED = 3  # Positions aberrantes consécutives avant réinitialisation
+RECENTER_M = 5000.0  # Recentrage du repère local au-delà de cette distance
+
+
+class GpsKalmanFilter:
+    """
+    Filtre de Kalman à vitesse constante pour un bus.
+
+    État [est, nord, v_est, v_nord] en mètres et m/s dans un plan local centré
+    sur une position de référence ; O(1) en mémoire et en calcul par position.
+    """
+
+    __slots__ = ('ref_lat', 'ref_lon', 'x', 'P', 'timestamp', 'rejected', 'updates')
+
+    def __init__(self, latitude: float, longitude: float, timestamp: datetime, accuracy: float):
+        self.ref_lat = latitude
+        self.ref_lon = longitude
+        self.x = np.zeros(4)
+        self.P = np.diag([accuracy ** 2, accuracy ** 2, INITIAL_SPEED_STD ** 2, INITIAL_SPEED_STD ** 2])
+        self.timestamp = timestamp
+        self.rejected = 0
+        self.updates = 1
+
+    def _to_local(self, latitude: float, longitude: float) -> np.ndarray:
+        return np.array([
+            (longitude - self.ref_lon) * METERS_PER_DEGREE * math.cos(math.radians(self.ref_lat)),
+            (latitude - self.ref_lat) * METERS_PER_DEGREE
+        ])
+
+    def _to_geo(self, east: float, north: float):
+        return (
+            self.ref_lat + north / METERS_PER_DEGREE,
+            self.ref_lon + east / (METERS_PER_DEGREE * math.cos(math.radians(self.ref_lat)))
+        )
+
+    def _predict(self, dt: float):
+        if dt <= 0:
+            return
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        q = ACCELERATION_NOISE
+        Q = np.zeros((4, 4))
+        Q[0, 0] = Q[1, 1] = q * dt ** 3 / 3
+        Q[0, 2] = Q[2, 0] = Q[1, 3] = Q[3, 1] = q * dt ** 2 / 2
+        Q[2, 2] = Q[3, 3] = q * dt
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+
+    def update(self, latitude: float, longitude: float, timestamp: datetime, accuracy: float) -> bool:
+        """
+        Intègre une position ; retourne False si elle est rejetée comme aberrante
+        ou plus ancienne que l'état (rattrapage d'anciennes positions : ignorée)
+        """
+        if timestamp <= self.timestamp:
+            return False
+        self._predict((timestamp - self.timestamp).total_seconds())
+
+        z = self._to_local(latitude, longitude)
+        innovation = z - self.x[:2]
+        S = self.P[:2, :2] + np.eye(2) * accuracy ** 2
+        S_inv = np.linalg.inv(S)
+
+        if innovation @ S_inv @ innovation > GATE and self.rejected < MAX_REJECTED:
+            self.rejected += 1
+            self.timestamp = timestamp
+            return False
+
+        K = self.P[:, :2] @ S_inv
+        self.x = self.x + K @ innovation
+        self.P = self.P - K @ self.P[:2, :]
+        self.P = (self.P + self.P.T) / 2
+        self.timestamp = timestamp
+        self.rejected = 0
+        self.updates += 1
+
+        # Recentrage pour garder l'approximation plane précise
+        if math.hypot(self.x[0], self.x[1]) > RECENTER_M:
+            self.ref_lat, self.ref_lon = self._to_geo(self.x[0], self.x[1])
+            self.x[0] = self.x[1] = 0.0
+        return True
+
+    def estimate(self) -> Dict:
+        latitude, longitude = self._to_geo(self.x[0], self.x[1])
+        east_speed, north_speed = self.x[2], self.x[3]
+        speed = math.hypot(east_speed, north_speed)
+
+        # Incertitude sur la vitesse projetée dans la direction du déplacement
+        if speed > 0:
+            direction = np.array([east_speed, north_speed]) / speed
+            speed_variance = float(direction @ self.P[2:, 2:] @ direction)
+        else:
+            speed_variance = float(np.trace(self.P[2:, 2:]) / 2)
+
+        return {
+            'latitude': latitude,
+            'longitude': longitude,
+            'speed': speed * 3.6,  # km/h
+            'heading': math.degrees(math.atan2(east_speed, north_speed)) % 360,
+            'position_std_m': math.sqrt(max(np.trace(self.P[:2, :2]) / 2, 0.0)),
+            'speed_std_kmh': math.sqrt(max(speed_variance, 0.0)) * 3.6,
+            'timestamp': self.timestamp,
+            'updates': self.updates
+        }
+
+
+class GpsFilterBank:
+    """
+    Un filtre de Kalman par bus, mis à jour à chaque position acceptée par
+    l'ingestion (POST /api/positions et /api/positions/bulk). Fournit une
+    position, une vitesse et un cap lissés avec leur incertitude, lus par les
+    prédictions sans requête sur l'historique.
+    """
+
+    def __init__(self, app=None):
+        self._filters: Dict[int, GpsKalmanFilter] = {}
+        self._lock = threading.Lock()
+
+        # Compteurs
+        self.updates = 0
+        self.rejected = 0
+        self.stale = 0
+        self.resets = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.gps_filter = self
+
+    def update(self, row: dict) -> Optional[Dict]:
+        """
+        Intègre une position (colonnes de Position) et retourne l'estimation du bus
+        """
+        accuracy = row.get('accuracy') or DEFAULT_ACCURACY_M
+        timestamp = row['timestamp']
+        with self._lock:
+            self.updates += 1
+            current = self._filters.get(row['bus_id'])
+            if current is None or (timestamp - current.timestamp).total_seconds() > RESET_AFTER_SECONDS:
+                if current is not None:
+                    self.resets += 1
+                current = GpsKalmanFilter(row['latitude'], row['longitude'], timestamp, accuracy)
+                self._filters[row['bus_id']] = current
+            elif timestamp <= current.timestamp:
+                # Position antérieure à l'état : ne ramène pas le bus en arrière
+                self.stale += 1
+            elif not current.update(row['latitude'], row['longitude'], timestamp, accuracy):
+                self.rejected += 1
+            return current.estimate()
+
+    def update_many(self, rows: Iterable[dict]):
+        """
+        Intègre des positions dans l'ordre chronologique de chaque bus (celles
+        antérieures à l'état du bus sont ignorées)
+        """
+        for row in sorted(rows, key=lambda r: r['timestamp']):
+            with self._lock:
+                current = self._filters.get(row['bus_id'])
+                if current is not None and row['timestamp'] <= current.timestamp:
+                    self.stale += 1
+                    continue
+            self.update(row)
+
+    def get(self, bus_id: int) -> Optional[Dict]:
+        with self._lock:
+            current = self._filters.get(bus_id)
+            return current.estimate() if current is not None else None
+
+    def forget(self, bus_id: int):
+        with self._lock:
+            self._filters.pop(bus_id, None)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'buses': len(self._filters),
+                'updates': self.updates,
+                'rejected_outliers': self.rejected,
+                'stale': self.stale,
+                'resets': self.resets
+            }
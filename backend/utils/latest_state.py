@@ -0,0 +1,129 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+from models import Position, Occupancy
+
+
+class LatestStateStore:
+    """
+    État courant de chaque bus, en mémoire pour le processus.
+
+    Contient la dernière position, la dernière occupation et la progression
+    sur la ligne : projection de chaque position reçue sur le tracé, reprise
+    par les prédictions et la détection des arrêts (la vitesse est estimée
+    par le SpeedEstimator). Alimenté par l'ingestion
+    (positions, occupation) et hydraté depuis la base au premier accès.
+    """
+
+    def __init__(self, app=None):
+        self._positions: Dict[int, dict] = {}
+        self._occupancy: Dict[int, dict] = {}
+        self._progress: Dict[int, Tuple[int, float, float]] = {}
+        self._projections: Dict[int, dict] = {}
+        self._lock = threading.RLock()
+        self.hydrated = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.latest_state = self
+
+    def hydrate(self):
+        """
+        Charge la dernière position et la dernière occupation de chaque bus
+        (une requête par table)
+        """
+        with self._lock:
+            positions = Position.latest_by_bus().values()
+            occupancy_records = Occupancy.latest_by_bus().values()
+
+            for position in positions:
+                self._set_if_newer(self._positions, _row(position, Position))
+            for occupancy in occupancy_records:
+                self._set_if_newer(self._occupancy, _row(occupancy, Occupancy))
+
+            self.hydrated = True
+
+    def _ensure_hydrated(self):
+        if not self.hydrated:
+            self.hydrate()
+
+    @staticmethod
+    def _set_if_newer(states: Dict[int, dict], row: dict) -> bool:
+        current = states.get(row['bus_id'])
+        if current is not None and current['timestamp'] and row['timestamp'] and \
+                row['timestamp'] < current['timestamp']:
+            return False
+        states[row['bus_id']] = row
+        return True
+
+    # Mises à jour (ingestion)
+
+    def update_position(self, row: dict):
+        """
+        Enregistre une nouvelle position (colonnes de Position)
+        """
+        with self._lock:
+            self._ensure_hydrated()
+            self._set_if_newer(self._positions, dict(row))
+
+    def update_occupancy(self, row: dict):
+        with self._lock:
+            self._ensure_hydrated()
+            self._set_if_newer(self._occupancy, dict(row))
+
+    def set_route_progress(self, bus_id: int, next_stop_index: int, progress: float,
+                           distance_along_m: float = 0.0):
+        with self._lock:
+            self._progress[bus_id] = (next_stop_index, progress, distance_along_m)
+
+    def set_projection(self, bus_id: int, projection: dict):
+        """
+        Projection de la dernière position sur le tracé (RouteGeometryCache.track)
+        """
+        with self._lock:
+            self._projections[bus_id] = projection
+            self._progress[bus_id] = (projection['next_stop_index'], projection['progress'], projection['along'])
+
+    def forget(self, bus_id: int):
+        with self._lock:
+            for states in (self._positions, self._occupancy, self._progress, self._projections):
+                states.pop(bus_id, None)
+
+    # Lectures
+
+    def get_position(self, bus_id: int) -> Optional[dict]:
+        with self._lock:
+            self._ensure_hydrated()
+            return self._positions.get(bus_id)
+
+    def get_occupancy(self, bus_id: int) -> Optional[dict]:
+        with self._lock:
+            self._ensure_hydrated()
+            return self._occupancy.get(bus_id)
+
+    def get_route_progress(self, bus_id: int) -> Optional[Tuple[int, float, float]]:
+        """
+        (index du prochain arrêt, pourcentage parcouru, mètres depuis le début de la ligne)
+        """
+        with self._lock:
+            return self._progress.get(bus_id)
+
+    def get_projection(self, bus_id: int) -> Optional[dict]:
+        with self._lock:
+            return self._projections.get(bus_id)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'hydrated': self.hydrated,
+                'positions': len(self._positions),
+                'occupancy': len(self._occupancy),
+                'route_progress': len(self._progress)
+            }
+
+
+def _row(record, model) -> dict:
+    """Colonnes d'un enregistrement ORM sous forme de dict"""
+    return {column.name: getattr(record, column.name) for column in model.__table__.columns}
@@ -0,0 +1,217 @@
+import atexit
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from flask import current_app
+
+from models import db, Bus, Occupancy
+
+
+class BusCounter:
+    """
+    Nombre de passagers d'un bus et changements pas encore écrits
+    """
+
+    __slots__ = ('count', 'capacity', 'timestamp', 'dirty', 'taps')
+
+    def __init__(self, count: int, capacity: int, timestamp: Optional[datetime]):
+        self.count = count
+        self.capacity = capacity
+        self.timestamp = timestamp
+        self.dirty = False
+        self.taps = 0  # Montées / descentes depuis la dernière écriture
+
+    def row(self, bus_id: int) -> dict:
+        percentage = self.count / self.capacity * 100 if self.capacity > 0 else 0
+        return {
+            'bus_id': bus_id,
+            'passenger_count': self.count,
+            'capacity_percentage': min(100, percentage),
+            'timestamp': self.timestamp
+        }
+
+
+class OccupancyCounters:
+    """
+    Compteurs de passagers par bus en mémoire (/api/occupancy/increment et
+    /decrement).
+
+    Chaque montée ou descente modifie le compteur du bus sous verrou (pas de
+    lecture-écriture concurrente en base, aucune perte de comptage), borné
+    entre 0 et Bus.capacity ; l'état courant en mémoire est mis à jour tout de
+    suite. Les compteurs modifiés sont écrits toutes les
+    OCCUPANCY_FLUSH_SECONDS : une ligne Occupancy par bus et par intervalle,
+    en un seul INSERT multi-lignes.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.flush_interval = 5.0
+        self._counters: Dict[int, BusCounter] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Compteurs
+        self.taps = 0
+        self.clamped = 0
+        self.flushes = 0
+        self.written = 0
+        self.flush_errors = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = float(app.config.get('OCCUPANCY_FLUSH_SECONDS', 5))
+        app.occupancy_counters = self
+
+        if self.flush_interval > 0:
+            self.start()
+            atexit.register(self.stop)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='occupancy-counters', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Arrête le thread et écrit les derniers compteurs
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        with self.app.app_context():
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                print(f"Erreur écriture occupation: {e}")
+
+    # Compteurs
+
+    @staticmethod
+    def _latest(bus_id: int) -> Optional[dict]:
+        store = getattr(current_app, 'latest_state', None)
+        if store is not None:
+            return store.get_occupancy(bus_id)
+        record = Occupancy.latest_by_bus([bus_id]).get(bus_id)
+        return {'passenger_count': record.passenger_count, 'timestamp': record.timestamp} if record else None
+
+    def adjust(self, bus_id: int, delta: int, capacity: int) -> dict:
+        """
+        Ajoute delta passagers (négatif pour une descente) au compteur du bus ;
+        retourne l'occupation résultante (colonnes de Occupancy)
+        """
+        with self._lock:
+            counter = self._counters.get(bus_id)
+        if counter is None:
+            # Première montée depuis le démarrage : repart de la dernière occupation connue
+            latest = self._latest(bus_id)
+            seeded = BusCounter(
+                (latest or {}).get('passenger_count') or 0, capacity, (latest or {}).get('timestamp')
+            )
+            with self._lock:
+                counter = self._counters.setdefault(bus_id, seeded)
+
+        with self._lock:
+            counter.capacity = capacity
+            wanted = counter.count + delta
+            counter.count = min(max(wanted, 0), max(capacity, 0))
+            if counter.count != wanted:
+                self.clamped += 1
+            counter.timestamp = datetime.utcnow()
+            counter.dirty = True
+            counter.taps += 1
+            self.taps += 1
+            row = counter.row(bus_id)
+
+        self._publish(row)
+        return row
+
+    def observe(self, bus_id: int, passenger_count: int, capacity: int, timestamp: datetime):
+        """
+        Occupation déjà écrite en base (mise à jour explicite, remise à zéro) :
+        le compteur repart de cette valeur
+        """
+        with self._lock:
+            counter = BusCounter(passenger_count, capacity, timestamp)
+            self._counters[bus_id] = counter
+
+    def _publish(self, row: dict):
+        """
+        État courant en mémoire et montées du trajet en cours
+        """
+        store = getattr(current_app, 'latest_state', None)
+        if store is not None:
+            store.update_occupancy(dict(row, id=None))
+        trips = getattr(current_app, 'trip_history', None)
+        if trips is not None:
+            trips.update_occupancy(row['bus_id'], row['passenger_count'])
+
+    def forget(self, bus_id: int):
+        with self._lock:
+            self._counters.pop(bus_id, None)
+
+    # Écriture
+
+    def flush(self) -> int:
+        """
+        Écrit une ligne par bus modifié depuis la dernière écriture
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty = {bus_id: counter for bus_id, counter in self._counters.items() if counter.dirty}
+                rows = {bus_id: counter.row(bus_id) for bus_id, counter in dirty.items()}
+                taps = {bus_id: counter.taps for bus_id, counter in dirty.items()}
+                for counter in dirty.values():
+                    counter.dirty = False
+                    counter.taps = 0
+            if not rows:
+                return 0
+
+            try:
+                # Bus supprimés entre-temps : rien à écrire
+                valid = {bus_id for (bus_id,) in db.session.query(Bus.id).filter(Bus.id.in_(list(rows))).all()}
+                inserts = [row for bus_id, row in rows.items() if bus_id in valid]
+                if inserts:
+                    db.session.execute(db.insert(Occupancy), inserts)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Erreur écriture occupation: {e}")
+                with self._lock:
+                    self.flush_errors += 1
+                    for bus_id in rows:
+                        counter = self._counters.get(bus_id)
+                        if counter is not None:
+                            counter.dirty = True
+                            counter.taps += taps[bus_id]
+                return 0
+
+            with self._lock:
+                self.flushes += 1
+                self.written += len(inserts)
+            return len(inserts)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'buses': len(self._counters),
+                'pending': sum(1 for counter in self._counters.values() if counter.dirty),
+                'taps': self.taps,
+                'clamped': self.clamped,
+                'flushes': self.flushes,
+                'written': self.written,
+                'flush_errors': self.flush_errors
+            }
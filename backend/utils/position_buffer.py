@@ -0,0 +1,255 @@
+import atexit
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+
+from models import db, Position
+
+
+class PositionBuffer:
+    """
+    Tampon d'écriture différée (write-behind) des positions GPS.
+
+    Les positions validées sont placées en mémoire puis écrites par un thread
+    dédié par INSERT multi-lignes + commit (group commit) d'au plus
+    POSITION_FLUSH_MAX_ROWS lignes, toutes les POSITION_FLUSH_INTERVAL_MS ou
+    dès qu'un lot complet est en attente. La dernière position de chaque bus
+    reste lisible depuis le LatestStateStore tant qu'elle n'est pas en base.
+
+    Un lot en échec reste en tête du tampon et l'écriture suivante attend de
+    plus en plus longtemps (jusqu'à POSITION_FLUSH_MAX_BACKOFF_SECONDS). Après
+    POSITION_FLUSH_MAX_RETRIES échecs, si la base répond, le lot est coupé en
+    deux jusqu'à isoler les lignes refusées, qui sont écartées.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.interval = 0.2
+        self.max_rows = 500
+        self.capacity = 10000
+        self.put_timeout = 0.5
+        self.max_retries = 5
+        self.max_backoff = 30.0
+        self._failures = 0  # Échecs consécutifs du lot en tête
+        self._retry_at = 0.0
+
+        self._rows = deque()  # (date de mise en tampon, ligne)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        # Compteurs
+        self.accepted = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.last_flush_size = 0
+        self.last_flush_duration = 0.0
+        self.last_write_latency = 0.0
+        self.max_write_latency = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('POSITION_WRITE_BEHIND', False)
+        self.interval = app.config.get('POSITION_FLUSH_INTERVAL_MS', 200) / 1000.0
+        self.max_rows = app.config.get('POSITION_FLUSH_MAX_ROWS', 500)
+        self.capacity = app.config.get('POSITION_BUFFER_MAX_ROWS', 10000)
+        self.put_timeout = app.config.get('POSITION_BUFFER_PUT_TIMEOUT', 0.5)
+        self.max_retries = app.config.get('POSITION_FLUSH_MAX_RETRIES', 5)
+        self.max_backoff = float(app.config.get('POSITION_FLUSH_MAX_BACKOFF_SECONDS', 30))
+        app.position_buffer = self
+
+        if self.enabled:
+            self.start()
+            atexit.register(self.stop)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='position-buffer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Arrête le thread et écrit ce qui reste dans le tampon
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        self.flush()
+
+    def put(self, rows: List[dict]) -> bool:
+        """
+        Ajoute des positions au tampon. Si le tampon est plein, attend au plus
+        put_timeout secondes qu'une écriture libère de la place (backpressure),
+        puis refuse les lignes (retourne False).
+        """
+        if not rows:
+            return True
+
+        with self._cond:
+            deadline = time.time() + self.put_timeout
+            while len(self._rows) + len(rows) > self.capacity:
+                remaining = deadline - time.time()
+                if remaining <= 0 or len(rows) > self.capacity:
+                    self.dropped += len(rows)
+                    return False
+                self._cond.notify_all()
+                self._cond.wait(remaining)
+
+            now = time.time()
+            for row in rows:
+                self._rows.append((now, row))
+            self.accepted += len(rows)
+
+            if len(self._rows) >= self.max_rows:
+                self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._rows:
+                    self._cond.wait()
+                # Après une erreur : attente avant le prochain essai
+                while self._running and time.time() < self._retry_at:
+                    self._cond.wait(self._retry_at - time.time())
+                # Attend l'intervalle de flush ou un lot complet
+                while self._running and len(self._rows) < self.max_rows:
+                    remaining = self._rows[0][0] + self.interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not self._running and not self._rows:
+                    return
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Écrit le contenu du tampon, un commit par lot de max_rows lignes
+        """
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self._rows)
+                self._rows.clear()
+                self._cond.notify_all()
+
+            written = 0
+            for offset in range(0, len(batch), self.max_rows):
+                chunk = batch[offset:offset + self.max_rows]
+                try:
+                    self._write(chunk)
+                except Exception as e:
+                    print(f"Erreur écriture tampon positions: {e}")
+                    with self._cond:
+                        self.flush_errors += 1
+                        self._failures += 1
+                        failures = self._failures
+                    if failures >= self.max_retries and self._database_available():
+                        # Lot refusé par la base elle-même : écarte les lignes fautives
+                        written += self._write_bisect(chunk)
+                        with self._cond:
+                            self._failures = 0
+                        continue
+                    self._requeue(batch[offset:], failures)
+                    return written
+
+                written += len(chunk)
+                with self._cond:
+                    self._failures = 0
+                    self._retry_at = 0.0
+
+            return written
+
+    def _write(self, chunk: List[tuple]):
+        started = time.time()
+        with self.app.app_context():
+            try:
+                db.session.execute(db.insert(Position), [row for _, row in chunk])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+        finished = time.time()
+        with self._cond:
+            latency = finished - chunk[0][0]
+            self.flushed += len(chunk)
+            self.flush_count += 1
+            self.last_flush_size = len(chunk)
+            self.last_flush_duration = finished - started
+            self.last_write_latency = latency
+            self.max_write_latency = max(self.max_write_latency, latency)
+
+    def _write_bisect(self, chunk: List[tuple]) -> int:
+        """
+        Écrit un lot refusé moitié par moitié ; une ligne seule refusée est écartée
+        """
+        try:
+            self._write(chunk)
+            return len(chunk)
+        except Exception as e:
+            if len(chunk) == 1:
+                print(f"Position écartée (refusée par la base): {e}")
+                with self._cond:
+                    self.dropped += 1
+                return 0
+        middle = len(chunk) // 2
+        return self._write_bisect(chunk[:middle]) + self._write_bisect(chunk[middle:])
+
+    def _database_available(self) -> bool:
+        """
+        Distingue une panne de la base (on réessaie) d'un lot invalide (on le découpe)
+        """
+        try:
+            with self.app.app_context():
+                db.session.execute(text('SELECT 1'))
+                db.session.remove()
+            return True
+        except Exception:
+            return False
+
+    def _requeue(self, rows: List[tuple], failures: int):
+        """
+        Remet les lignes non écrites en tête du tampon (dans la limite de la
+        capacité) et recule le prochain essai
+        """
+        with self._cond:
+            room = max(0, self.capacity - len(self._rows))
+            kept = rows[:room]
+            self.dropped += len(rows) - len(kept)
+            self._rows.extendleft(reversed(kept))
+            backoff = min(self.interval * 2 ** failures, self.max_backoff)
+            self._retry_at = time.time() + backoff
+
+    def get_stats(self) -> Dict:
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'pending': len(self._rows),
+                'capacity': self.capacity,
+                'accepted': self.accepted,
+                'flushed': self.flushed,
+                'dropped': self.dropped,
+                'flush_count': self.flush_count,
+                'flush_errors': self.flush_errors,
+                'consecutive_failures': self._failures,
+                'last_flush_size': self.last_flush_size,
+                'last_flush_duration_seconds': round(self.last_flush_duration, 3),
+                'last_write_latency_seconds': round(self.last_write_latency, 3),
+                'max_write_latency_seconds': round(self.max_write_latency, 3)
+            }
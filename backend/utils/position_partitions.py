@@ -0,0 +1,467 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import make_url
+
+from models import db, Position, PositionPartition, SegmentModelState
+
+TABLE_PREFIX = 'positions_p'  # SQLite : positions_p20261017
+MYSQL_PREFIX = 'p'  # MySQL : partition p20261017 de la table positions
+MYSQL_MAXVALUE = 'pmax'
+COLUMNS = [column.name for column in Position.__table__.columns]
+
+
+class PositionPartitionManager:
+    """
+    Stockage des positions par période (jour ou semaine).
+
+    - MySQL : partitions natives RANGE (TO_DAYS(timestamp)) de la table
+      positions, créées POSITION_PARTITIONS_AHEAD périodes à l'avance ; MySQL
+      n'ouvre que les partitions couvertes par le filtre sur timestamp. La
+      conversion de la table (scripts/manage_partitions.py --convert) supprime
+      la clé étrangère vers buses (non supportée par les tables partitionnées)
+      et ajoute timestamp à la clé primaire.
+    - SQLite : la table positions garde la période en cours et les
+      POSITION_HOT_PERIODS précédentes ; les périodes terminées sont déplacées
+      par lots dans une table positions_pAAAAMMJJ, inscrite dans
+      position_partitions. Les lectures par plage de dates n'interrogent que
+      les tables qui la recouvrent. Le modèle de temps de parcours
+      (scripts/build_segment_model.py) lit la table positions par curseur
+      d'identifiant : une fois lancé, seules les positions qu'il a déjà
+      apprises (id <= SegmentModelState.last_position_id) sont déplacées.
+
+    Dans les deux cas, l'expiration supprime une partition entière (DROP)
+    au lieu de supprimer les positions une à une.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.mode: Optional[str] = None  # 'native' (MySQL), 'tables' (SQLite) ou None
+        self.period = 'day'
+        self.hot_periods = 1
+        self.ahead = 3
+        self.chunk_size = 1000
+        self.chunk_pause = 0.05
+        self._tables: Dict[str, db.Table] = {}
+        self._lock = threading.Lock()
+
+        # Compteurs
+        self.queries = 0
+        self.partitions_scanned = 0
+        self.partitions_pruned = 0
+        self.partition_count = 0
+        self.rows_rotated = 0
+        self.partitions_created = 0
+        self.partitions_dropped = 0
+        self.rows_dropped = 0
+        self.last_maintenance: Optional[datetime] = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('POSITION_PARTITIONING', False)
+        self.period = app.config.get('POSITION_PARTITION_PERIOD', 'day')
+        self.hot_periods = app.config.get('POSITION_HOT_PERIODS', 1)
+        self.ahead = app.config.get('POSITION_PARTITIONS_AHEAD', 3)
+        self.chunk_size = app.config.get('RETENTION_CHUNK_SIZE', 1000)
+        self.chunk_pause = app.config.get('RETENTION_CHUNK_PAUSE_SECONDS', 0.05)
+        app.position_partitions = self
+
+        if self.enabled:
+            backend = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+            self.mode = {'mysql': 'native', 'sqlite': 'tables'}.get(backend)
+            if self.mode is None:
+                print(f"Partitionnement des positions non supporté pour {backend}")
+
+    # Périodes
+
+    def period_start(self, moment: datetime) -> datetime:
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.period == 'week':
+            start -= timedelta(days=start.weekday())
+        return start
+
+    def next_period(self, start: datetime) -> datetime:
+        return start + timedelta(days=7 if self.period == 'week' else 1)
+
+    def hot_from(self, now: datetime) -> datetime:
+        """
+        Début de la période la plus ancienne gardée dans la table positions
+        """
+        start = self.period_start(now)
+        for _ in range(self.hot_periods):
+            start = self.period_start(start - timedelta(days=1))
+        return start
+
+    # Tables par période (SQLite)
+
+    def _table(self, name: str) -> db.Table:
+        table = self._tables.get(name)
+        if table is None:
+            table = db.Table(
+                name, db.MetaData(),
+                *[db.Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                  for column in Position.__table__.columns],
+                db.Index(f'ix_{name}_bus_id_timestamp', 'bus_id', 'timestamp'),
+                db.Index(f'ix_{name}_timestamp', 'timestamp')
+            )
+            self._tables[name] = table
+        return table
+
+    def _ensure_table(self, start: datetime) -> PositionPartition:
+        name = f'{TABLE_PREFIX}{start:%Y%m%d}'
+        record = PositionPartition.query.filter_by(name=name).first()
+        if record is None:
+            self._table(name).create(db.session.connection(), checkfirst=True)
+            record = PositionPartition(name=name, period_start=start, period_end=self.next_period(start), row_count=0)
+            db.session.add(record)
+            db.session.commit()
+            self.partitions_created += 1
+        return record
+
+    def partitions(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   newest_first: bool = False) -> List[PositionPartition]:
+        """
+        Tables par période recouvrant [start, end) (SQLite)
+        """
+        query = PositionPartition.query
+        if start is not None:
+            query = query.filter(PositionPartition.period_end > start)
+        if end is not None:
+            query = query.filter(PositionPartition.period_start < end)
+        order = PositionPartition.period_start.desc() if newest_first else PositionPartition.period_start
+        return query.order_by(order).all()
+
+    # Lectures
+
+    def query(self, bus_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+              limit: Optional[int] = None, newest_first: bool = False) -> List[Position]:
+        """
+        Positions d'un bus sur [start, end), triées par date ; seules les
+        partitions recouvrant la plage sont lues. Avec une limite, la lecture
+        s'arrête dès que les partitions restantes ne peuvent plus contribuer.
+        """
+        if self.mode != 'tables':
+            # Table unique (MySQL élague lui-même les partitions)
+            query = Position.query.filter(Position.bus_id == bus_id)
+            if start is not None:
+                query = query.filter(Position.timestamp >= start)
+            if end is not None:
+                query = query.filter(Position.timestamp < end)
+            order = Position.timestamp.desc() if newest_first else Position.timestamp.asc()
+            query = query.order_by(order)
+            if limit:
+                query = query.limit(limit)
+            with self._lock:
+                self.queries += 1
+            return query.all()
+
+        # Table courante d'abord : elle peut contenir des positions en retard
+        rows = self._read(Position.__table__, bus_id, start, end, limit, newest_first)
+        partitions = self.partitions(start, end, newest_first)
+        total = PositionPartition.query.count()
+        scanned = 0
+        for record in partitions:
+            if limit and len(rows) >= limit:
+                # Positions déjà lues situées au-delà de cette partition et des suivantes
+                if newest_first:
+                    ready = sum(1 for row in rows if row['timestamp'] >= record.period_end)
+                else:
+                    ready = sum(1 for row in rows if row['timestamp'] < record.period_start)
+                if ready >= limit:
+                    break
+            rows.extend(self._read(self._table(record.name), bus_id, start, end, limit, newest_first))
+            scanned += 1
+
+        rows.sort(key=lambda row: row['timestamp'], reverse=newest_first)
+        if limit:
+            rows = rows[:limit]
+        with self._lock:
+            self.queries += 1
+            self.partitions_scanned += scanned
+            self.partitions_pruned += total - scanned
+        return [Position(**row) for row in rows]
+
+    @staticmethod
+    def _read(table, bus_id: int, start: Optional[datetime], end: Optional[datetime],
+              limit: Optional[int], newest_first: bool) -> List[dict]:
+        statement = select(*[table.c[name] for name in COLUMNS]).where(table.c.bus_id == bus_id)
+        if start is not None:
+            statement = statement.where(table.c.timestamp >= start)
+        if end is not None:
+            statement = statement.where(table.c.timestamp < end)
+        statement = statement.order_by(table.c.timestamp.desc() if newest_first else table.c.timestamp.asc())
+        if limit:
+            statement = statement.limit(limit)
+        return [dict(row._mapping) for row in db.session.execute(statement)]
+
+    # Maintenance
+
+    def maintain(self, now: Optional[datetime] = None, convert: bool = False,
+                 deadline: Optional[float] = None) -> Dict:
+        """
+        SQLite : déplace les périodes terminées hors de la table positions.
+        MySQL : crée les partitions des prochaines périodes (et convertit la
+        table si convert=True). Retourne les lignes déplacées et partitions créées.
+        """
+        now = now or datetime.utcnow()
+        created = self.partitions_created
+        rotated = 0
+        if self.mode == 'tables':
+            rotated = self._rotate(now, deadline)
+            self.partition_count = PositionPartition.query.count()
+        elif self.mode == 'native':
+            self._mysql_maintain(now, convert)
+        self.last_maintenance = now
+        return {'positions_rotated': rotated, 'partitions_created': self.partitions_created - created}
+
+    def _rotate(self, now: datetime, deadline: Optional[float]) -> int:
+        hot_from = self.hot_from(now)
+        # La position la plus récente reste dans la table courante : les
+        # identifiants ne repartent jamais de 1 (pas d'AUTOINCREMENT sous SQLite)
+        last_id = db.session.query(func.max(Position.id)).scalar()
+        # Positions pas encore lues par le modèle de temps de parcours : gardées
+        learned = db.session.query(SegmentModelState.last_position_id).order_by(SegmentModelState.id).limit(1).scalar()
+        if last_id and learned is not None:
+            last_id = min(last_id, learned + 1)
+        moved = 0
+        start = db.session.query(func.min(Position.timestamp))\
+            .filter(Position.timestamp < hot_from, Position.id < last_id).scalar() if last_id else None
+
+        while start is not None and not _expired(deadline):
+            period = self.period_start(start)
+            end = self.next_period(period)
+            record = self._ensure_table(period)
+            table = self._table(record.name)
+            positions = Position.__table__
+
+            while not _expired(deadline):
+                ids = [row[0] for row in db.session.query(Position.id).filter(
+                    Position.timestamp >= period, Position.timestamp < end, Position.id < last_id
+                ).order_by(Position.id).limit(self.chunk_size).all()]
+                if not ids:
+                    break
+                # Copie et suppression dans la même transaction
+                db.session.execute(table.insert().from_select(
+                    COLUMNS, select(*[positions.c[name] for name in COLUMNS]).where(positions.c.id.in_(ids))
+                ))
+                db.session.execute(positions.delete().where(positions.c.id.in_(ids)))
+                record.row_count = (record.row_count or 0) + len(ids)
+                db.session.commit()
+                moved += len(ids)
+                if self.chunk_pause:
+                    time.sleep(self.chunk_pause)
+
+            start = db.session.query(func.min(Position.timestamp))\
+                .filter(Position.timestamp >= end, Position.timestamp < hot_from, Position.id < last_id).scalar()
+
+        with self._lock:
+            self.rows_rotated += moved
+        return moved
+
+    def drop_before(self, cutoff: datetime) -> Tuple[int, int]:
+        """
+        Supprime les partitions entièrement antérieures à cutoff ;
+        retourne (partitions, positions) supprimées
+        """
+        dropped, rows = 0, 0
+        if self.mode == 'tables':
+            for record in PositionPartition.query.filter(PositionPartition.period_end <= cutoff).all():
+                db.session.execute(text(f'DROP TABLE IF EXISTS "{record.name}"'))
+                rows += record.row_count or 0
+                db.session.delete(record)
+                db.session.commit()
+                self._tables.pop(record.name, None)
+                dropped += 1
+            self.partition_count = PositionPartition.query.count()
+        elif self.mode == 'native':
+            partitions = self._mysql_partitions() or []
+            # La dernière partition datée est gardée : la plage doit rester couverte
+            names = [name for name, start in partitions[:-1] if self.next_period(start) <= cutoff]
+            for name in names:
+                rows += db.session.execute(text(f'SELECT COUNT(*) FROM positions PARTITION ({name})')).scalar()
+            if names:
+                db.session.execute(text(f'ALTER TABLE positions DROP PARTITION {", ".join(names)}'))
+                db.session.commit()
+            dropped = len(names)
+            self.partition_count = len(partitions) - dropped
+
+        with self._lock:
+            self.partitions_dropped += dropped
+            self.rows_dropped += rows
+        return dropped, rows
+
+    def downsample(self, cutoff: datetime, mask: Callable[..., np.ndarray],
+                   deadline: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Sous-échantillonne les tables par période antérieures à cutoff (SQLite) :
+        les positions gardées sont recopiées dans une nouvelle table qui remplace
+        l'ancienne. Retourne (positions lues, positions supprimées).
+        """
+        scanned, removed = 0, 0
+        if self.mode != 'tables':
+            return scanned, removed
+
+        pending = PositionPartition.query.filter(
+            PositionPartition.period_end <= cutoff, PositionPartition.downsampled.isnot(True)
+        ).order_by(PositionPartition.period_start).all()
+        for record in pending:
+            if _expired(deadline):
+                break
+            table = self._table(record.name)
+            rewrite = db.Table(
+                f'{record.name}_rewrite', db.MetaData(),
+                *[db.Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns]
+            )
+            connection = db.session.connection()
+            rewrite.drop(connection, checkfirst=True)
+            rewrite.create(connection)
+
+            kept = 0
+            bus_ids = [row[0] for row in db.session.execute(select(table.c.bus_id).distinct())]
+            for bus_id in bus_ids:
+                rows = self._read(table, bus_id, None, None, None, False)
+                if not rows:
+                    continue
+                keep = mask(
+                    np.full(len(rows), bus_id),
+                    np.array([row['timestamp'] for row in rows], dtype='datetime64[us]').astype(np.int64) / 1e6,
+                    np.array([row['latitude'] for row in rows]),
+                    np.array([row['longitude'] for row in rows])
+                )
+                kept_rows = [row for row, kept_row in zip(rows, keep) if kept_row]
+                if kept_rows:
+                    db.session.execute(rewrite.insert(), kept_rows)
+                scanned += len(rows)
+                kept += len(kept_rows)
+
+            # Remplacement de la table (les index sont recréés sous leur nom)
+            db.session.execute(text(f'DROP TABLE "{record.name}"'))
+            db.session.execute(text(f'ALTER TABLE "{rewrite.name}" RENAME TO "{record.name}"'))
+            for index in table.indexes:
+                index.create(connection)
+            removed += (record.row_count or 0) - kept
+            record.row_count = kept
+            record.downsampled = True
+            db.session.commit()
+        return scanned, removed
+
+    def delete_bus(self, bus_id: int):
+        """
+        Supprime les positions archivées d'un bus supprimé (SQLite ;
+        la table positions est vidée par la cascade de Bus.positions)
+        """
+        if self.mode != 'tables':
+            return
+        for record in self.partitions():
+            table = self._table(record.name)
+            deleted = db.session.execute(table.delete().where(table.c.bus_id == bus_id)).rowcount
+            record.row_count = max((record.row_count or 0) - deleted, 0)
+        db.session.commit()
+
+    # Partitions natives (MySQL)
+
+    def _mysql_partitions(self) -> Optional[List[Tuple[str, datetime]]]:
+        """
+        Partitions datées de la table positions (None si elle n'est pas partitionnée)
+        """
+        rows = db.session.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'positions' "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        )).all()
+        if not rows or rows[0][0] is None:
+            return None
+        return [
+            (name, datetime.strptime(name[len(MYSQL_PREFIX):], '%Y%m%d'))
+            for (name,) in rows if name != MYSQL_MAXVALUE
+        ]
+
+    def _mysql_definitions(self, starts: List[datetime]) -> str:
+        definitions = [
+            f"PARTITION {MYSQL_PREFIX}{start:%Y%m%d} VALUES LESS THAN (TO_DAYS('{self.next_period(start):%Y-%m-%d}'))"
+            for start in starts
+        ]
+        definitions.append(f'PARTITION {MYSQL_MAXVALUE} VALUES LESS THAN MAXVALUE')
+        return ', '.join(definitions)
+
+    def _periods(self, first: datetime, last: datetime) -> List[datetime]:
+        starts = []
+        start = self.period_start(first)
+        while start <= last:
+            starts.append(start)
+            start = self.next_period(start)
+        return starts
+
+    def _mysql_maintain(self, now: datetime, convert: bool):
+        horizon = self.period_start(now)
+        for _ in range(self.ahead):
+            horizon = self.next_period(horizon)
+
+        partitions = self._mysql_partitions()
+        if partitions is None:
+            if not convert:
+                print("Table positions non partitionnée : lancer scripts/manage_partitions.py --convert")
+                return
+            self._mysql_convert(now, horizon)
+            partitions = self._mysql_partitions()
+
+        last = partitions[-1][1] if partitions else self.period_start(now)
+        starts = self._periods(self.next_period(last), horizon)
+        if starts:
+            db.session.execute(text(
+                f'ALTER TABLE positions REORGANIZE PARTITION {MYSQL_MAXVALUE} INTO ({self._mysql_definitions(starts)})'
+            ))
+            db.session.commit()
+            self.partitions_created += len(starts)
+        self.partition_count = len(partitions) + len(starts)
+
+    def _mysql_convert(self, now: datetime, horizon: datetime):
+        """
+        Partitionne la table positions (une seule fois ; copie complète de la table)
+        """
+        first = db.session.query(func.min(Position.timestamp)).scalar() or now
+        foreign_keys = db.session.execute(text(
+            "SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'positions' AND REFERENCED_TABLE_NAME IS NOT NULL"
+        )).all()
+        for (name,) in foreign_keys:
+            db.session.execute(text(f'ALTER TABLE positions DROP FOREIGN KEY `{name}`'))
+        db.session.execute(text(
+            'ALTER TABLE positions MODIFY timestamp DATETIME NOT NULL, '
+            'DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)'
+        ))
+        starts = self._periods(first, horizon)
+        db.session.execute(text(
+            f'ALTER TABLE positions PARTITION BY RANGE (TO_DAYS(timestamp)) ({self._mysql_definitions(starts)})'
+        ))
+        db.session.commit()
+        self.partitions_created += len(starts)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'mode': self.mode,
+                'period': self.period,
+                'partitions': self.partition_count,
+                'queries': self.queries,
+                'partitions_scanned': self.partitions_scanned,
+                'partitions_pruned': self.partitions_pruned,
+                'rows_rotated': self.rows_rotated,
+                'partitions_created': self.partitions_created,
+                'partitions_dropped': self.partitions_dropped,
+                'rows_dropped': self.rows_dropped,
+                'last_maintenance': self.last_maintenance.isoformat() if self.last_maintenance else None
+            }
+
+
+def _expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.perf_counter() > deadline
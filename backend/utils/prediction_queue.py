@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from models import db
+from utils.predictions import PredictionEngine
+
+
+class IncrementalPredictionEngine:
+    """
+    File d'événements "bus X a bougé" traitée en arrière-plan.
+
+    L'ingestion GPS se contente d'appeler enqueue(bus_id) ; un thread dédié
+    recalcule uniquement les ETA de ce bus, pour les arrêts de sa ligne qui ont
+    des abonnés WebSocket (les autres sont calculés à la demande). Plusieurs
+    événements pour un même bus en attente sont fusionnés en un seul.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pending: "OrderedDict[int, float]" = OrderedDict()  # bus_id -> date de mise en file
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        # Compteurs
+        self.enqueued = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.errors = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+        self.last_duration = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.prediction_queue = self
+        self.start()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='prediction-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def enqueue(self, bus_id: int):
+        """
+        Signale qu'un bus a bougé (O(1), ne touche pas la base)
+        """
+        with self._cond:
+            self.enqueued += 1
+            if bus_id in self._pending:
+                # Un recalcul est déjà prévu pour ce bus : on garde la date la plus ancienne
+                self.coalesced += 1
+                return
+            self._pending[bus_id] = time.time()
+            self._cond.notify()
+
+    def _next(self) -> Optional[tuple]:
+        with self._cond:
+            while self._running and not self._pending:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            return self._pending.popitem(last=False)
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+
+            bus_id, enqueued_at = item
+            started = time.time()
+            try:
+                with self.app.app_context():
+                    notifier = getattr(self.app, 'stop_notifier', None)
+                    stop_ids = notifier.subscribed_stops() if notifier is not None else None
+                    PredictionEngine.update_bus_predictions(bus_id, stop_ids)
+                    db.session.remove()
+            except Exception as e:
+                self.errors += 1
+                print(f"Erreur recalcul prédictions bus {bus_id}: {e}")
+
+            finished = time.time()
+            lag = finished - enqueued_at
+            with self._cond:
+                self.processed += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self._total_lag += lag
+                self.last_duration = finished - started
+
+    def get_stats(self) -> Dict:
+        """
+        Profondeur de file et retard de traitement
+        """
+        with self._cond:
+            oldest = next(iter(self._pending.values()), None)
+            return {
+                'queue_depth': len(self._pending),
+                'oldest_pending_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'processed': self.processed,
+                'errors': self.errors,
+                'last_lag_seconds': round(self.last_lag, 3),
+                'max_lag_seconds': round(self.max_lag, 3),
+                'average_lag_seconds': round(self._total_lag / self.processed, 3) if self.processed else 0.0,
+                'last_duration_seconds': round(self.last_duration, 3)
+            }
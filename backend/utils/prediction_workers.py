@@ -0,0 +1,150 @@
+import atexit
+import heapq
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from utils.predictions import estimate_route
+
+
+def estimate_shard(snapshots: List[Dict]) -> Dict:
+    """
+    Calcule les ETA d'un groupe de lignes (exécuté dans un processus du pool)
+    """
+    started = time.perf_counter()
+    routes = []
+    for snapshot in snapshots:
+        route_started = time.perf_counter()
+        estimate = estimate_route(snapshot)
+        routes.append((snapshot['route_id'], estimate, time.perf_counter() - route_started))
+    return {
+        'pid': os.getpid(),
+        'routes': routes,
+        'seconds': time.perf_counter() - started
+    }
+
+
+class PredictionWorkerPool:
+    """
+    Calcul des ETA du cycle complet réparti par ligne (current_route_id) sur
+    un pool de PREDICTION_WORKERS processus.
+
+    Chaque processus reçoit un instantané en lecture seule des lignes de son
+    lot (tracé, positions et vitesses des bus) et renvoie les tableaux d'ETA ;
+    l'écriture en base reste faite par le processus principal. Les lignes sont
+    réparties en lots de coût équivalent (bus × arrêts). Avec 0 processus, ou
+    si le pool est indisponible, le calcul est fait dans le processus courant.
+    """
+
+    def __init__(self, app=None):
+        self.max_workers = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+        # Mesures
+        self.cycles = 0
+        self.fallbacks = 0
+        self.last_cycle_seconds = 0.0
+        self.last_shards: List[Dict] = []
+        self.route_timings: Dict[int, Dict] = {}  # route_id -> dernier calcul
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_workers = app.config.get('PREDICTION_WORKERS', 0)
+        app.prediction_workers = self
+        atexit.register(self.shutdown)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn : les processus ne copient pas les threads ni les connexions du serveur
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    @staticmethod
+    def _cost(snapshot: Dict) -> int:
+        return max(len(snapshot['bus_ids']), 1) * max(len(snapshot['geometry'].stops), 1)
+
+    def _shard(self, snapshots: List[Dict]) -> List[List[Dict]]:
+        """
+        Répartit les lignes en lots de coût équivalent (la plus coûteuse d'abord
+        dans le lot le moins chargé)
+        """
+        count = min(self.max_workers, len(snapshots))
+        heap = [(0, i) for i in range(count)]
+        shards: List[List[Dict]] = [[] for _ in range(count)]
+        for snapshot in sorted(snapshots, key=self._cost, reverse=True):
+            load, i = heapq.heappop(heap)
+            shards[i].append(snapshot)
+            heapq.heappush(heap, (load + self._cost(snapshot), i))
+        return shards
+
+    def run(self, snapshots: List[Dict]) -> Dict[int, Dict]:
+        """
+        Calcule les ETA de toutes les lignes : route_id -> tableaux d'estimation
+        """
+        started = time.perf_counter()
+        if self.max_workers > 0 and len(snapshots) > 1:
+            try:
+                with self._lock:
+                    executor = self._get_executor()
+                    futures = [executor.submit(estimate_shard, shard) for shard in self._shard(snapshots)]
+                shard_results = [future.result() for future in futures]
+            except Exception as e:
+                # Pool cassé (processus tué, etc.) : recréé au prochain cycle
+                print(f"Erreur pool de prédiction, calcul local: {e}")
+                self.fallbacks += 1
+                self.shutdown()
+                shard_results = [estimate_shard(snapshots)]
+        else:
+            shard_results = [estimate_shard(snapshots)]
+
+        sizes = {snapshot['route_id']: snapshot for snapshot in snapshots}
+        estimates = {}
+        shards = []
+        with self._lock:
+            for shard in shard_results:
+                for route_id, estimate, seconds in shard['routes']:
+                    estimates[route_id] = estimate
+                    self.route_timings[route_id] = {
+                        'route_id': route_id,
+                        'buses': len(sizes[route_id]['bus_ids']),
+                        'stops': len(sizes[route_id]['geometry'].stops),
+                        'seconds': round(seconds, 4)
+                    }
+                shards.append({
+                    'pid': shard['pid'],
+                    'routes': [route_id for route_id, _, _ in shard['routes']],
+                    'buses': sum(len(sizes[route_id]['bus_ids']) for route_id, _, _ in shard['routes']),
+                    'seconds': round(shard['seconds'], 4)
+                })
+            self.cycles += 1
+            self.last_shards = shards
+            self.last_cycle_seconds = time.perf_counter() - started
+
+        return estimates
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            slowest = sorted(self.route_timings.values(), key=lambda t: t['seconds'], reverse=True)
+            return {
+                'workers': self.max_workers,
+                'cycles': self.cycles,
+                'fallbacks': self.fallbacks,
+                'last_cycle_seconds': round(self.last_cycle_seconds, 4),
+                'last_shards': self.last_shards,
+                'slowest_routes': slowest[:10]
+            }
@@ -1,9 +1,130 @@
 from datetime import datetime, timedelta
+from flask import current_app
 from typing import List, Dict, Optional, Tuple
-from models import db, Bus, Position, Stop, RouteStop, Prediction, Occupancy
-from utils.gps_utils import calculate_distance, calculate_speed, get_traffic_factor, get_weather_factor
+from sqlalchemy import func
+from models import db, Bus, Position, RouteStop, Prediction, Occupancy, OccupancyRollup, RetentionState
+from utils.gps_utils import get_traffic_factor, get_weather_factor
+from utils.route_geometry import RouteGeometryCache, STOP_TOLERANCE_M
+from utils.replicas import use_replicas
 import numpy as np
 
+
+DEFAULT_SPEED_KMH = 25.0  # Vitesse par défaut en zone urbaine
+STOP_DWELL_HOURS = 1.0 / 60  # 1 minute par arrêt intermédiaire
+
+def estimate_route_etas(stop_ids: List[int], stop_offsets, bus_along, speeds, factor: float,
+                        segment_seconds=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calcule d'un coup les ETA de n bus vers les m arrêts d'une ligne (sans accès à la base)
+    stop_ids, stop_offsets: arrêts de la ligne dans l'ordre (mètres le long du tracé)
+    bus_along, speeds: position des bus (mètres) et vitesse moyenne (km/h)
+    factor: correction trafic × météo
+    segment_seconds: temps de parcours médians historiques entre arrêts consécutifs
+    (m - 1 valeurs, NaN si inconnu) ; à défaut distance / vitesse × facteur + arrêt
+    Retourne des matrices n × m : (prochain passage, heures, distance km, confiance)
+    """
+    stop_offsets = np.asarray(stop_offsets, dtype=float)
+    bus_along = np.asarray(bus_along, dtype=float)
+    speeds = np.asarray(speeds, dtype=float)
+    n, m = len(bus_along), len(stop_offsets)
+    
+    # Distance restante le long du trajet (arrêts déjà passés exclus)
+    remaining = stop_offsets[None, :] - bus_along[:, None]
+    reachable = remaining >= -STOP_TOLERANCE_M
+    distance_km = np.maximum(remaining, 0.0) / 1000
+    
+    # Arrêts strictement entre le bus et chaque arrêt
+    sorted_offsets = np.sort(stop_offsets)
+    before_stop = np.searchsorted(sorted_offsets, stop_offsets - STOP_TOLERANCE_M, side='left')
+    behind_bus = np.searchsorted(sorted_offsets, bus_along + STOP_TOLERANCE_M, side='right')
+    intermediate = np.maximum(before_stop[None, :] - behind_bus[:, None], 0)
+    
+    effective_speeds = np.where(speeds > 0, speeds, DEFAULT_SPEED_KMH)
+    if m < 2:
+        hours = distance_km / effective_speeds[:, None] * factor
+    else:
+        # Temps de chaque segment entre arrêts (secondes) : médiane historique
+        # (arrêts compris) ou conduite + 1 minute à l'arrêt de départ
+        positions = np.maximum.accumulate(stop_offsets)
+        lengths_km = np.diff(positions) / 1000
+        driving = lengths_km[None, :] / effective_speeds[:, None] * factor * 3600
+        if segment_seconds is None:
+            known = np.zeros(m - 1, dtype=bool)
+            historical = np.zeros(m - 1)
+        else:
+            segment_seconds = np.asarray(segment_seconds, dtype=float)
+            known = np.isfinite(segment_seconds)
+            historical = np.where(known, segment_seconds, 0.0)
+        full = np.where(known[None, :], historical[None, :], driving + STOP_DWELL_HOURS * 3600)
+        cumulative = np.concatenate([np.zeros((n, 1)), np.cumsum(full, axis=1)], axis=1)
+        
+        # Segment en cours (k = dernier arrêt atteint, -1 avant le premier)
+        reached = np.searchsorted(positions, bus_along + STOP_TOLERANCE_M, side='right') - 1
+        current = np.clip(reached, 0, m - 2)
+        rows = np.arange(n)
+        length = positions[current + 1] - positions[current]
+        fraction = np.divide(positions[current + 1] - bus_along, length,
+                             out=np.zeros(n), where=length > 0)
+        partial = np.clip(fraction, 0.0, 1.0) * np.where(known[current], historical[current], driving[rows, current])
+        before_first = (positions[0] - bus_along) / 1000 / effective_speeds * factor * 3600
+        partial = np.where(reached < 0, np.maximum(before_first, 0.0), partial)
+        
+        # Fin du segment en cours puis segments complets jusqu'à l'arrêt
+        following = np.minimum(reached + 1, m - 1)
+        seconds = partial[:, None] + cumulative - cumulative[rows, following][:, None]
+        ahead = np.arange(m)[None, :] > reached[:, None]
+        hours = np.where(ahead, np.maximum(seconds, 0.0), 0.0) / 3600
+    
+    confidence = PredictionEngine._calculate_confidence(distance_km, speeds[:, None], intermediate)
+    
+    # Arrêt desservi plusieurs fois (boucle) : seul le prochain passage compte
+    selected = reachable.copy()
+    served: Dict[int, np.ndarray] = {}
+    for j, stop_id in enumerate(stop_ids):
+        if stop_id in served:
+            selected[:, j] &= ~served[stop_id]
+            served[stop_id] |= selected[:, j]
+        else:
+            served[stop_id] = selected[:, j].copy()
+    
+    return selected, hours, distance_km, confidence
+
+def estimate_route(snapshot: Dict) -> Dict:
+    """
+    Calcul complet d'une ligne à partir d'un instantané en lecture seule (tracé,
+    positions et vitesses des bus) : projection des positions sur le tracé puis
+    ETA vers chaque arrêt. Sans accès à la base ni à l'application, pour pouvoir
+    être exécuté dans un processus séparé.
+    """
+    geometry = snapshot['geometry']
+    along = np.zeros(len(snapshot['bus_ids']))
+    segments = np.zeros(len(snapshot['bus_ids']), dtype=int)
+    projected = snapshot.get('projected') or [None] * len(snapshot['bus_ids'])
+    for i, (latitude, longitude, hint, known) in enumerate(
+            zip(snapshot['latitudes'], snapshot['longitudes'], snapshot['hints'], projected)):
+        if known is not None:
+            # Position déjà projetée à sa réception
+            along[i], segments[i] = known
+        else:
+            along[i], segments[i], _ = geometry.project(latitude, longitude, hint)
+    
+    selected, hours, distance_km, confidence = estimate_route_etas(
+        [stop_id for _, stop_id, _ in geometry.stops],
+        [offset for _, _, offset in geometry.stops],
+        along,
+        snapshot['speeds'],
+        snapshot['factor'],
+        snapshot.get('segment_seconds')
+    )
+    return {
+        'along': along,
+        'segments': segments,
+        'selected': selected,
+        'hours': hours,
+        'distance_km': distance_km,
+        'confidence': confidence
+    }
+
 class PredictionEngine:
     """
     Moteur de prédiction des temps d'arrivée
@@ -16,175 +137,386 @@ class PredictionEngine:
         """
         try:
             bus = Bus.query.get(bus_id)
-            stop = Stop.query.get(stop_id)
-            
-            if not bus or not stop or not bus.current_route_id:
+            if not bus:
                 return None
             
-            # Position actuelle du bus
-            current_position = bus.get_current_position()
-            if not current_position:
+            result = PredictionEngine.compute_predictions([bus], {stop_id}).get(bus_id)
+            if not result or not result['predictions']:
                 return None
-            
-            # Obtient les arrêts de la ligne
-            route_stops = RouteStop.query.filter_by(route_id=bus.current_route_id)\
-                                        .order_by(RouteStop.sequence).all()
-            
-            # Trouve l'arrêt cible dans la ligne
-            target_stop_sequence = None
-            for rs in route_stops:
-                if rs.stop_id == stop_id:
-                    target_stop_sequence = rs.sequence
-                    break
-            
-            if target_stop_sequence is None:
-                return None
-            
-            # Calcule la distance jusqu'à l'arrêt
-            distance_km = calculate_distance(
-                current_position.latitude, current_position.longitude,
-                stop.latitude, stop.longitude
-            )
-            
-            # Obtient l'historique des vitesses
-            historical_speed = PredictionEngine._get_average_speed(bus_id, bus.current_route_id)
-            
-            # Facteurs de correction
-            current_time = datetime.now()
-            traffic_factor = get_traffic_factor(current_time.hour, current_time.weekday())
-            weather_factor = get_weather_factor()
-            
-            # Calcul du temps de base
-            if historical_speed > 0:
-                base_time_hours = distance_km / historical_speed
-            else:
-                # Vitesse par défaut en zone urbaine
-                base_time_hours = distance_km / 25.0
-            
-            # Temps ajusté avec facteurs
-            adjusted_time_hours = base_time_hours * traffic_factor * weather_factor
-            
-            # Ajoute du temps pour les arrêts intermédiaires
-            intermediate_stops = PredictionEngine._count_intermediate_stops(
-                bus, current_position, target_stop_sequence, route_stops
-            )
-            stop_time_hours = (intermediate_stops * 1.0) / 60  # 1 minute par arrêt
-            
-            total_time_hours = adjusted_time_hours + stop_time_hours
-            arrival_time = current_time + timedelta(hours=total_time_hours)
-            
-            # Calcule la confiance de la prédiction
-            confidence = PredictionEngine._calculate_confidence(
-                distance_km, historical_speed, intermediate_stops
-            )
-            
-            return {
-                'bus_id': bus_id,
-                'stop_id': stop_id,
-                'arrival_time': arrival_time,
-                'confidence': confidence,
-                'distance_km': distance_km,
-                'eta_minutes': int(total_time_hours * 60)
-            }
+            return result['predictions'][0]
             
         except Exception as e:
             print(f"Erreur calcul prédiction: {e}")
             return None
     
     @staticmethod
-    def _get_average_speed(bus_id: int, route_id: int) -> float:
+    def compute_predictions(buses: List[Bus], stop_ids: Optional[set] = None,
+                            parallel: bool = False) -> Dict[int, Dict]:
         """
-        Calcule la vitesse moyenne historique d'un bus sur une ligne
+        Calcule en lot les prédictions d'un ensemble de bus (sans écriture en base).
+        Positions, vitesses et tracés sont chargés en quelques requêtes, puis les
+        ETA de tous les couples bus × arrêt d'une ligne sont calculées ensemble.
+        Si stop_ids est fourni, seuls ces arrêts sont retenus. Les temps de
+        parcours historiques entre arrêts (segment_model) remplacent le calcul
+        distance / vitesse sur les segments où ils sont connus.
+        Avec parallel, les lignes sont réparties sur le pool de processus
+        (PREDICTION_WORKERS) s'il est configuré.
+        Retourne bus_id -> {'predictions', 'route_stop_ids', 'passed'}
         """
-        try:
-            # Obtient les positions récentes
-            recent_positions = Position.query.filter_by(bus_id=bus_id)\
-                .filter(Position.timestamp >= datetime.now() - timedelta(hours=2))\
-                .order_by(Position.timestamp.desc()).limit(10).all()
-            
-            if len(recent_positions) < 2:
-                return 25.0  # Vitesse par défaut
-            
-            speeds = []
-            for i in range(1, len(recent_positions)):
-                prev_pos = recent_positions[i]
-                curr_pos = recent_positions[i-1]
-                
-                distance = calculate_distance(
-                    prev_pos.latitude, prev_pos.longitude,
-                    curr_pos.latitude, curr_pos.longitude
-                )
+        buses = [bus for bus in buses if bus.current_route_id]
+        if not buses:
+            return {}
+        
+        bus_ids = [bus.id for bus in buses]
+        positions = PredictionEngine._get_latest_positions(bus_ids)
+        speeds = PredictionEngine._get_average_speeds(bus_ids)
+        geometries = PredictionEngine._route_geometry()
+        store = getattr(current_app, 'latest_state', None)
+        segment_model = getattr(current_app, 'segment_model', None)
+        
+        # Facteurs de correction (heure locale pour le trafic)
+        current_time = datetime.now()
+        factor = get_traffic_factor(current_time.hour, current_time.weekday()) * get_weather_factor()
+        # Heure d'arrivée en UTC, comme les timestamps en base
+        computed_at = datetime.utcnow()
+        
+        # Instantané par ligne : tracé, positions et vitesses des bus
+        snapshots: Dict[int, Dict] = {}
+        members: Dict[int, List[Bus]] = {}
+        for bus in buses:
+            position = positions.get(bus.id)
+            if position is None:
+                continue
+            route_id = bus.current_route_id
+            if route_id not in snapshots:
+                geometry = geometries.get(route_id)
+                if geometry is None or not geometry.stops:
+                    continue
+                snapshots[route_id] = {
+                    'route_id': route_id, 'geometry': geometry, 'factor': factor,
+                    'segment_seconds': segment_model.segment_seconds(
+                        route_id, [stop_id for _, stop_id, _ in geometry.stops], computed_at
+                    ) if segment_model is not None else None,
+                    'bus_ids': [], 'latitudes': [], 'longitudes': [], 'hints': [], 'projected': [], 'speeds': []
+                }
+                members[route_id] = []
+            snapshot = snapshots[route_id]
+            snapshot['bus_ids'].append(bus.id)
+            snapshot['latitudes'].append(position[0])
+            snapshot['longitudes'].append(position[1])
+            snapshot['hints'].append(geometries.last_segment(bus.id, route_id))
+            projection = store.get_projection(bus.id) if store is not None else None
+            snapshot['projected'].append(
+                (projection['along'], projection['segment'])
+                if projection is not None and projection['route_id'] == route_id
+                and projection['geometry'] is snapshot['geometry']
+                and (projection['latitude'], projection['longitude']) == tuple(position[:2]) else None
+            )
+            snapshot['speeds'].append(speeds.get(bus.id, DEFAULT_SPEED_KMH))
+            members[route_id].append(bus)
+        
+        workers = getattr(current_app, 'prediction_workers', None) if parallel else None
+        if workers is not None:
+            estimates = workers.run(list(snapshots.values()))
+        else:
+            estimates = {route_id: estimate_route(snapshot) for route_id, snapshot in snapshots.items()}
+        
+        results = {}
+        for route_id, estimate in estimates.items():
+            geometry = snapshots[route_id]['geometry']
+            route_stop_ids = [stop_id for _, stop_id, _ in geometry.stops]
+            wanted = np.array([stop_ids is None or stop_id in stop_ids for stop_id in route_stop_ids])
+            requested = {stop_id for stop_id, keep in zip(route_stop_ids, wanted) if keep}
+            selected, hours = estimate['selected'], estimate['hours']
+            
+            for i, bus in enumerate(members[route_id]):
+                # Position le long du tracé, reprise au prochain calcul
+                along = float(estimate['along'][i])
+                geometries.remember(bus.id, route_id, int(estimate['segments'][i]))
+                if store is not None:
+                    next_stop_index, progress = geometry.progress(along)
+                    store.set_route_progress(bus.id, next_stop_index, progress, along)
                 
-                time_diff = (curr_pos.timestamp - prev_pos.timestamp).total_seconds() / 3600
+                predictions = [{
+                    'bus_id': bus.id,
+                    'stop_id': route_stop_ids[j],
+                    'arrival_time': computed_at + timedelta(hours=float(hours[i, j])),
+                    'confidence': float(estimate['confidence'][i, j]),
+                    'distance_km': float(estimate['distance_km'][i, j]),
+                    'eta_minutes': int(hours[i, j] * 60)
+                } for j in np.flatnonzero(selected[i] & wanted)]
                 
-                if time_diff > 0:
-                    speed = distance / time_diff
-                    if 5 <= speed <= 80:  # Vitesses réalistes
-                        speeds.append(speed)
-            
-            return np.mean(speeds) if speeds else 25.0
-            
-        except Exception:
-            return 25.0
+                # Arrêts demandés sans prochain passage : déjà passés
+                passed = requested - {p['stop_id'] for p in predictions}
+                results[bus.id] = {
+                    'predictions': predictions,
+                    'route_stop_ids': [s for s in dict.fromkeys(route_stop_ids) if s not in passed],
+                    'passed': passed
+                }
+        
+        return results
+    
+    @staticmethod
+    def _route_geometry() -> RouteGeometryCache:
+        cache = getattr(current_app, 'route_geometry', None)
+        if cache is None:
+            cache = RouteGeometryCache(current_app)
+        return cache
+    
+    @staticmethod
+    def _get_latest_positions(bus_ids: List[int]) -> Dict[int, Tuple[float, float]]:
+        """
+        Dernière position (latitude, longitude) de chaque bus : position lissée
+        par le filtre de Kalman, sinon état courant en mémoire, puis une seule
+        requête pour les bus absents
+        """
+        gps_filter = getattr(current_app, 'gps_filter', None)
+        store = getattr(current_app, 'latest_state', None)
+        positions = {}
+        for bus_id in bus_ids:
+            estimate = gps_filter.get(bus_id) if gps_filter is not None else None
+            if estimate:
+                positions[bus_id] = (estimate['latitude'], estimate['longitude'])
+                continue
+            state = store.get_position(bus_id) if store is not None else None
+            if state:
+                positions[bus_id] = (state['latitude'], state['longitude'])
+        
+        missing = [bus_id for bus_id in bus_ids if bus_id not in positions]
+        if missing:
+            for bus_id, position in Position.latest_by_bus(missing).items():
+                positions[bus_id] = (position.latitude, position.longitude)
+        return positions
     
     @staticmethod
-    def _count_intermediate_stops(bus: Bus, current_position: Position, 
-                                 target_sequence: int, route_stops: List[RouteStop]) -> int:
+    def _get_average_speeds(bus_ids: List[int]) -> Dict[int, float]:
+        """
+        Vitesse moyenne récente de chaque bus (km/h), sans requête : moyenne
+        mobile tenue à jour par l'ingestion (SpeedEstimator), sinon vitesse du
+        filtre de Kalman si le bus roule
+        """
+        estimator = getattr(current_app, 'speed_estimator', None)
+        gps_filter = getattr(current_app, 'gps_filter', None)
+        speeds = {}
+        for bus_id in bus_ids:
+            speed = estimator.get_speed(bus_id) if estimator is not None else None
+            if speed:
+                speeds[bus_id] = speed
+                continue
+            estimate = gps_filter.get(bus_id) if gps_filter is not None else None
+            if estimate and 5 <= estimate['speed'] <= 80:  # Vitesses réalistes
+                speeds[bus_id] = estimate['speed']
+        return speeds
+    
+    @staticmethod
+    def _calculate_confidence(distance_km, speed, stops):
+        """
+        Calcule la confiance de la prédiction (scalaires ou tableaux NumPy)
+        """
+        # Confiance de base selon la distance
+        base_confidence = np.select(
+            [distance_km <= 1, distance_km <= 5, distance_km <= 10],
+            [0.9, 0.8, 0.7],
+            0.6
+        )
+        
+        # Réduction selon le nombre d'arrêts
+        stop_penalty = np.minimum(np.asarray(stops) * 0.05, 0.3)
+        
+        # Réduction si vitesse atypique
+        speed = np.asarray(speed)
+        speed_penalty = np.where((speed < 10) | (speed > 60), 0.2, 0.0)
+        
+        return np.clip(base_confidence - stop_penalty - speed_penalty, 0.1, 1.0)
+
+    @staticmethod
+    def _load_predictions(bus_ids: Optional[List[int]] = None) -> Tuple[Dict[Tuple[int, int], tuple], List[int]]:
+        """
+        Prédictions en base par couple (bus_id, stop_id) : (id, arrival_time, confidence).
+        Retourne aussi les ids des doublons éventuels d'un même couple
+        """
+        query = db.session.query(
+            Prediction.id, Prediction.bus_id, Prediction.stop_id,
+            Prediction.arrival_time, Prediction.confidence
+        )
+        if bus_ids is not None:
+            query = query.filter(Prediction.bus_id.in_(bus_ids))
+        
+        existing = {}
+        duplicates = []
+        for prediction_id, bus_id, stop_id, arrival_time, confidence in query.order_by(Prediction.id):
+            previous = existing.get((bus_id, stop_id))
+            if previous is not None:
+                duplicates.append(previous[0])  # On garde la plus récente
+            existing[(bus_id, stop_id)] = (prediction_id, arrival_time, confidence)
+        return existing, duplicates
+
+    @staticmethod
+    def _apply_predictions(results: Dict[int, Dict], bus_ids: Optional[List[int]] = None) -> Dict[str, int]:
+        """
+        Enregistre les prédictions calculées par différence avec la base (sans commit) :
+        - insertion groupée des nouveaux couples (bus_id, stop_id)
+        - mise à jour groupée des ETA décalées d'au moins PREDICTION_WRITE_MIN_DELTA secondes
+        - suppression en une requête des couples qui ne sont plus prédits
+        - ETA inchangées : seul created_at est rafraîchi, en une requête (sinon
+          refresh_stop_predictions les croit périmées dès que le bus bouge)
+        bus_ids: bus concernés (None pour un cycle complet sur toute la table)
         """
-        Compte le nombre d'arrêts intermédiaires jusqu'à la destination
+        min_delta = current_app.config.get('PREDICTION_WRITE_MIN_DELTA', 15)
+        # Base de la différence lue sur le primaire (un réplica en retard ferait réinsérer)
+        with use_replicas(False):
+            existing, obsolete = PredictionEngine._load_predictions(bus_ids)
+        now = datetime.utcnow()
+        
+        inserts = []
+        updates = []
+        unchanged = []
+        for result in results.values():
+            for prediction_data in result['predictions']:
+                current = existing.get((prediction_data['bus_id'], prediction_data['stop_id']))
+                if current is None:
+                    inserts.append({
+                        'bus_id': prediction_data['bus_id'],
+                        'stop_id': prediction_data['stop_id'],
+                        'arrival_time': prediction_data['arrival_time'],
+                        'confidence': prediction_data['confidence'],
+                        'created_at': now
+                    })
+                elif abs((prediction_data['arrival_time'] - current[1]).total_seconds()) >= min_delta or \
+                        abs(prediction_data['confidence'] - (current[2] or 0.0)) >= 0.05:
+                    updates.append({
+                        'id': current[0],
+                        'arrival_time': prediction_data['arrival_time'],
+                        'confidence': prediction_data['confidence'],
+                        'created_at': now
+                    })
+                else:
+                    unchanged.append(current[0])
+        
+        # Arrêts déjà passés, ligne changée, bus sans prédiction (cycle complet)
+        expected = {
+            (bus_id, stop_id)
+            for bus_id, result in results.items() for stop_id in result['route_stop_ids']
+        }
+        obsolete += [
+            current[0] for (bus_id, stop_id), current in existing.items()
+            if (bus_ids is None or bus_id in results) and (bus_id, stop_id) not in expected
+        ]
+        
+        if inserts:
+            db.session.execute(db.insert(Prediction), inserts)
+        if updates:
+            db.session.execute(db.update(Prediction), updates)
+        if unchanged:
+            Prediction.query.filter(Prediction.id.in_(unchanged))\
+                .update({'created_at': now}, synchronize_session=False)
+        if obsolete:
+            Prediction.query.filter(Prediction.id.in_(obsolete)).delete(synchronize_session=False)
+        
+        return {
+            'inserted': len(inserts),
+            'updated': len(updates),
+            'unchanged': len(unchanged),
+            'deleted': len(obsolete)
+        }
+
+    @staticmethod
+    def _update_bus_predictions(bus: Bus, stop_ids: Optional[set] = None) -> Tuple[List[Dict], List[int]]:
         """
+        Recalcule les prédictions d'un bus pour les arrêts de sa ligne (sans commit).
+        Si stop_ids est fourni, seuls ces arrêts sont recalculés.
+        Retourne (prédictions calculées, arrêts de la ligne)
+        """
+        results = PredictionEngine.compute_predictions([bus], stop_ids)
+        PredictionEngine._apply_predictions(results, [bus.id])
+        result = results.get(bus.id)
+        if result is None:
+            return [], []
+        return result['predictions'], result['route_stop_ids']
+
+    @staticmethod
+    def _notify(bus: Bus, predictions: List[Dict], route_stop_ids: List[int]):
+        """
+        Diffuse les changements aux abonnés des arrêts (après commit)
+        """
+        notifier = getattr(current_app, 'stop_notifier', None)
+        if notifier is None:
+            return
         try:
-            # Trouve l'arrêt le plus proche actuellement
-            min_distance = float('inf')
-            current_sequence = 0
-            
-            for rs in route_stops:
-                distance = calculate_distance(
-                    current_position.latitude, current_position.longitude,
-                    rs.stop.latitude, rs.stop.longitude
-                )
-                if distance < min_distance:
-                    min_distance = distance
-                    current_sequence = rs.sequence
-            
-            # Compte les arrêts entre la position actuelle et la destination
-            if target_sequence > current_sequence:
-                return target_sequence - current_sequence - 1
-            else:
+            notifier.notify_bus(bus, predictions, route_stop_ids)
+        except Exception as e:
+            print(f"Erreur diffusion prédictions bus {bus.id}: {e}")
+
+    @staticmethod
+    def update_bus_predictions(bus_id: int, stop_ids: Optional[set] = None) -> int:
+        """
+        Met à jour les prédictions d'un seul bus (appelé par la file incrémentale).
+        Si stop_ids est fourni, seuls ces arrêts sont recalculés ; les autres le
+        seront à la demande (refresh_stop_predictions) ou au prochain cycle complet.
+        """
+        try:
+            bus = Bus.query.get(bus_id)
+            if not bus or not bus.is_in_service:
+                # Plus de prédictions pour un bus hors service
+                Prediction.query.filter_by(bus_id=bus_id).delete()
+                db.session.commit()
+                notifier = getattr(current_app, 'stop_notifier', None)
+                if notifier is not None:
+                    notifier.notify_bus_removed(bus_id)
                 return 0
-                
-        except Exception:
+            
+            predictions, route_stop_ids = PredictionEngine._update_bus_predictions(bus, stop_ids)
+            db.session.commit()
+            PredictionEngine._notify(bus, predictions, route_stop_ids)
+            return len(predictions)
+            
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erreur mise à jour prédictions bus {bus_id}: {e}")
             return 0
-    
+
     @staticmethod
-    def _calculate_confidence(distance_km: float, speed: float, stops: int) -> float:
+    def refresh_stop_predictions(stop_id: int) -> int:
         """
-        Calcule la confiance de la prédiction
+        Recalcule à la demande les prédictions d'un arrêt dont le bus a bougé
+        depuis le dernier calcul (ou qui n'ont jamais été calculées)
         """
         try:
-            # Confiance de base selon la distance
-            if distance_km <= 1:
-                base_confidence = 0.9
-            elif distance_km <= 5:
-                base_confidence = 0.8
-            elif distance_km <= 10:
-                base_confidence = 0.7
-            else:
-                base_confidence = 0.6
+            route_ids = [rs.route_id for rs in RouteStop.query.filter_by(stop_id=stop_id).all()]
+            if not route_ids:
+                return 0
+            
+            buses = Bus.query.filter(
+                Bus.current_route_id.in_(route_ids),
+                Bus.is_in_service == True
+            ).all()
+            existing = {
+                p.bus_id: p for p in Prediction.query.filter_by(stop_id=stop_id).all()
+            }
             
-            # Réduction selon le nombre d'arrêts
-            stop_penalty = min(stops * 0.05, 0.3)
+            stale = []
+            for bus in buses:
+                position = bus.get_current_position()
+                if not position:
+                    continue
+                
+                prediction = existing.get(bus.id)
+                if prediction and position.timestamp and prediction.created_at >= position.timestamp:
+                    continue
+                stale.append(bus)
             
-            # Réduction si vitesse atypique
-            speed_penalty = 0.0
-            if speed < 10 or speed > 60:
-                speed_penalty = 0.2
+            results = PredictionEngine.compute_predictions(stale, {stop_id})
+            counts = PredictionEngine._apply_predictions(results, [bus.id for bus in stale])
+            refreshed = counts['inserted'] + counts['updated'] + counts['deleted']
             
-            confidence = base_confidence - stop_penalty - speed_penalty
-            return max(0.1, min(1.0, confidence))
+            if refreshed or counts['unchanged']:
+                db.session.commit()
+            return refreshed
             
-        except Exception:
-            return 0.5
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erreur rafraîchissement prédictions arrêt {stop_id}: {e}")
+            return 0
 
     @staticmethod
     def update_all_predictions():
@@ -192,48 +524,29 @@ class PredictionEngine:
         Met à jour toutes les prédictions pour tous les bus actifs
         """
         try:
-            # Supprime les anciennes prédictions
-            Prediction.query.filter(
-                Prediction.created_at < datetime.now() - timedelta(minutes=5)
-            ).delete()
-            
-            # Obtient tous les bus actifs
-            active_buses = Bus.query.filter_by(is_in_service=True).all()
-            
-            predictions_created = 0
-            for bus in active_buses:
-                if not bus.current_route_id:
-                    continue
+            # Lectures du calcul sur les réplicas (si configurés)
+            with use_replicas():
+                # Obtient tous les bus actifs
+                active_buses = Bus.query.filter_by(is_in_service=True).all()
                 
-                # Obtient les arrêts de la ligne
-                route_stops = RouteStop.query.filter_by(route_id=bus.current_route_id)\
-                    .order_by(RouteStop.sequence).all()
-                
-                for route_stop in route_stops:
-                    prediction_data = PredictionEngine.calculate_arrival_time(
-                        bus.id, route_stop.stop_id
-                    )
-                    
-                    if prediction_data:
-                        # Supprime l'ancienne prédiction pour ce bus/arrêt
-                        Prediction.query.filter_by(
-                            bus_id=bus.id,
-                            stop_id=route_stop.stop_id
-                        ).delete()
-                        
-                        # Crée une nouvelle prédiction
-                        prediction = Prediction(
-                            bus_id=prediction_data['bus_id'],
-                            stop_id=prediction_data['stop_id'],
-                            arrival_time=prediction_data['arrival_time'],
-                            confidence=prediction_data['confidence']
-                        )
-                        
-                        db.session.add(prediction)
-                        predictions_created += 1
+                # Toutes les ETA de la flotte en un seul calcul
+                results = PredictionEngine.compute_predictions(active_buses, parallel=True)
             
+            # Écriture par différence ; les prédictions des bus inactifs, des
+            # arrêts déjà passés ou hors ligne sont supprimées en une requête
+            counts = PredictionEngine._apply_predictions(results)
             db.session.commit()
-            print(f"Prédictions mises à jour: {predictions_created}")
+            
+            for bus in active_buses:
+                if bus.id in results:
+                    PredictionEngine._notify(bus, results[bus.id]['predictions'], results[bus.id]['route_stop_ids'])
+            
+            predictions_created = sum(len(result['predictions']) for result in results.values())
+            print(
+                f"Prédictions mises à jour: {predictions_created} "
+                f"(insérées {counts['inserted']}, modifiées {counts['updated']}, "
+                f"inchangées {counts['unchanged']}, supprimées {counts['deleted']})"
+            )
             
         except Exception as e:
             db.session.rollback()
@@ -267,6 +580,24 @@ class OccupancyManager:
             db.session.add(occupancy)
             db.session.commit()
             
+            # État courant en mémoire
+            store = getattr(current_app, 'latest_state', None)
+            if store is not None:
+                store.update_occupancy({
+                    column.name: getattr(occupancy, column.name)
+                    for column in Occupancy.__table__.columns
+                })
+            
+            # Montées du trajet en cours
+            trips = getattr(current_app, 'trip_history', None)
+            if trips is not None:
+                trips.update_occupancy(bus_id, occupancy.passenger_count)
+            
+            # Les montées / descentes suivantes repartent de cette valeur
+            counters = getattr(current_app, 'occupancy_counters', None)
+            if counters is not None:
+                counters.observe(bus_id, occupancy.passenger_count, bus.capacity, occupancy.timestamp)
+            
             return True
             
         except Exception as e:
@@ -277,32 +608,143 @@ class OccupancyManager:
     @staticmethod
     def get_occupancy_stats(bus_id: int, hours: int = 24) -> Dict:
         """
-        Obtient les statistiques d'occupation d'un bus
+        Obtient les statistiques d'occupation d'un bus : histogramme par nombre
+        de passagers (nombre d'enregistrements et durée pendant laquelle chaque
+        valeur a été observée), d'où les moyennes et percentiles par
+        enregistrement et pondérés par le temps.
+        Un enregistrement vaut jusqu'au suivant, au plus
+        OCCUPANCY_MAX_HOLD_SECONDS et pas au-delà de la dernière position du
+        bus (bus hors service ou muet). Au-delà de la rétention de l'occupation
+        brute, la partie ancienne de la période est lue dans les agrégats par
+        minute : total_records compte alors les enregistrements bruts
+        (raw_records) et les mesures agrégées (rollup_samples).
         """
         try:
-            since = datetime.now() - timedelta(hours=hours)
-            
-            occupancy_records = Occupancy.query.filter_by(bus_id=bus_id)\
-                .filter(Occupancy.timestamp >= since)\
-                .order_by(Occupancy.timestamp.desc()).all()
-            
-            if not occupancy_records:
+            now = datetime.utcnow()
+            since = now - timedelta(hours=hours)
+            max_hold = current_app.config.get('OCCUPANCY_MAX_HOLD_SECONDS', 1800)
+            
+            histogram: Dict[int, List[float]] = {}  # passagers -> [enregistrements, secondes]
+            peak = None
+            raw_since = since
+            rollup_samples = 0
+            raw_records = 0
+            
+            raw_cutoff = now - timedelta(days=current_app.config.get('OCCUPANCY_RAW_RETENTION_DAYS', 7))
+            state = RetentionState.query.first() if since < raw_cutoff else None
+            if state is not None and state.occupancy_rolled_until and state.occupancy_rolled_until > since:
+                # Minutes agrégées : une minute = 60 secondes à l'occupation moyenne
+                raw_since = state.occupancy_rolled_until
+                rounded = func.round(OccupancyRollup.passengers_avg)
+                rows = db.session.query(
+                    rounded, func.sum(OccupancyRollup.samples), func.count(OccupancyRollup.id),
+                    func.max(OccupancyRollup.passengers_max)
+                ).filter(
+                    OccupancyRollup.bus_id == bus_id,
+                    OccupancyRollup.minute >= since,
+                    OccupancyRollup.minute < raw_since
+                ).group_by(rounded).all()
+                for value, samples, minutes, maximum in rows:
+                    entry = histogram.setdefault(int(value or 0), [0, 0.0])
+                    entry[0] += samples or 0
+                    entry[1] += minutes * 60.0
+                    rollup_samples += samples or 0
+                    peak = max(peak or 0, maximum or 0)
+                carried = db.session.query(OccupancyRollup.passengers_last).filter(
+                    OccupancyRollup.bus_id == bus_id,
+                    OccupancyRollup.minute >= since,
+                    OccupancyRollup.minute < raw_since
+                ).order_by(OccupancyRollup.minute.desc()).limit(1).scalar()
+            else:
+                carried = db.session.query(Occupancy.passenger_count)\
+                    .filter(Occupancy.bus_id == bus_id, Occupancy.timestamp < since)\
+                    .order_by(Occupancy.timestamp.desc()).limit(1).scalar()
+            
+            # Fin du dernier enregistrement : dernière position reçue du bus
+            store = getattr(current_app, 'latest_state', None)
+            position = store.get_position(bus_id) if store is not None else None
+            horizon = now
+            if position is not None and position.get('timestamp'):
+                horizon = min(now, position['timestamp'])
+            bus = db.session.get(Bus, bus_id)
+            if bus is not None and not bus.is_in_service and position is None:
+                horizon = raw_since
+            
+            # Enregistrements bruts dans l'ordre, durées calculées ici (sans fonction de fenêtre)
+            rows = db.session.query(Occupancy.timestamp, Occupancy.passenger_count)\
+                .filter(Occupancy.bus_id == bus_id, Occupancy.timestamp >= raw_since)\
+                .order_by(Occupancy.timestamp.asc()).all()
+            
+            current = carried
+            first_start = horizon
+            if rows:
+                starts = np.array([row[0] for row in rows], dtype='datetime64[us]')
+                counts = np.array([row[1] or 0 for row in rows], dtype=np.int64)
+                ends = np.append(starts[1:], np.datetime64(max(horizon, rows[-1][0]), 'us'))
+                durations = np.clip((ends - starts) / np.timedelta64(1, 's'), 0.0, max_hold)
+                
+                values, inverse = np.unique(counts, return_inverse=True)
+                for value, count, seconds in zip(values, np.bincount(inverse), np.bincount(inverse, weights=durations)):
+                    entry = histogram.setdefault(int(value), [0, 0.0])
+                    entry[0] += int(count)
+                    entry[1] += float(seconds)
+                raw_records = len(rows)
+                peak = max(peak or 0, int(values[-1]))
+                current = int(counts[-1])
+                first_start = rows[0][0]
+            
+            # Valeur d'avant la partie brute (dernier agrégat ou dernier enregistrement
+            # avant la période), valable jusqu'au premier enregistrement brut
+            if carried is not None:
+                gap = min(max((min(first_start, horizon) - raw_since).total_seconds(), 0.0), max_hold)
+                if gap > 0:
+                    histogram.setdefault(int(carried), [0, 0.0])[1] += gap
+            
+            # Occupation courante : état en mémoire (compteurs pas encore écrits compris)
+            latest_state = store.get_occupancy(bus_id) if store is not None else None
+            if latest_state is not None:
+                current = latest_state.get('passenger_count', current)
+            
+            if not any(entry[0] for entry in histogram.values()):
                 return {
-                    'current': 0,
+                    'current': current or 0,
                     'average': 0,
                     'peak': 0,
                     'total_records': 0
                 }
             
-            counts = [r.passenger_count for r in occupancy_records]
+            values = np.array(sorted(histogram), dtype=float)
+            counts = np.array([histogram[value][0] for value in sorted(histogram)], dtype=float)
+            seconds = np.array([histogram[value][1] for value in sorted(histogram)], dtype=float)
             
             return {
-                'current': counts[0],
-                'average': np.mean(counts),
-                'peak': max(counts),
-                'total_records': len(counts)
+                'current': current or 0,
+                'average': round(float(np.average(values, weights=counts)), 2),
+                'time_weighted_average': round(float(np.average(values, weights=seconds)), 2) if seconds.sum() else None,
+                'peak': int(peak or 0),
+                'total_records': int(counts.sum()),
+                'raw_records': int(raw_records),
+                'rollup_samples': int(rollup_samples),
+                'percentiles': _weighted_percentiles(values, counts),
+                'time_weighted_percentiles': _weighted_percentiles(values, seconds),
+                'source': 'rollups+raw' if raw_since > since else 'raw'
             }
             
         except Exception as e:
             print(f"Erreur stats occupation: {e}")
             return {'current': 0, 'average': 0, 'peak': 0, 'total_records': 0}
+
+def _weighted_percentiles(values: np.ndarray, weights: np.ndarray,
+                          percentiles=(50, 90, 95)) -> Optional[Dict[str, int]]:
+    """
+    Percentiles d'un histogramme (valeurs triées, poids) : plus petite valeur
+    dont le poids cumulé atteint le pourcentage
+    """
+    total = weights.sum()
+    if total <= 0:
+        return None
+    cumulative = np.cumsum(weights) / total
+    return {
+        f'p{p}': int(values[min(int(np.searchsorted(cumulative, p / 100 - 1e-9)), len(values) - 1)])
+        for p in percentiles
+    }
@@ -0,0 +1,270 @@
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+
+def bus_room(bus_id: int) -> str:
+    return f'bus_{bus_id}'
+
+
+def route_room(route_id: int) -> str:
+    return f'route_{route_id}'
+
+
+def stop_room(stop_id: int) -> str:
+    return f'stop_{stop_id}'
+
+
+def room_has_subscribers(socketio, room: str, namespace: str = '/') -> bool:
+    rooms = socketio.server.manager.rooms.get(namespace, {})
+    return bool(rooms.get(room))
+
+
+def position_payload(bus_id: int, route_id: Optional[int], row: dict) -> dict:
+    """
+    Message compact envoyé aux abonnés pour une position
+    """
+    timestamp = row.get('timestamp')
+    return {
+        'bus_id': bus_id,
+        'route_id': route_id,
+        'lat': round(row['latitude'], 6),
+        'lon': round(row['longitude'], 6),
+        'speed': row.get('speed'),
+        'heading': row.get('heading'),
+        'ts': timestamp.isoformat() if timestamp else None
+    }
+
+
+class RealtimePublisher:
+    """
+    Diffusion Socket.IO des positions par salles (bus_<id> et route_<id>).
+
+    L'ingestion dépose la dernière position de chaque bus ; toutes les
+    SOCKET_PUSH_INTERVAL secondes, une seule mise à jour par bus est envoyée
+    (les positions intermédiaires sont fusionnées), et uniquement vers les
+    salles qui ont des abonnés.
+    """
+
+    def __init__(self, app=None, socketio=None):
+        self.socketio = None
+        self.interval = 1.0
+        self._pending: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+        # Compteurs
+        self.published = 0
+        self.coalesced = 0
+        self.emitted = 0
+        self.skipped = 0
+
+        if app is not None and socketio is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio):
+        self.socketio = socketio
+        self.interval = app.config.get('SOCKET_PUSH_INTERVAL', 1.0)
+        app.realtime = self
+        socketio.start_background_task(self._run)
+
+    def publish_position(self, bus_id: int, route_id: Optional[int], row: dict):
+        """
+        Dépose la dernière position d'un bus (O(1), aucun envoi réseau)
+        """
+        payload = position_payload(bus_id, route_id, row)
+        with self._lock:
+            self.published += 1
+            if bus_id in self._pending:
+                self.coalesced += 1
+            self._pending[bus_id] = payload
+
+    def has_subscribers(self, room: str) -> bool:
+        return room_has_subscribers(self.socketio, room)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Erreur diffusion positions: {e}")
+
+    def flush(self) -> int:
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        if not pending:
+            return 0
+
+        emitted = 0
+        by_route: Dict[int, list] = {}
+        for bus_id, payload in pending.items():
+            room = bus_room(bus_id)
+            if self.has_subscribers(room):
+                self.socketio.emit('bus_position', payload, to=room)
+                emitted += 1
+            else:
+                self.skipped += 1
+
+            if payload['route_id']:
+                by_route.setdefault(payload['route_id'], []).append(payload)
+
+        # Un seul message par ligne et par intervalle
+        for route_id, payloads in by_route.items():
+            room = route_room(route_id)
+            if self.has_subscribers(room):
+                self.socketio.emit('route_positions', {
+                    'route_id': route_id,
+                    'positions': payloads
+                }, to=room)
+                emitted += 1
+            else:
+                self.skipped += 1
+
+        self.emitted += emitted
+        return emitted
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'interval_seconds': self.interval,
+                'pending': len(self._pending),
+                'published': self.published,
+                'coalesced': self.coalesced,
+                'emitted': self.emitted,
+                'skipped_no_subscribers': self.skipped
+            }
+
+
+def prediction_entry(bus_id: int, bus_number: Optional[str], route_id: Optional[int],
+                     arrival_time: datetime, confidence: float) -> dict:
+    """
+    Prédiction compacte envoyée aux abonnés d'un arrêt
+    """
+    eta_seconds = (arrival_time - datetime.utcnow()).total_seconds()
+    return {
+        'bus_id': bus_id,
+        'bus_number': bus_number,
+        'route_id': route_id,
+        'arrival_time': arrival_time.isoformat(),
+        'eta_minutes': max(0, int(eta_seconds / 60)),
+        'confidence': confidence
+    }
+
+
+class StopPredictionNotifier:
+    """
+    Canal Socket.IO des prédictions par arrêt (salle stop_<id>).
+
+    Garde pour chaque arrêt suivi la dernière prédiction envoyée par bus et
+    n'envoie que les différences : bus ajouté, bus retiré, ou ETA décalée
+    d'au moins PREDICTION_PUSH_MIN_DELTA secondes. Les arrêts sans abonné ne
+    sont pas suivis.
+    """
+
+    def __init__(self, app=None, socketio=None):
+        self.socketio = None
+        self.min_delta = 60
+        self._sent: Dict[int, Dict[int, tuple]] = {}  # stop_id -> bus_id -> (arrival_time, entrée)
+        self._lock = threading.Lock()
+
+        # Compteurs
+        self.messages = 0
+        self.skipped_unchanged = 0
+
+        if app is not None and socketio is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio):
+        self.socketio = socketio
+        self.min_delta = app.config.get('PREDICTION_PUSH_MIN_DELTA', 60)
+        app.stop_notifier = self
+
+    def subscribed_stops(self) -> Set[int]:
+        """
+        Arrêts ayant au moins un abonné
+        """
+        rooms = self.socketio.server.manager.rooms.get('/', {})
+        return {
+            int(room[len('stop_'):]) for room, participants in rooms.items()
+            if room and room.startswith('stop_') and participants
+        }
+
+    def seed(self, stop_id: int, predictions: List[tuple]):
+        """
+        Initialise l'état envoyé d'un arrêt (liste de (arrival_time, entrée))
+        """
+        with self._lock:
+            if stop_id not in self._sent:
+                self._sent[stop_id] = {entry['bus_id']: (arrival_time, entry) for arrival_time, entry in predictions}
+
+    def notify_bus(self, bus, predictions: List[dict], route_stop_ids: Iterable[int]):
+        """
+        Compare les nouvelles prédictions d'un bus à celles déjà envoyées
+        et diffuse les changements aux abonnés des arrêts concernés
+        """
+        route_stop_ids = set(route_stop_ids)
+        changes: Dict[int, dict] = {}
+
+        with self._lock:
+            for prediction in predictions:
+                stop_id = prediction['stop_id']
+                if not room_has_subscribers(self.socketio, stop_room(stop_id)):
+                    self._sent.pop(stop_id, None)
+                    continue
+
+                sent = self._sent.setdefault(stop_id, {})
+                previous = sent.get(bus.id)
+                entry = prediction_entry(
+                    bus.id, bus.number, bus.current_route_id,
+                    prediction['arrival_time'], prediction['confidence']
+                )
+
+                if previous is None:
+                    kind = 'added'
+                elif abs((prediction['arrival_time'] - previous[0]).total_seconds()) >= self.min_delta:
+                    kind = 'updated'
+                else:
+                    self.skipped_unchanged += 1
+                    continue
+
+                sent[bus.id] = (prediction['arrival_time'], entry)
+                changes.setdefault(stop_id, _empty_change(stop_id))[kind].append(entry)
+
+            # Arrêts qui ne sont plus sur la ligne du bus (changement de ligne)
+            for stop_id, sent in self._sent.items():
+                if bus.id in sent and stop_id not in route_stop_ids:
+                    del sent[bus.id]
+                    changes.setdefault(stop_id, _empty_change(stop_id))['removed'].append(bus.id)
+
+        self._emit(changes)
+
+    def notify_bus_removed(self, bus_id: int):
+        """
+        Le bus n'a plus de prédictions (hors service)
+        """
+        changes: Dict[int, dict] = {}
+        with self._lock:
+            for stop_id, sent in self._sent.items():
+                if sent.pop(bus_id, None) is not None:
+                    changes.setdefault(stop_id, _empty_change(stop_id))['removed'].append(bus_id)
+        self._emit(changes)
+
+    def _emit(self, changes: Dict[int, dict]):
+        for stop_id, change in changes.items():
+            self.socketio.emit('stop_predictions', change, to=stop_room(stop_id))
+            self.messages += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'tracked_stops': len(self._sent),
+                'messages': self.messages,
+                'skipped_unchanged': self.skipped_unchanged,
+                'min_delta_seconds': self.min_delta
+            }
+
+
+def _empty_change(stop_id: int) -> dict:
+    return {'stop_id': stop_id, 'added': [], 'updated': [], 'removed': []}
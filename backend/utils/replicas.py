@@ -0,0 +1,191 @@
+import atexit
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from flask import has_request_context, request
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine, make_url
+
+from models import db
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+@contextmanager
+def use_replicas(enabled: bool = True):
+    """
+    Autorise (ou interdit) les lectures sur les réplicas pour la session
+    courante, quel que soit le contexte (thread de fond, requête GET)
+    """
+    info = db.session.info
+    previous = info.get('replicas')
+    info['replicas'] = enabled
+    try:
+        yield
+    finally:
+        if previous is None:
+            info.pop('replicas', None)
+        else:
+            info['replicas'] = previous
+
+
+class Replica:
+    """
+    Réplica en lecture et son dernier retard de réplication mesuré
+    """
+
+    __slots__ = ('url', 'engine', 'lag', 'healthy', 'checked_at', 'error', 'reads')
+
+    def __init__(self, url: str, engine: Engine):
+        self.url = url
+        self.engine = engine
+        self.lag: Optional[float] = None  # Secondes
+        self.healthy = False
+        self.checked_at = 0.0
+        self.error: Optional[str] = None
+        self.reads = 0
+
+    def to_dict(self) -> Dict:
+        return {
+            'host': make_url(self.url).host,
+            'healthy': self.healthy,
+            'lag_seconds': self.lag,
+            'checked_seconds_ago': round(time.time() - self.checked_at, 1) if self.checked_at else None,
+            'error': self.error,
+            'reads': self.reads,
+            'pool': self.engine.pool.status()
+        }
+
+
+class ReplicaRouter:
+    """
+    Lectures sur les réplicas MySQL (DATABASE_REPLICA_URLS).
+
+    Les SELECT des requêtes GET, et ceux des blocs use_replicas() (calcul
+    des prédictions), sont répartis à tour de rôle entre les réplicas dont le
+    retard est inférieur à REPLICA_MAX_LAG_SECONDS ; tout le reste (ingestion,
+    écritures des prédictions, lectures suivies d'écritures) va au primaire.
+    Le retard est mesuré toutes les REPLICA_LAG_CHECK_SECONDS par SHOW REPLICA
+    STATUS : réplica injoignable, réplication arrêtée ou mesure trop ancienne,
+    les lectures reviennent au primaire.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.replicas: List[Replica] = []
+        self.max_lag = 5.0
+        self.check_interval = 5.0
+        self._counter = itertools.count()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Compteurs
+        self.replica_reads = 0
+        self.fallbacks = 0
+        self.checks = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        urls = app.config.get('DATABASE_REPLICA_URLS') or []
+        if not urls:
+            return
+
+        self.max_lag = float(app.config.get('REPLICA_MAX_LAG_SECONDS', 5))
+        self.check_interval = float(app.config.get('REPLICA_LAG_CHECK_SECONDS', 5))
+        # Mêmes réglages de pool que le primaire
+        options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        self.replicas = [Replica(url, create_engine(url, **options)) for url in urls]
+        app.db_reader = self
+
+        self.check_lag()
+        if self.check_interval > 0:
+            self._thread = threading.Thread(target=self._run, name='replica-lag', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            self.check_lag()
+
+    # Retard de réplication
+
+    def check_lag(self):
+        for replica in self.replicas:
+            try:
+                replica.lag = self._measure_lag(replica.engine)
+                replica.healthy = replica.lag is not None
+                replica.error = None if replica.healthy else 'réplication arrêtée'
+            except Exception as e:
+                replica.lag = None
+                replica.healthy = False
+                replica.error = str(e)
+            replica.checked_at = time.time()
+        self.checks += 1
+
+    @staticmethod
+    def _measure_lag(engine: Engine) -> Optional[float]:
+        """
+        Retard en secondes (0 pour un serveur qui ne réplique pas, None si la
+        réplication est arrêtée)
+        """
+        with engine.connect() as connection:
+            try:
+                row = connection.execute(text('SHOW REPLICA STATUS')).mappings().first()
+                key = 'Seconds_Behind_Source'
+            except Exception:
+                # MySQL < 8.0.22, MariaDB
+                connection.rollback()
+                row = connection.execute(text('SHOW SLAVE STATUS')).mappings().first()
+                key = 'Seconds_Behind_Master'
+        if row is None:
+            return 0.0
+        lag = row.get(key)
+        return float(lag) if lag is not None else None
+
+    # Routage
+
+    def read_bind(self, session) -> Optional[Engine]:
+        """
+        Réplica des lectures de cette session (None : primaire)
+        """
+        allowed = session.info.get('replicas')
+        if allowed is None:
+            allowed = has_request_context() and request.method in READ_METHODS
+        if not allowed:
+            return None
+
+        # Mesure trop ancienne (thread de contrôle bloqué) : réplica ignoré
+        stale_before = time.time() - max(3 * self.check_interval, 15)
+        candidates = [
+            replica for replica in self.replicas
+            if replica.healthy and replica.lag <= self.max_lag and replica.checked_at >= stale_before
+        ]
+        if not candidates:
+            self.fallbacks += 1
+            return None
+
+        replica = candidates[next(self._counter) % len(candidates)]
+        replica.reads += 1
+        self.replica_reads += 1
+        return replica.engine
+
+    def get_stats(self) -> Dict:
+        return {
+            'max_lag_seconds': self.max_lag,
+            'replica_reads': self.replica_reads,
+            'primary_fallbacks': self.fallbacks,
+            'lag_checks': self.checks,
+            'replicas': [replica.to_dict() for replica in self.replicas],
+            'primary_pool': db.engine.pool.status()
+        }
@@ -0,0 +1,423 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import func
+
+from models import db, Bus, Position, Occupancy, OccupancyRollup, RetentionState
+from utils.route_geometry import METERS_PER_DEGREE
+
+
+def floor_minute(moment: datetime) -> datetime:
+    return moment.replace(second=0, microsecond=0)
+
+
+def interval_keep(bus_ids: np.ndarray, seconds: np.ndarray, interval: float) -> np.ndarray:
+    """
+    Garde la première position de chaque bus dans chaque intervalle
+    (lignes triées par bus puis par date)
+    """
+    buckets = np.floor(seconds / interval).astype(np.int64)
+    keep = np.ones(len(bus_ids), dtype=bool)
+    keep[1:] = (bus_ids[1:] != bus_ids[:-1]) | (buckets[1:] != buckets[:-1])
+    return keep
+
+
+def douglas_peucker_keep(latitudes: np.ndarray, longitudes: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """
+    Points conservés par Douglas-Peucker (forme du tracé à tolerance_m près),
+    dans un plan local ; les extrémités sont toujours gardées
+    """
+    count = len(latitudes)
+    keep = np.zeros(count, dtype=bool)
+    if count <= 2:
+        keep[:] = True
+        return keep
+
+    y = (latitudes - latitudes[0]) * METERS_PER_DEGREE
+    x = (longitudes - longitudes[0]) * METERS_PER_DEGREE * np.cos(np.radians(latitudes[0]))
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        length = np.hypot(dx, dy)
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        if length > 0:
+            distances = np.abs(px * dy - py * dx) / length
+        else:
+            distances = np.hypot(px, py)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return keep
+
+
+class RetentionManager:
+    """
+    Rétention des positions et de l'occupation.
+
+    - positions : brutes pendant POSITION_RAW_RETENTION_DAYS, puis
+      sous-échantillonnées sur place (une par POSITION_DOWNSAMPLE_SECONDS, ou
+      Douglas-Peucker) et supprimées après POSITION_ARCHIVE_DAYS (partition
+      entière si POSITION_PARTITIONING, voir utils/position_partitions.py) ;
+    - occupation : agrégée par minute et par bus dans occupancy_rollups, puis
+      supprimée après OCCUPANCY_RAW_RETENTION_DAYS (les MAX_OCCUPANCY_HISTORY
+      derniers enregistrements de chaque bus sont toujours conservés).
+
+    Les suppressions se font par lots de RETENTION_CHUNK_SIZE lignes, chacun
+    dans sa propre transaction, avec une pause entre les lots. Lancé toutes
+    les RETENTION_INTERVAL_SECONDS par un thread, ou par scripts/run_retention.py.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.raw_days = 7
+        self.method = 'interval'
+        self.downsample_seconds = 60
+        self.tolerance_m = 15.0
+        self.archive_days = 90
+        self.occupancy_days = 7
+        self.occupancy_keep = 100
+        self.occupancy_delay = timedelta(seconds=35)
+        self.chunk_size = 1000
+        self.chunk_pause = 0.05
+        self.window = timedelta(minutes=60)
+        self.interval = 0
+        self._deadline: Optional[float] = None
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Mesures
+        self.runs = 0
+        self.errors = 0
+        self.totals = {
+            'positions_downsampled': 0,
+            'positions_expired': 0,
+            'occupancy_rolled_up': 0,
+            'rollups_written': 0,
+            'occupancy_deleted': 0,
+            'positions_rotated': 0,
+            'partitions_created': 0,
+            'partitions_dropped': 0,
+            'chunks': 0
+        }
+        self.last_run: Dict = {}
+        self._metrics: Dict = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.raw_days = app.config.get('POSITION_RAW_RETENTION_DAYS', 7)
+        self.method = app.config.get('POSITION_DOWNSAMPLE_METHOD', 'interval')
+        self.downsample_seconds = app.config.get('POSITION_DOWNSAMPLE_SECONDS', 60)
+        self.tolerance_m = app.config.get('POSITION_DOWNSAMPLE_TOLERANCE_M', 15)
+        self.archive_days = app.config.get('POSITION_ARCHIVE_DAYS', 90)
+        self.occupancy_days = app.config.get('OCCUPANCY_RAW_RETENTION_DAYS', 7)
+        self.occupancy_keep = app.config.get('MAX_OCCUPANCY_HISTORY', 100)
+        # Les compteurs de montées écrivent leurs lignes jusqu'à OCCUPANCY_FLUSH_SECONDS après leur date
+        self.occupancy_delay = timedelta(seconds=app.config.get('OCCUPANCY_FLUSH_SECONDS', 5) +
+                                         app.config.get('OCCUPANCY_ROLLUP_DELAY_SECONDS', 30))
+        self.chunk_size = app.config.get('RETENTION_CHUNK_SIZE', 1000)
+        self.chunk_pause = app.config.get('RETENTION_CHUNK_PAUSE_SECONDS', 0.05)
+        self.window = timedelta(minutes=app.config.get('RETENTION_WINDOW_MINUTES', 60))
+        self.interval = app.config.get('RETENTION_INTERVAL_SECONDS', 0)
+        app.retention = self
+
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                self.run()
+
+    # Exécution
+
+    def run(self, now: Optional[datetime] = None, max_seconds: Optional[float] = None) -> Dict:
+        """
+        Une passe complète (ou jusqu'à max_seconds) ; retourne ses mesures
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return {'skipped': 'déjà en cours'}
+
+        now = now or datetime.utcnow()
+        started = time.perf_counter()
+        self._deadline = started + max_seconds if max_seconds else None
+        self._metrics = {
+            'started_at': now.isoformat(),
+            'positions_scanned': 0,
+            'positions_downsampled': 0,
+            'positions_expired': 0,
+            'occupancy_rolled_up': 0,
+            'rollups_written': 0,
+            'occupancy_deleted': 0,
+            'positions_rotated': 0,
+            'partitions_created': 0,
+            'partitions_dropped': 0,
+            'chunks': 0,
+            'max_chunk_seconds': 0.0,
+            'completed': False
+        }
+        try:
+            state = RetentionState.query.first()
+            if state is None:
+                state = RetentionState()
+                db.session.add(state)
+                db.session.commit()
+
+            # Périodes terminées rangées dans leur partition avant sous-échantillonnage
+            self._metrics.update(self.app.position_partitions.maintain(now, deadline=self._deadline))
+            self.rollup_occupancy(state, now)
+            self.delete_occupancy(state, now)
+            self.downsample_positions(state, now)
+            self.expire_positions(now)
+
+            self._metrics['completed'] = not self._out_of_time()
+            self._metrics['positions_downsampled_until'] = _iso(state.positions_downsampled_until)
+            self._metrics['occupancy_rolled_until'] = _iso(state.occupancy_rolled_until)
+        except Exception as e:
+            db.session.rollback()
+            self.errors += 1
+            self._metrics['error'] = str(e)
+            print(f"Erreur rétention: {e}")
+        finally:
+            self._metrics['duration_seconds'] = round(time.perf_counter() - started, 3)
+            self._metrics['max_chunk_seconds'] = round(self._metrics['max_chunk_seconds'], 4)
+            self.runs += 1
+            for key in self.totals:
+                self.totals[key] += self._metrics[key]
+            self.last_run = self._metrics
+            self._run_lock.release()
+        return self.last_run
+
+    def _out_of_time(self) -> bool:
+        return self._deadline is not None and time.perf_counter() > self._deadline
+
+    def _delete_ids(self, model, ids: List[int], *conditions) -> int:
+        """
+        Supprime des lignes par lots (une transaction courte par lot) ; les
+        conditions supplémentaires limitent les partitions lues
+        """
+        deleted = 0
+        for i in range(0, len(ids), self.chunk_size):
+            chunk_started = time.perf_counter()
+            chunk = ids[i:i + self.chunk_size]
+            model.query.filter(model.id.in_(chunk), *conditions).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(chunk)
+            self._chunk_done(chunk_started)
+        return deleted
+
+    def _delete_where(self, model, *conditions) -> int:
+        """
+        Supprime toutes les lignes vérifiant les conditions, par lots
+        """
+        deleted = 0
+        while not self._out_of_time():
+            chunk_started = time.perf_counter()
+            ids = [row[0] for row in db.session.query(model.id).filter(*conditions).limit(self.chunk_size).all()]
+            if not ids:
+                break
+            model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(ids)
+            self._chunk_done(chunk_started)
+        return deleted
+
+    def _chunk_done(self, chunk_started: float):
+        self._metrics['chunks'] += 1
+        self._metrics['max_chunk_seconds'] = max(self._metrics['max_chunk_seconds'], time.perf_counter() - chunk_started)
+        if self.chunk_pause:
+            time.sleep(self.chunk_pause)
+
+    # Positions
+
+    def _downsample_mask(self, bus_ids: np.ndarray, seconds: np.ndarray,
+                         latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        if self.method != 'douglas_peucker':
+            return interval_keep(bus_ids, seconds, self.downsample_seconds)
+
+        keep = np.zeros(len(bus_ids), dtype=bool)
+        starts = np.flatnonzero(np.r_[True, bus_ids[1:] != bus_ids[:-1]])
+        ends = np.r_[starts[1:], len(bus_ids)]
+        for start, end in zip(starts, ends):
+            keep[start:end] = douglas_peucker_keep(latitudes[start:end], longitudes[start:end], self.tolerance_m)
+        return keep
+
+    def downsample_positions(self, state: RetentionState, now: datetime):
+        """
+        Sous-échantillonne les positions plus anciennes que la rétention brute,
+        fenêtre par fenêtre depuis la dernière exécution (les tables par période
+        sont réécrites en entier)
+        """
+        cutoff = now - timedelta(days=self.raw_days)
+        scanned, removed = self.app.position_partitions.downsample(cutoff, self._downsample_mask, self._deadline)
+        self._metrics['positions_scanned'] += scanned
+        self._metrics['positions_downsampled'] += removed
+
+        start = state.positions_downsampled_until or \
+            db.session.query(func.min(Position.timestamp)).scalar()
+
+        while start is not None and start < cutoff and not self._out_of_time():
+            end = min(start + self.window, cutoff)
+            rows = db.session.query(
+                Position.id, Position.bus_id, Position.timestamp, Position.latitude, Position.longitude
+            ).filter(Position.timestamp >= start, Position.timestamp < end)\
+                .order_by(Position.bus_id, Position.timestamp).all()
+
+            if rows:
+                ids = np.array([row[0] for row in rows])
+                bus_ids = np.array([row[1] for row in rows])
+                seconds = np.array([row[2] for row in rows], dtype='datetime64[us]').astype(np.int64) / 1e6
+                keep = self._downsample_mask(
+                    bus_ids, seconds,
+                    np.array([row[3] for row in rows]), np.array([row[4] for row in rows])
+                )
+                self._metrics['positions_scanned'] += len(rows)
+                self._metrics['positions_downsampled'] += self._delete_ids(
+                    Position, ids[~keep].tolist(), Position.timestamp >= start, Position.timestamp < end
+                )
+                next_start = end
+            else:
+                # Pas de positions dans la fenêtre : saute à la suivante
+                next_start = db.session.query(func.min(Position.timestamp))\
+                    .filter(Position.timestamp >= end).scalar() or cutoff
+
+            state.positions_downsampled_until = end
+            db.session.commit()
+            start = max(next_start, end)
+
+    def expire_positions(self, now: datetime):
+        """
+        Supprime les partitions expirées d'un bloc, puis les positions
+        expirées restées dans la table positions (hors MySQL partitionné)
+        """
+        cutoff = now - timedelta(days=self.archive_days)
+        partitions = self.app.position_partitions
+        dropped, rows = partitions.drop_before(cutoff)
+        self._metrics['partitions_dropped'] += dropped
+        self._metrics['positions_expired'] += rows
+        if partitions.mode != 'native':
+            self._metrics['positions_expired'] += self._delete_where(Position, Position.timestamp < cutoff)
+
+    # Occupation
+
+    def rollup_occupancy(self, state: RetentionState, now: datetime):
+        """
+        Agrège l'occupation par bus et par minute (minutes terminées depuis
+        occupancy_delay seulement : une ligne écrite en retard par les
+        compteurs serait sinon derrière occupancy_rolled_until, jamais agrégée)
+        """
+        limit = floor_minute(now - self.occupancy_delay)
+        start = state.occupancy_rolled_until
+        if start is None:
+            first = db.session.query(func.min(Occupancy.timestamp)).scalar()
+            start = floor_minute(first) if first else None
+
+        while start is not None and start < limit and not self._out_of_time():
+            end = min(start + self.window, limit)
+            rows = db.session.query(
+                Occupancy.bus_id, Occupancy.timestamp, Occupancy.passenger_count, Occupancy.capacity_percentage
+            ).filter(Occupancy.timestamp >= start, Occupancy.timestamp < end)\
+                .order_by(Occupancy.bus_id, Occupancy.timestamp).all()
+
+            if rows:
+                rollups = self._rollups(start, rows)
+                db.session.execute(db.insert(OccupancyRollup), rollups)
+                self._metrics['occupancy_rolled_up'] += len(rows)
+                self._metrics['rollups_written'] += len(rollups)
+                next_start = end
+            else:
+                following = db.session.query(func.min(Occupancy.timestamp))\
+                    .filter(Occupancy.timestamp >= end).scalar()
+                next_start = floor_minute(following) if following else limit
+
+            # Agrégats et avancement écrits dans la même transaction
+            state.occupancy_rolled_until = end
+            db.session.commit()
+            start = max(next_start, end)
+
+    @staticmethod
+    def _rollups(start: datetime, rows) -> List[dict]:
+        bus_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        timestamps = np.array([row[1] for row in rows], dtype='datetime64[us]')
+        counts = np.array([row[2] or 0 for row in rows], dtype=float)
+        percentages = np.array([row[3] or 0.0 for row in rows], dtype=float)
+
+        minutes = (timestamps - np.datetime64(start, 'us')).astype('timedelta64[m]').astype(np.int64)
+        keys = bus_ids * 100000 + minutes  # Lignes triées par bus puis date : clés croissantes
+        firsts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        lasts = np.r_[firsts[1:], len(keys)] - 1
+        samples = np.diff(np.r_[firsts, len(keys)])
+
+        sums = np.add.reduceat(counts, firsts)
+        percentage_sums = np.add.reduceat(percentages, firsts)
+        minimums = np.minimum.reduceat(counts, firsts)
+        maximums = np.maximum.reduceat(counts, firsts)
+
+        return [
+            {
+                'bus_id': int(bus_ids[first]),
+                'minute': start + timedelta(minutes=int(minutes[first])),
+                'samples': int(n),
+                'passengers_avg': float(total / n),
+                'passengers_min': int(low),
+                'passengers_max': int(high),
+                'passengers_last': int(counts[last]),
+                'capacity_percentage_avg': float(percentage_total / n)
+            }
+            for first, last, n, total, percentage_total, low, high
+            in zip(firsts, lasts, samples, sums, percentage_sums, minimums, maximums)
+        ]
+
+    def delete_occupancy(self, state: RetentionState, now: datetime):
+        """
+        Supprime l'occupation brute agrégée et plus ancienne que la rétention,
+        en gardant les MAX_OCCUPANCY_HISTORY derniers enregistrements de chaque bus
+        """
+        if state.occupancy_rolled_until is None:
+            return
+        cutoff = min(now - timedelta(days=self.occupancy_days), state.occupancy_rolled_until)
+
+        # Bus par bus : date du N-ième enregistrement le plus récent (index
+        # bus_id, timestamp : N lignes lues), puis suppression par lots
+        bus_ids = [bus_id for (bus_id,) in db.session.query(Bus.id).order_by(Bus.id).all()]
+        for bus_id in bus_ids:
+            if self._out_of_time():
+                break
+            kept_from = db.session.query(Occupancy.timestamp)\
+                .filter(Occupancy.bus_id == bus_id)\
+                .order_by(Occupancy.timestamp.desc())\
+                .offset(self.occupancy_keep - 1).limit(1).scalar()
+            if kept_from is None:
+                continue  # Moins de MAX_OCCUPANCY_HISTORY enregistrements
+            self._metrics['occupancy_deleted'] += self._delete_where(
+                Occupancy, Occupancy.bus_id == bus_id, Occupancy.timestamp < min(cutoff, kept_from)
+            )
+
+    def get_stats(self) -> Dict:
+        return {
+            'interval_seconds': self.interval,
+            'method': self.method,
+            'runs': self.runs,
+            'errors': self.errors,
+            'running': self._run_lock.locked(),
+            'totals': dict(self.totals),
+            'last_run': self.last_run
+        }
+
+
+def _iso(moment: Optional[datetime]) -> Optional[str]:
+    return moment.isoformat() if moment else None
@@ -0,0 +1,328 @@
+import json
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from models import db, RouteShape, RouteStop, Stop
+from utils.gps_utils import consecutive_distances
+
+METERS_PER_DEGREE = 111190.0
+
+# Un bus à moins de STOP_TOLERANCE_M d'un arrêt (avant ou après) y est considéré
+STOP_TOLERANCE_M = 30.0
+# Au-delà de cette distance au tracé, la recherche locale est abandonnée au profit
+# d'une recherche sur tout le tracé
+OFF_ROUTE_M = 150.0
+# Fenêtre de recherche autour du dernier segment connu (en segments)
+WINDOW_BACK = 2
+WINDOW_FORWARD = 30
+
+
+class RouteGeometry:
+    """
+    Tracé d'une ligne : polyligne ordonnée, distances cumulées (mètres) et
+    position de chaque arrêt le long du tracé.
+
+    Toute progression est exprimée en "mètres depuis le début de la ligne",
+    ce qui reste correct sur les boucles et les rues parallèles, contrairement
+    à la distance à vol d'oiseau jusqu'à l'arrêt le plus proche.
+    """
+
+    def __init__(self, route_id: int, latitudes, longitudes,
+                 cumulative: Optional[np.ndarray] = None,
+                 stops: Optional[List[Tuple[int, int, float]]] = None,
+                 source: str = 'shape'):
+        self.route_id = route_id
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        if cumulative is None:
+            cumulative = np.concatenate(([0.0], np.cumsum(
+                consecutive_distances(self.latitudes, self.longitudes) * 1000
+            )))
+        self.cumulative = np.asarray(cumulative, dtype=float)
+        self.total_length = float(self.cumulative[-1]) if self.cumulative.size else 0.0
+        self.stops: List[Tuple[int, int, float]] = stops or []  # (séquence, stop_id, mètres)
+        self.source = source
+
+    @property
+    def segment_count(self) -> int:
+        return max(len(self.latitudes) - 1, 0)
+
+    @classmethod
+    def from_stops(cls, route_id: int, route_stops: List[Tuple[int, int, float, float]]) -> 'RouteGeometry':
+        """
+        Tracé par défaut : segments droits entre arrêts successifs
+        route_stops: [(séquence, stop_id, latitude, longitude)] triés par séquence
+        """
+        geometry = cls(
+            route_id,
+            [rs[2] for rs in route_stops],
+            [rs[3] for rs in route_stops],
+            source='stops'
+        )
+        geometry.stops = [
+            (rs[0], rs[1], float(geometry.cumulative[i])) for i, rs in enumerate(route_stops)
+        ]
+        return geometry
+
+    def place_stops(self, route_stops: List[Tuple[int, int, float, float]]):
+        """
+        Calcule la position des arrêts le long du tracé, dans l'ordre des
+        séquences (chaque arrêt est cherché après le précédent)
+        """
+        stops = []
+        segment = 0
+        for sequence, stop_id, latitude, longitude in route_stops:
+            along, segment, _ = self._project(latitude, longitude, segment, self.segment_count)
+            stops.append((sequence, stop_id, along))
+        self.stops = stops
+
+    # Projection
+
+    def _project(self, latitude: float, longitude: float, start: int, end: int) -> Tuple[float, int, float]:
+        """
+        Projette un point sur les segments [start, end) : (mètres, segment, écart latéral)
+        """
+        if self.segment_count == 0:
+            if not self.latitudes.size:
+                return 0.0, 0, float('inf')
+            dx = (self.longitudes[0] - longitude) * METERS_PER_DEGREE * math.cos(math.radians(latitude))
+            dy = (self.latitudes[0] - latitude) * METERS_PER_DEGREE
+            return 0.0, 0, math.hypot(dx, dy)
+
+        start = max(0, min(start, self.segment_count - 1))
+        end = max(start + 1, min(end, self.segment_count))
+
+        # Projection plane locale centrée sur le point (mètres)
+        kx = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+        x = (self.longitudes[start:end + 1] - longitude) * kx
+        y = (self.latitudes[start:end + 1] - latitude) * METERS_PER_DEGREE
+        ax, ay, bx, by = x[:-1], y[:-1], x[1:], y[1:]
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+
+        t = np.zeros_like(length2)
+        np.divide(-(ax * dx + ay * dy), length2, out=t, where=length2 > 0)
+        t = np.minimum(np.maximum(t, 0.0), 1.0)
+        offsets = np.hypot(ax + t * dx, ay + t * dy)
+
+        i = int(np.argmin(offsets))
+        segment = start + i
+        along = self.cumulative[segment] + t[i] * (self.cumulative[segment + 1] - self.cumulative[segment])
+        return float(along), segment, float(offsets[i])
+
+    def project(self, latitude: float, longitude: float, hint: Optional[int] = None) -> Tuple[float, int, float]:
+        """
+        Position d'un point le long du tracé : (mètres, segment, écart latéral).
+        Avec hint (dernier segment connu), la recherche se fait d'abord dans une
+        fenêtre autour de ce segment.
+        """
+        if hint is not None:
+            result = self._project(latitude, longitude, hint - WINDOW_BACK, hint + WINDOW_FORWARD)
+            if result[2] <= OFF_ROUTE_M:
+                return result
+        return self._project(latitude, longitude, 0, self.segment_count)
+
+    # Arrêts
+
+    def stop_offset(self, stop_id: int, along: float = 0.0) -> Optional[float]:
+        """
+        Position du prochain passage à un arrêt après `along` (None si déjà passé)
+        """
+        for _, sid, offset in self.stops:
+            if sid == stop_id and offset >= along - STOP_TOLERANCE_M:
+                return offset
+        return None
+
+    def stops_between(self, along: float, target: float) -> int:
+        """
+        Nombre d'arrêts strictement entre deux positions le long du tracé
+        """
+        return sum(
+            1 for _, _, offset in self.stops
+            if along + STOP_TOLERANCE_M < offset < target - STOP_TOLERANCE_M
+        )
+
+    def progress(self, along: float) -> Tuple[int, float]:
+        """
+        (index du prochain arrêt, pourcentage de la ligne parcouru)
+        """
+        next_stop_index = len(self.stops) - 1
+        for i, (_, _, offset) in enumerate(self.stops):
+            if offset >= along - STOP_TOLERANCE_M:
+                next_stop_index = i
+                break
+        percentage = (along / self.total_length * 100) if self.total_length > 0 else 0.0
+        return max(next_stop_index, 0), min(percentage, 100.0)
+
+    def to_dict(self) -> Dict:
+        return {
+            'route_id': self.route_id,
+            'source': self.source,
+            'points': [[float(lat), float(lon)] for lat, lon in zip(self.latitudes, self.longitudes)],
+            'cumulative_distances_m': [round(float(d), 1) for d in self.cumulative],
+            'total_length_m': round(self.total_length, 1),
+            'stops': [
+                {'sequence': sequence, 'stop_id': stop_id, 'distance_m': round(offset, 1)}
+                for sequence, stop_id, offset in self.stops
+            ]
+        }
+
+
+def _route_stop_rows(route_id: int) -> List[Tuple[int, int, float, float]]:
+    return [
+        (sequence, stop_id, latitude, longitude)
+        for sequence, stop_id, latitude, longitude in db.session.query(
+            RouteStop.sequence, RouteStop.stop_id, Stop.latitude, Stop.longitude
+        ).join(Stop, Stop.id == RouteStop.stop_id)
+        .filter(RouteStop.route_id == route_id)
+        .order_by(RouteStop.sequence).all()
+    ]
+
+
+def build_route_shape(route_id: int, points: List[List[float]]) -> RouteShape:
+    """
+    Crée ou remplace le tracé stocké d'une ligne, avec distances cumulées et
+    position des arrêts précalculées (sans commit)
+    """
+    geometry = RouteGeometry(route_id, [p[0] for p in points], [p[1] for p in points])
+    geometry.place_stops(_route_stop_rows(route_id))
+
+    shape = RouteShape.query.filter_by(route_id=route_id).first()
+    if shape is None:
+        shape = RouteShape(route_id=route_id)
+        db.session.add(shape)
+    shape.points = json.dumps([[float(lat), float(lon)] for lat, lon in points])
+    shape.cumulative_distances = json.dumps([round(float(d), 2) for d in geometry.cumulative])
+    shape.stop_distances = json.dumps([
+        [sequence, stop_id, round(offset, 2)] for sequence, stop_id, offset in geometry.stops
+    ])
+    return shape
+
+
+class RouteGeometryCache:
+    """
+    Tracés des lignes en mémoire + dernier segment connu de chaque bus
+    (pour reprendre la recherche là où le bus était)
+    """
+
+    def __init__(self, app=None):
+        self.refresh_seconds = 300
+        self._geometries: Dict[int, Tuple[float, RouteGeometry]] = {}
+        self._bus_segments: Dict[int, Tuple[int, int]] = {}  # bus_id -> (route_id, segment)
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.refresh_seconds = app.config.get('ROUTE_GEOMETRY_REFRESH_SECONDS', 300)
+        app.route_geometry = self
+
+    def get(self, route_id: int) -> Optional[RouteGeometry]:
+        with self._lock:
+            cached = self._geometries.get(route_id)
+        if cached and time.time() - cached[0] <= self.refresh_seconds:
+            return cached[1]
+
+        geometry = self._load(route_id)
+        with self._lock:
+            self._geometries[route_id] = (time.time(), geometry)
+        return geometry
+
+    @staticmethod
+    def _load(route_id: int) -> Optional[RouteGeometry]:
+        route_stops = _route_stop_rows(route_id)
+        shape = RouteShape.query.filter_by(route_id=route_id).first()
+
+        if shape is None:
+            return RouteGeometry.from_stops(route_id, route_stops) if route_stops else None
+
+        points = json.loads(shape.points)
+        cumulative = json.loads(shape.cumulative_distances) if shape.cumulative_distances else None
+        geometry = RouteGeometry(
+            route_id, [p[0] for p in points], [p[1] for p in points],
+            cumulative=np.array(cumulative) if cumulative else None
+        )
+        stored = [tuple(s) for s in json.loads(shape.stop_distances)] if shape.stop_distances else []
+        if [(s[0], s[1]) for s in stored] == [(rs[0], rs[1]) for rs in route_stops]:
+            geometry.stops = [(int(s[0]), int(s[1]), float(s[2])) for s in stored]
+        else:
+            # Arrêts de la ligne modifiés depuis l'enregistrement du tracé
+            geometry.place_stops(route_stops)
+        return geometry
+
+    def invalidate(self, route_id: int):
+        with self._lock:
+            self._geometries.pop(route_id, None)
+
+    def invalidate_stop(self, stop_id: int) -> List[int]:
+        """
+        Oublie le tracé de toutes les lignes qui desservent cet arrêt (arrêt
+        déplacé) ; retourne ces lignes
+        """
+        route_ids = [route_id for (route_id,) in db.session.query(RouteStop.route_id)
+                     .filter(RouteStop.stop_id == stop_id).distinct().all()]
+        for route_id in route_ids:
+            self.invalidate(route_id)
+        return route_ids
+
+    def last_segment(self, bus_id: int, route_id: int) -> Optional[int]:
+        """
+        Dernier segment connu d'un bus sur cette ligne
+        """
+        with self._lock:
+            last = self._bus_segments.get(bus_id)
+        return last[1] if last and last[0] == route_id else None
+
+    def remember(self, bus_id: int, route_id: int, segment: int):
+        with self._lock:
+            self._bus_segments[bus_id] = (route_id, segment)
+
+    def locate(self, bus_id: int, route_id: int, latitude: float, longitude: float) -> Optional[Tuple[RouteGeometry, float]]:
+        """
+        Projette la position d'un bus sur le tracé de sa ligne en reprenant la
+        recherche depuis le dernier segment connu : (tracé, mètres depuis le début)
+        """
+        geometry = self.get(route_id)
+        if geometry is None:
+            return None
+
+        along, segment, _ = geometry.project(latitude, longitude, self.last_segment(bus_id, route_id))
+        self.remember(bus_id, route_id, segment)
+        return geometry, along
+
+    def track(self, bus_id: int, route_id: Optional[int], latitude: float, longitude: float,
+              timestamp=None) -> Optional[Dict]:
+        """
+        Projection d'une position reçue (une fois, à l'ingestion) : tracé,
+        mètres depuis le début, segment, prochain arrêt et pourcentage parcouru
+        """
+        if route_id is None:
+            return None
+        located = self.locate(bus_id, route_id, latitude, longitude)
+        if located is None:
+            return None
+        geometry, along = located
+        next_stop_index, progress = geometry.progress(along)
+        return {
+            'route_id': route_id,
+            'geometry': geometry,
+            'latitude': latitude,
+            'longitude': longitude,
+            'timestamp': timestamp,
+            'along': along,
+            'segment': self.last_segment(bus_id, route_id),
+            'next_stop_index': next_stop_index,
+            'progress': progress
+        }
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'routes': len(self._geometries),
+                'tracked_buses': len(self._bus_segments)
+            }
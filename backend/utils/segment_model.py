@@ -0,0 +1,327 @@
+import json
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from models import db, Bus, Position, SegmentTravelTime, SegmentModelState
+from utils.route_geometry import RouteGeometryCache, OFF_ROUTE_M, STOP_TOLERANCE_M
+
+BUCKET_MINUTES = 15
+BUCKETS = 24 * 60 // BUCKET_MINUTES
+DAY_TYPES = ('weekday', 'saturday', 'sunday')
+
+# Classes de temps de parcours (secondes, progression géométrique)
+TIME_EDGES = np.geomspace(5.0, 3600.0, 65)
+BINS = len(TIME_EDGES) - 1
+
+# Un écart plus long entre deux positions, ou un recul sur le tracé, démarre un nouveau trajet
+MAX_GAP_SECONDS = 1800
+BACKTRACK_M = 200.0
+
+
+def day_type(moment: datetime) -> str:
+    weekday = moment.weekday()
+    if weekday == 5:
+        return 'saturday'
+    if weekday == 6:
+        return 'sunday'
+    return 'weekday'
+
+
+def time_bucket(moment: datetime) -> int:
+    """Créneau de 15 minutes de la journée (0 à 95)"""
+    return (moment.hour * 60 + moment.minute) // BUCKET_MINUTES
+
+
+def route_segments(geometry) -> List[Tuple[int, int]]:
+    """Couples (arrêt de départ, arrêt d'arrivée) consécutifs d'une ligne"""
+    stop_ids = [stop_id for _, stop_id, _ in geometry.stops]
+    return list(zip(stop_ids[:-1], stop_ids[1:]))
+
+
+def histogram_medians(histograms: np.ndarray, min_samples: int) -> np.ndarray:
+    """
+    Médiane de chaque histogramme (créneaux × segments × classes) en secondes.
+    Un créneau trop peu observé utilise aussi les deux créneaux voisins ;
+    NaN si les observations restent insuffisantes.
+    """
+    counts = histograms.sum(axis=2)
+    neighbours = histograms + np.roll(histograms, 1, axis=0) + np.roll(histograms, -1, axis=0)
+    merged = np.where((counts >= min_samples)[..., None], histograms, neighbours).astype(float)
+    totals = merged.sum(axis=2)
+
+    # Classe contenant la médiane puis interpolation géométrique dans la classe
+    cumulative = np.cumsum(merged, axis=2)
+    half = totals[..., None] / 2
+    index = np.minimum((cumulative < half).sum(axis=2), BINS - 1)
+    below = np.take_along_axis(cumulative, index[..., None], axis=2)[..., 0] - \
+        np.take_along_axis(merged, index[..., None], axis=2)[..., 0]
+    inside = np.take_along_axis(merged, index[..., None], axis=2)[..., 0]
+    fraction = np.divide(totals / 2 - below, inside, out=np.full(totals.shape, 0.5), where=inside > 0)
+    low, high = TIME_EDGES[index], TIME_EDGES[index + 1]
+    medians = low * (high / low) ** np.clip(fraction, 0.0, 1.0)
+
+    return np.where(totals >= min_samples, medians, np.nan).astype(np.float32)
+
+
+def _pack_histograms(histograms: np.ndarray) -> bytes:
+    return zlib.compress(histograms.astype('<u4').tobytes())
+
+
+def _unpack_histograms(data: Optional[bytes], segment_count: int) -> np.ndarray:
+    if not data:
+        return np.zeros((BUCKETS, segment_count, BINS), dtype=np.uint32)
+    return np.frombuffer(zlib.decompress(data), dtype='<u4').reshape(BUCKETS, segment_count, BINS).copy()
+
+
+class SegmentModelBuilder:
+    """
+    Agrégation incrémentale de l'historique des positions en temps de parcours
+    entre arrêts consécutifs, par ligne, type de jour et créneau de 15 minutes.
+
+    Chaque exécution ne lit que les positions d'id supérieur à la dernière
+    traitée, par lots, et conserve l'état de chaque bus (dernier arrêt passé)
+    entre deux lots et deux exécutions. Les passages aux arrêts sont interpolés
+    entre deux positions projetées sur le tracé de la ligne ; les temps sont
+    cumulés dans des histogrammes, ce qui permet de fusionner les lots sans
+    relire l'historique.
+
+    La ligne d'une position est la ligne actuelle du bus (les positions ne
+    stockent pas la ligne).
+    """
+
+    def __init__(self, batch_size: int = 50000, min_samples: int = 5):
+        self.batch_size = batch_size
+        self.min_samples = min_samples
+        self.geometries = RouteGeometryCache()
+
+    def run(self, max_rows: Optional[int] = None) -> Dict:
+        state = SegmentModelState.query.first()
+        if state is None:
+            state = SegmentModelState(last_position_id=0, buses='{}')
+            db.session.add(state)
+            db.session.commit()
+
+        carry = {int(bus_id): value for bus_id, value in json.loads(state.buses or '{}').items()}
+        stats = {'positions': 0, 'observations': 0, 'batches': 0}
+
+        while max_rows is None or stats['positions'] < max_rows:
+            limit = self.batch_size if max_rows is None else min(self.batch_size, max_rows - stats['positions'])
+            rows = db.session.query(
+                Position.id, Position.bus_id, Position.latitude, Position.longitude, Position.timestamp
+            ).filter(Position.id > state.last_position_id)\
+                .order_by(Position.id).limit(limit).all()
+            if not rows:
+                break
+
+            observations = self._process_batch(rows, carry)
+            self._merge(observations)
+
+            state.last_position_id = rows[-1][0]
+            state.buses = json.dumps({str(bus_id): value for bus_id, value in carry.items()})
+            db.session.commit()
+
+            stats['positions'] += len(rows)
+            stats['observations'] += len(observations)
+            stats['batches'] += 1
+            print(f"Lot {stats['batches']}: {len(rows)} positions, {len(observations)} temps de parcours "
+                  f"(jusqu'à la position {state.last_position_id})")
+
+        stats['last_position_id'] = state.last_position_id
+        return stats
+
+    def _process_batch(self, rows, carry: Dict[int, dict]) -> List[tuple]:
+        """
+        Passages aux arrêts d'un lot : [(route_id, segment, secondes, heure de départ)]
+        """
+        by_bus: Dict[int, list] = {}
+        for _, bus_id, latitude, longitude, timestamp in rows:
+            by_bus.setdefault(bus_id, []).append((timestamp, latitude, longitude))
+
+        routes = dict(db.session.query(Bus.id, Bus.current_route_id).filter(Bus.id.in_(list(by_bus))).all())
+
+        observations = []
+        for bus_id, fixes in by_bus.items():
+            route_id = routes.get(bus_id)
+            geometry = self.geometries.get(route_id) if route_id else None
+            if geometry is None or len(geometry.stops) < 2:
+                carry.pop(bus_id, None)
+                continue
+            fixes.sort(key=lambda fix: fix[0])
+            observations.extend(self._process_bus(bus_id, route_id, geometry, fixes, carry))
+        return observations
+
+    def _process_bus(self, bus_id: int, route_id: int, geometry, fixes, carry: Dict[int, dict]) -> List[tuple]:
+        offsets = np.maximum.accumulate(np.array([offset for _, _, offset in geometry.stops]))
+        state = carry.get(bus_id)
+        if state is not None and state['route_id'] != route_id:
+            state = None
+
+        observations = []
+        for timestamp, latitude, longitude in fixes:
+            previous_time = datetime.fromisoformat(state['timestamp']) if state else None
+            if previous_time is not None and timestamp <= previous_time:
+                continue  # Position en retard ou doublon
+
+            along, segment, offset = geometry.project(latitude, longitude, state['segment'] if state else None)
+            if offset > OFF_ROUTE_M:
+                continue
+
+            if state is None or (timestamp - previous_time).total_seconds() > MAX_GAP_SECONDS or \
+                    along < state['along'] - BACKTRACK_M:
+                # Nouveau trajet : passage connu seulement si le bus est à un arrêt
+                at_stop = np.flatnonzero(np.abs(offsets - along) <= STOP_TOLERANCE_M)
+                state = {'route_id': route_id, 'along': along, 'segment': segment,
+                         'timestamp': timestamp.isoformat(), 'last_stop': None, 'last_stop_time': None}
+                if at_stop.size:
+                    state['last_stop'] = int(at_stop[-1])
+                    state['last_stop_time'] = timestamp.isoformat()
+                    state['along'] = max(along, float(offsets[at_stop[-1]]))
+                continue
+
+            # Arrêts franchis entre les deux positions, heure de passage interpolée
+            first = int(np.searchsorted(offsets, state['along'], side='right'))
+            last = int(np.searchsorted(offsets, along, side='right'))
+            elapsed = (timestamp - previous_time).total_seconds()
+            moved = along - state['along']
+            for index in range(first, last):
+                ratio = (offsets[index] - state['along']) / moved if moved > 0 else 1.0
+                passed_at = previous_time + timedelta(seconds=elapsed * ratio)
+                if state['last_stop'] is not None and index == state['last_stop'] + 1:
+                    started_at = datetime.fromisoformat(state['last_stop_time'])
+                    observations.append((
+                        route_id, state['last_stop'], (passed_at - started_at).total_seconds(), started_at
+                    ))
+                state['last_stop'] = index
+                state['last_stop_time'] = passed_at.isoformat()
+
+            state['along'] = max(along, state['along'])
+            state['segment'] = segment
+            state['timestamp'] = timestamp.isoformat()
+
+        if state is not None:
+            carry[bus_id] = state
+        return observations
+
+    def _merge(self, observations: List[tuple]):
+        """
+        Ajoute les observations aux histogrammes stockés et recalcule les médianes
+        """
+        grouped: Dict[Tuple[int, str], list] = {}
+        for route_id, segment, seconds, started_at in observations:
+            if TIME_EDGES[0] <= seconds <= TIME_EDGES[-1]:
+                grouped.setdefault((route_id, day_type(started_at)), []).append(
+                    (time_bucket(started_at), segment, seconds)
+                )
+
+        for (route_id, kind), values in grouped.items():
+            segments = route_segments(self.geometries.get(route_id))
+            histograms = self._load(route_id, kind, segments)
+
+            buckets, indexes, seconds = (np.array(column) for column in zip(*values))
+            bins = np.clip(np.searchsorted(TIME_EDGES, seconds, side='right') - 1, 0, BINS - 1)
+            np.add.at(histograms, (buckets, indexes, bins), 1)
+
+            record = SegmentTravelTime.query.filter_by(route_id=route_id, day_type=kind).first()
+            if record is None:
+                record = SegmentTravelTime(route_id=route_id, day_type=kind)
+                db.session.add(record)
+            record.segments = json.dumps([list(pair) for pair in segments])
+            record.histograms = _pack_histograms(histograms)
+            record.medians = histogram_medians(histograms, self.min_samples).tobytes()
+            record.samples = int(histograms.sum())
+
+    @staticmethod
+    def _load(route_id: int, kind: str, segments: List[Tuple[int, int]]) -> np.ndarray:
+        """
+        Histogrammes stockés, réalignés sur les segments actuels de la ligne
+        """
+        histograms = np.zeros((BUCKETS, len(segments), BINS), dtype=np.uint32)
+        record = SegmentTravelTime.query.filter_by(route_id=route_id, day_type=kind).first()
+        if record is None:
+            return histograms
+
+        stored_segments = [tuple(pair) for pair in json.loads(record.segments)]
+        stored = _unpack_histograms(record.histograms, len(stored_segments))
+        columns = {pair: i for i, pair in enumerate(stored_segments)}
+        for i, pair in enumerate(segments):
+            if pair in columns:
+                histograms[:, i, :] = stored[:, columns[pair], :]
+        return histograms
+
+
+class SegmentTravelModel:
+    """
+    Médianes des temps de parcours entre arrêts en mémoire, utilisées par
+    PredictionEngine à la place de distance / vitesse × facteur de trafic
+    quand l'historique est suffisant.
+    """
+
+    def __init__(self, app=None):
+        self.refresh_seconds = 600
+        self._routes: Dict[int, Tuple[float, Dict[str, tuple]]] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.refresh_seconds = app.config.get('SEGMENT_MODEL_REFRESH_SECONDS', 600)
+        app.segment_model = self
+
+    def _get(self, route_id: int) -> Dict[str, tuple]:
+        with self._lock:
+            cached = self._routes.get(route_id)
+        if cached and time.time() - cached[0] <= self.refresh_seconds:
+            return cached[1]
+
+        models = {}
+        for record in SegmentTravelTime.query.filter_by(route_id=route_id).all():
+            segments = [tuple(pair) for pair in json.loads(record.segments)]
+            medians = np.frombuffer(record.medians, dtype=np.float32).reshape(BUCKETS, len(segments))
+            models[record.day_type] = ({pair: i for i, pair in enumerate(segments)}, medians)
+
+        with self._lock:
+            self._routes[route_id] = (time.time(), models)
+        return models
+
+    def segment_seconds(self, route_id: int, stop_ids: List[int], moment: datetime) -> Optional[np.ndarray]:
+        """
+        Temps de parcours médian (secondes) entre arrêts consécutifs de la liste
+        pour le créneau de `moment` ; NaN pour les segments sans historique,
+        None si la ligne n'a aucun historique
+        """
+        try:
+            model = self._get(route_id).get(day_type(moment))
+        except Exception as e:
+            print(f"Erreur chargement temps de parcours ligne {route_id}: {e}")
+            return None
+        if model is None:
+            return None
+
+        columns, medians = model
+        bucket = time_bucket(moment)
+        seconds = np.array([
+            medians[bucket, columns[pair]] if pair in columns else np.nan
+            for pair in zip(stop_ids[:-1], stop_ids[1:])
+        ], dtype=float)
+
+        with self._lock:
+            self.lookups += 1
+            if np.isfinite(seconds).any():
+                self.hits += 1
+        return seconds
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'routes_cached': len(self._routes),
+                'lookups': self.lookups,
+                'lookups_with_history': self.hits
+            }
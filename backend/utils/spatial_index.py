@@ -0,0 +1,202 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from models import Stop
+from utils.gps_utils import distances_from_point
+
+# Longueur d'un degré de latitude (km)
+KM_PER_DEGREE = 111.19
+
+
+class StopSpatialIndex:
+    """
+    Index spatial en mémoire des arrêts actifs (grille régulière en degrés).
+
+    Chaque cellule de STOP_INDEX_CELL_DEG degrés contient les arrêts qui s'y
+    trouvent ; une requête ne calcule les distances que pour les cellules
+    voisines du point recherché. L'index est construit au premier accès, mis
+    à jour par les routes de création / modification / suppression d'arrêts,
+    et reconstruit toutes les STOP_INDEX_REFRESH_SECONDS secondes pour
+    prendre en compte les modifications faites par d'autres processus.
+    """
+
+    def __init__(self, app=None):
+        self.cell_deg = 0.01
+        self.refresh_seconds = 300
+        self._cells: Dict[Tuple[int, int], Dict[int, Tuple[float, float]]] = {}
+        self._stops: Dict[int, dict] = {}  # stop_id -> stop.to_dict()
+        self._cell_of: Dict[int, Tuple[int, int]] = {}
+        self._bounds: Optional[List[int]] = None  # [min_i, max_i, min_j, max_j] des cellules
+        self._lock = threading.RLock()
+        self.built_at: Optional[float] = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cell_deg = app.config.get('STOP_INDEX_CELL_DEG', 0.01)
+        self.refresh_seconds = app.config.get('STOP_INDEX_REFRESH_SECONDS', 300)
+        app.stop_index = self
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return int(math.floor(latitude / self.cell_deg)), int(math.floor(longitude / self.cell_deg))
+
+    # Construction / mises à jour
+
+    def rebuild(self):
+        """
+        Recharge tous les arrêts actifs (une requête)
+        """
+        stops = Stop.query.filter_by(is_active=True).all()
+        with self._lock:
+            self._cells = {}
+            self._stops = {}
+            self._cell_of = {}
+            self._bounds = None
+            for stop in stops:
+                self._insert(stop.to_dict())
+            self.built_at = time.time()
+
+    def _ensure_built(self):
+        if self.built_at is None or time.time() - self.built_at > self.refresh_seconds:
+            self.rebuild()
+
+    def _insert(self, stop_data: dict):
+        cell = self._cell(stop_data['latitude'], stop_data['longitude'])
+        self._cells.setdefault(cell, {})[stop_data['id']] = (stop_data['latitude'], stop_data['longitude'])
+        self._stops[stop_data['id']] = stop_data
+        self._cell_of[stop_data['id']] = cell
+        if self._bounds is None:
+            self._bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            self._bounds = [
+                min(self._bounds[0], cell[0]), max(self._bounds[1], cell[0]),
+                min(self._bounds[2], cell[1]), max(self._bounds[3], cell[1])
+            ]
+
+    def upsert(self, stop: Stop):
+        """
+        Ajoute ou met à jour un arrêt (retiré s'il n'est plus actif)
+        """
+        with self._lock:
+            if self.built_at is None:
+                return  # Sera chargé à la construction
+            self._remove(stop.id)
+            if stop.is_active:
+                self._insert(stop.to_dict())
+
+    def remove(self, stop_id: int):
+        with self._lock:
+            self._remove(stop_id)
+
+    def _remove(self, stop_id: int):
+        cell = self._cell_of.pop(stop_id, None)
+        if cell is None:
+            return
+        members = self._cells.get(cell)
+        if members is not None:
+            members.pop(stop_id, None)
+            if not members:
+                del self._cells[cell]
+        self._stops.pop(stop_id, None)
+
+    # Requêtes
+
+    def _candidates(self, cells) -> List[Tuple[int, float, float]]:
+        candidates = []
+        for cell in cells:
+            members = self._cells.get(cell)
+            if members:
+                candidates.extend((stop_id, lat, lon) for stop_id, (lat, lon) in members.items())
+        return candidates
+
+    def _ranked(self, latitude: float, longitude: float, candidates, radius_km: Optional[float]):
+        if not candidates:
+            return []
+        ids = np.array([c[0] for c in candidates])
+        distances = distances_from_point(
+            latitude, longitude, [c[1] for c in candidates], [c[2] for c in candidates]
+        )
+        if radius_km is not None:
+            within = distances <= radius_km
+            ids, distances = ids[within], distances[within]
+        order = np.lexsort((ids, distances))
+        return [(self._stops[int(ids[i])], float(distances[i])) for i in order]
+
+    def _ring(self, ci: int, cj: int, r: int):
+        if r == 0:
+            return [(ci, cj)]
+        cells = [(ci + di, cj + dj) for di in (-r, r) for dj in range(-r, r + 1)]
+        cells += [(ci + di, cj + dj) for dj in (-r, r) for di in range(-r + 1, r)]
+        return cells
+
+    def _guaranteed_km(self, latitude: float, r: int) -> float:
+        """
+        Distance en dessous de laquelle tous les arrêts ont été vus après
+        avoir parcouru les anneaux 0..r (marge de 1 % pour l'approximation)
+        """
+        worst_lat = min(89.0, abs(latitude) + (r + 1) * self.cell_deg)
+        return r * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(worst_lat)) * 0.99
+
+    def within_radius(self, latitude: float, longitude: float, radius_km: float) -> List[Tuple[dict, float]]:
+        """
+        Arrêts à moins de radius_km, triés par distance : [(stop_data, distance_km)]
+        """
+        with self._lock:
+            self._ensure_built()
+            dlat = radius_km / KM_PER_DEGREE
+            cos_lat = max(math.cos(math.radians(min(89.0, abs(latitude) + dlat))), 0.01)
+            dlon = radius_km / (KM_PER_DEGREE * cos_lat)
+            i0, j0 = self._cell(latitude - dlat, longitude - dlon)
+            i1, j1 = self._cell(latitude + dlat, longitude + dlon)
+
+            if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+                cells = list(self._cells.keys())
+            else:
+                cells = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+            return self._ranked(latitude, longitude, self._candidates(cells), radius_km)
+
+    def nearest(self, latitude: float, longitude: float, k: int,
+                max_radius_km: Optional[float] = None) -> List[Tuple[dict, float]]:
+        """
+        k arrêts les plus proches (optionnellement à moins de max_radius_km),
+        triés par distance : [(stop_data, distance_km)]
+        """
+        with self._lock:
+            self._ensure_built()
+            if k <= 0 or not self._cells:
+                return []
+
+            ci, cj = self._cell(latitude, longitude)
+            min_i, max_i, min_j, max_j = self._bounds
+            max_ring = max(abs(ci - min_i), abs(ci - max_i), abs(cj - min_j), abs(cj - max_j))
+
+            candidates = []
+            r = 0
+            while True:
+                candidates.extend(self._candidates(self._ring(ci, cj, r)))
+                guaranteed = self._guaranteed_km(latitude, r)
+                if r >= max_ring:
+                    break
+                if max_radius_km is not None and guaranteed >= max_radius_km:
+                    break
+                if len(candidates) >= k:
+                    ranked = self._ranked(latitude, longitude, candidates, max_radius_km)
+                    if len(ranked) >= k and ranked[k - 1][1] <= guaranteed:
+                        break
+                r += 1
+
+            return self._ranked(latitude, longitude, candidates, max_radius_km)[:k]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'stops': len(self._stops),
+                'cells': len(self._cells),
+                'cell_deg': self.cell_deg,
+                'built_seconds_ago': round(time.time() - self.built_at, 1) if self.built_at else None
+            }
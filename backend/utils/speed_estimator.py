@@ -0,0 +1,344 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import func
+
+from models import db, Bus, Position, BusSpeedEstimate
+from utils.gps_utils import calculate_distance
+
+MIN_MOVING_KMH = 5.0  # En dessous, le bus est à l'arrêt : la moyenne n'est pas modifiée
+MAX_SPEED_KMH = 80.0  # Au-dessus, mesure aberrante (saut GPS)
+MIN_INTERVAL_SECONDS = 2  # Positions trop rapprochées : le bruit GPS domine
+MAX_INTERVAL_SECONDS = 300  # Au-delà, l'intervalle ne dit plus rien de la vitesse
+MAX_DEVIATION_KMH = 30.0  # Écart à la moyenne au-delà duquel une mesure est suspecte
+MAX_REJECTED = 3  # Mesures rejetées consécutives avant d'accepter un changement de régime
+HISTORY_HOURS = 2  # Historique relu au démarrage pour les bus sans sauvegarde
+HISTORY_POSITIONS = 10
+
+
+class BusSpeed:
+    """
+    Moyenne mobile exponentielle de la vitesse d'un bus (O(1) par position)
+    """
+
+    __slots__ = ('speed', 'variance', 'samples', 'rejected', 'rejected_in_row',
+                 'latitude', 'longitude', 'timestamp', 'moving', 'dirty')
+
+    def __init__(self):
+        self.speed: Optional[float] = None
+        self.variance = 0.0
+        self.samples = 0
+        self.rejected = 0
+        self.rejected_in_row = 0
+        self.latitude: Optional[float] = None
+        self.longitude: Optional[float] = None
+        self.timestamp: Optional[datetime] = None
+        self.moving = False
+        self.dirty = False
+
+    def _anchor(self, latitude: float, longitude: float, timestamp: datetime):
+        self.latitude, self.longitude, self.timestamp = latitude, longitude, timestamp
+
+    def update(self, latitude: float, longitude: float, timestamp: datetime, half_life: float) -> str:
+        """
+        Intègre une position ; retourne 'sample', 'stationary', 'rejected' ou 'skipped'
+        """
+        self.dirty = True
+        if self.timestamp is None:
+            self._anchor(latitude, longitude, timestamp)
+            return 'skipped'
+
+        seconds = (timestamp - self.timestamp).total_seconds()
+        if seconds < MIN_INTERVAL_SECONDS:
+            return 'skipped'  # Position trop proche (ou plus ancienne) : ancre conservée
+        if seconds > MAX_INTERVAL_SECONDS:
+            self._anchor(latitude, longitude, timestamp)
+            return 'skipped'
+
+        sample = calculate_distance(self.latitude, self.longitude, latitude, longitude) / (seconds / 3600)
+
+        if sample < MIN_MOVING_KMH:
+            self.moving = False
+            self.rejected_in_row = 0
+            self._anchor(latitude, longitude, timestamp)
+            return 'stationary'
+
+        # Mesure hors plage ou trop loin de la moyenne : l'ancre est conservée,
+        # la prochaine mesure couvre l'intervalle complet
+        deviation = max(MAX_DEVIATION_KMH, 3 * self.variance ** 0.5)
+        suspicious = self.speed is not None and self.samples >= 3 and abs(sample - self.speed) > deviation
+        if sample > MAX_SPEED_KMH or (suspicious and self.rejected_in_row < MAX_REJECTED):
+            self.rejected += 1
+            self.rejected_in_row += 1
+            return 'rejected'
+
+        # Poids de la nouvelle mesure selon la durée couverte (demi-vie en secondes)
+        alpha = 1 - 0.5 ** (seconds / half_life)
+        if self.speed is None:
+            self.speed = sample
+        else:
+            diff = sample - self.speed
+            self.speed += alpha * diff
+            self.variance = (1 - alpha) * (self.variance + alpha * diff * diff)
+        self.samples += 1
+        self.rejected_in_row = 0
+        self.moving = True
+        self._anchor(latitude, longitude, timestamp)
+        return 'sample'
+
+    def to_dict(self) -> Dict:
+        return {
+            'speed': round(self.speed, 1) if self.speed is not None else None,
+            'std': round(self.variance ** 0.5, 1),
+            'samples': self.samples,
+            'moving': self.moving,
+            'updated_at': self.timestamp.isoformat() if self.timestamp else None
+        }
+
+
+class SpeedEstimator:
+    """
+    Vitesse moyenne de chaque bus en roulage, tenue à jour par l'ingestion.
+
+    Chaque position met à jour une moyenne mobile exponentielle (demi-vie
+    SPEED_HALF_LIFE_SECONDS) de la vitesse entre deux positions ; les arrêts
+    (< 5 km/h) ne la modifient pas et les mesures aberrantes (> 80 km/h ou très
+    éloignées de la moyenne) sont rejetées. Les estimations sont sauvegardées
+    dans bus_speed_estimates toutes les SPEED_SNAPSHOT_SECONDS et rechargées au
+    démarrage ; les bus sans sauvegarde sont initialisés une fois depuis leurs
+    dernières positions.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.half_life = 120.0
+        self.snapshot_interval = 60.0
+        self._states: Dict[int, BusSpeed] = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.hydrated = False
+
+        # Compteurs
+        self.updates = 0
+        self.samples = 0
+        self.rejected = 0
+        self.stationary = 0
+        self.snapshots = 0
+        self.snapshot_errors = 0
+        self.last_snapshot_rows = 0
+        self.last_snapshot_seconds = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.half_life = float(app.config.get('SPEED_HALF_LIFE_SECONDS', 120))
+        self.snapshot_interval = float(app.config.get('SPEED_SNAPSHOT_SECONDS', 60))
+        app.speed_estimator = self
+
+        if self.snapshot_interval > 0:
+            self.start()
+            atexit.register(self.stop)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='speed-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Arrête le thread et sauvegarde les dernières estimations
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        with self.app.app_context():
+            self.snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                with self.app.app_context():
+                    self.snapshot()
+            except Exception as e:
+                print(f"Erreur sauvegarde vitesses: {e}")
+
+    # Chargement
+
+    def hydrate(self):
+        """
+        Recharge la sauvegarde, puis rejoue les dernières positions des bus
+        qui n'en ont pas (une requête par table)
+        """
+        with self._lock:
+            self.hydrated = True
+            try:
+                for record in BusSpeedEstimate.query.all():
+                    state = BusSpeed()
+                    state.speed = record.speed
+                    state.variance = record.variance or 0.0
+                    state.samples = record.samples or 0
+                    state.rejected = record.rejected or 0
+                    state.moving = record.speed is not None
+                    state._anchor(record.last_latitude, record.last_longitude, record.last_timestamp)
+                    if state.latitude is None or state.longitude is None:
+                        state.timestamp = None
+                    self._states[record.bus_id] = state
+
+                ranked = db.session.query(
+                    Position.bus_id, Position.latitude, Position.longitude, Position.timestamp,
+                    func.row_number().over(
+                        partition_by=Position.bus_id, order_by=Position.timestamp.desc()
+                    ).label('rank')
+                ).filter(
+                    Position.timestamp >= datetime.utcnow() - timedelta(hours=HISTORY_HOURS)
+                ).subquery()
+                rows = db.session.query(
+                    ranked.c.bus_id, ranked.c.latitude, ranked.c.longitude, ranked.c.timestamp
+                ).filter(ranked.c.rank <= HISTORY_POSITIONS)\
+                    .order_by(ranked.c.bus_id, ranked.c.timestamp).all()
+            except Exception as e:
+                print(f"Erreur chargement vitesses: {e}")
+                return
+
+            known = set(self._states)
+            for bus_id, latitude, longitude, timestamp in rows:
+                if bus_id not in known:
+                    self._apply(bus_id, latitude, longitude, timestamp)
+
+    def _ensure_hydrated(self):
+        if not self.hydrated:
+            self.hydrate()
+
+    # Mises à jour (ingestion)
+
+    def _apply(self, bus_id: int, latitude: float, longitude: float, timestamp: datetime) -> BusSpeed:
+        state = self._states.get(bus_id)
+        if state is None:
+            state = self._states[bus_id] = BusSpeed()
+        result = state.update(latitude, longitude, timestamp, self.half_life)
+        if result == 'sample':
+            self.samples += 1
+        elif result == 'rejected':
+            self.rejected += 1
+        elif result == 'stationary':
+            self.stationary += 1
+        return state
+
+    def update(self, row: dict) -> Dict:
+        """
+        Intègre une position (colonnes de Position) et retourne l'estimation du bus
+        """
+        with self._lock:
+            self._ensure_hydrated()
+            self.updates += 1
+            return self._apply(row['bus_id'], row['latitude'], row['longitude'], row['timestamp']).to_dict()
+
+    def update_many(self, rows: Iterable[dict]):
+        """
+        Intègre des positions dans l'ordre chronologique de chaque bus
+        """
+        with self._lock:
+            for row in sorted(rows, key=lambda r: r['timestamp']):
+                self.update(row)
+
+    def forget(self, bus_id: int):
+        with self._lock:
+            self._states.pop(bus_id, None)
+
+    # Lectures
+
+    def get(self, bus_id: int) -> Optional[Dict]:
+        with self._lock:
+            self._ensure_hydrated()
+            state = self._states.get(bus_id)
+            return state.to_dict() if state is not None and state.speed is not None else None
+
+    def get_speed(self, bus_id: int) -> Optional[float]:
+        with self._lock:
+            self._ensure_hydrated()
+            state = self._states.get(bus_id)
+            return state.speed if state is not None else None
+
+    # Sauvegarde
+
+    def snapshot(self) -> int:
+        """
+        Écrit les estimations modifiées depuis la dernière sauvegarde
+        (INSERT et UPDATE groupés, un seul commit)
+        """
+        started = time.perf_counter()
+        with self._lock:
+            dirty = {bus_id: state for bus_id, state in self._states.items() if state.dirty}
+            rows = {
+                bus_id: {
+                    'bus_id': bus_id,
+                    'speed': state.speed,
+                    'variance': state.variance,
+                    'samples': state.samples,
+                    'rejected': state.rejected,
+                    'last_latitude': state.latitude,
+                    'last_longitude': state.longitude,
+                    'last_timestamp': state.timestamp,
+                    'updated_at': datetime.utcnow()
+                }
+                for bus_id, state in dirty.items()
+            }
+            for state in dirty.values():
+                state.dirty = False
+
+        if not rows:
+            return 0
+
+        try:
+            bus_ids = list(rows)
+            existing = {bus_id for (bus_id,) in db.session.query(BusSpeedEstimate.bus_id)
+                        .filter(BusSpeedEstimate.bus_id.in_(bus_ids)).all()}
+            # Bus supprimés entre-temps : rien à sauvegarder
+            valid = {bus_id for (bus_id,) in db.session.query(Bus.id).filter(Bus.id.in_(bus_ids)).all()}
+
+            inserts = [row for bus_id, row in rows.items() if bus_id in valid and bus_id not in existing]
+            updates = [row for bus_id, row in rows.items() if bus_id in valid and bus_id in existing]
+            if inserts:
+                db.session.execute(db.insert(BusSpeedEstimate), inserts)
+            if updates:
+                db.session.execute(db.update(BusSpeedEstimate), updates)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erreur sauvegarde vitesses: {e}")
+            with self._lock:
+                self.snapshot_errors += 1
+                for bus_id in rows:
+                    state = self._states.get(bus_id)
+                    if state is not None:
+                        state.dirty = True
+            return 0
+
+        with self._lock:
+            self.snapshots += 1
+            self.last_snapshot_rows = len(inserts) + len(updates)
+            self.last_snapshot_seconds = time.perf_counter() - started
+        return self.last_snapshot_rows
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'hydrated': self.hydrated,
+                'buses': len(self._states),
+                'updates': self.updates,
+                'samples': self.samples,
+                'rejected_outliers': self.rejected,
+                'stationary': self.stationary,
+                'snapshots': self.snapshots,
+                'snapshot_errors': self.snapshot_errors,
+                'last_snapshot_rows': self.last_snapshot_rows,
+                'last_snapshot_seconds': round(self.last_snapshot_seconds, 4)
+            }
@@ -0,0 +1,131 @@
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+
+from models import db
+
+
+def sqlite_pragmas(busy_timeout_ms: int, cache_size_mb: int, mmap_size_mb: int,
+                   read_only: bool = False) -> List[str]:
+    """
+    PRAGMA appliqués à chaque nouvelle connexion (journal_mode est persistant
+    dans le fichier : seule la connexion d'écriture le positionne)
+    """
+    pragmas = [
+        f'PRAGMA busy_timeout = {int(busy_timeout_ms)}',
+        'PRAGMA synchronous = NORMAL',  # Sûr en WAL : seule la dernière transaction peut être perdue
+        f'PRAGMA cache_size = -{int(cache_size_mb) * 1024}',  # En Kio (valeur négative)
+        f'PRAGMA mmap_size = {int(mmap_size_mb) * 1024 * 1024}',
+        'PRAGMA temp_store = MEMORY'
+    ]
+    if read_only:
+        pragmas.append('PRAGMA query_only = ON')
+    else:
+        pragmas.insert(0, 'PRAGMA journal_mode = WAL')
+    return pragmas
+
+
+def apply_pragmas(engine: Engine, pragmas: List[str]):
+    """
+    Exécute les PRAGMA à l'ouverture de chaque connexion du pool
+    """
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_reader_engine(path: str, pool_size: int, pragmas: List[str]) -> Engine:
+    """
+    Pool de connexions en lecture seule sur le même fichier (mode=ro)
+    """
+    engine = create_engine(
+        f'sqlite:///{Path(path).as_uri()}?mode=ro&uri=true',
+        pool_size=pool_size,
+        max_overflow=pool_size,
+        connect_args={'check_same_thread': False}
+    )
+    apply_pragmas(engine, pragmas)
+    return engine
+
+
+class SqliteProfile:
+    """
+    Profil SQLite de production (SQLITE_PRODUCTION).
+
+    En WAL, les lecteurs ne bloquent plus l'écrivain ni l'inverse. Les
+    écritures passent par le pool de l'application, limité à
+    SQLITE_WRITER_POOL_SIZE connexion (SQLite n'a qu'un écrivain à la fois :
+    les autres attendent une connexion au lieu de boucler sur le verrou) ;
+    les SELECT de db.session sont envoyés à un pool séparé de connexions en
+    lecture seule (voir RoutingSession dans models) tant que la transaction
+    n'a rien écrit.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.path: Optional[str] = None
+        self.reader: Optional[Engine] = None
+        self.reader_pool_size = 8
+
+        # Compteurs
+        self.reads = 0
+        self.journal_mode: Optional[str] = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.db_reader = self
+
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if not app.config.get('SQLITE_PRODUCTION', False) or url.get_backend_name() != 'sqlite' \
+                or url.database in (None, '', ':memory:'):
+            return
+
+        busy_timeout_ms = app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000)
+        cache_size_mb = app.config.get('SQLITE_CACHE_SIZE_MB', 64)
+        mmap_size_mb = app.config.get('SQLITE_MMAP_SIZE_MB', 256)
+        self.reader_pool_size = app.config.get('SQLITE_READER_POOL_SIZE', 8)
+
+        with app.app_context():
+            writer = db.engine
+        self.path = writer.url.database
+        apply_pragmas(writer, sqlite_pragmas(busy_timeout_ms, cache_size_mb, mmap_size_mb))
+
+        # Première connexion : crée le fichier et passe la base en WAL
+        with writer.connect() as connection:
+            self.journal_mode = connection.exec_driver_sql('PRAGMA journal_mode').scalar()
+            connection.commit()
+
+        self.reader = create_reader_engine(
+            self.path, self.reader_pool_size,
+            sqlite_pragmas(busy_timeout_ms, cache_size_mb, mmap_size_mb, read_only=True)
+        )
+        self.enabled = True
+
+    def read_bind(self, session) -> Optional[Engine]:
+        """
+        Moteur des lectures (None : lectures sur la connexion d'écriture)
+        """
+        if self.reader is None:
+            return None
+        self.reads += 1  # Compteur approximatif (sans verrou, appelé à chaque SELECT)
+        return self.reader
+
+    def get_stats(self) -> Dict:
+        stats = {
+            'enabled': self.enabled,
+            'journal_mode': self.journal_mode,
+            'routed_reads': self.reads
+        }
+        if self.reader is not None:
+            stats['reader_pool'] = self.reader.pool.status()
+            stats['writer_pool'] = db.engine.pool.status()
+        return stats
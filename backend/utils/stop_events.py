@@ -0,0 +1,360 @@
+import atexit
+import math
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from flask import current_app
+
+from models import db, Bus, StopEvent
+from utils.gps_utils import is_bus_at_stop
+from utils.route_geometry import METERS_PER_DEGREE, _route_stop_rows
+
+RESET_AFTER_SECONDS = 900  # Au-delà, la position du bus sur la ligne est recalculée
+MAX_PENDING = 10000  # Événements gardés en mémoire si la base est indisponible
+
+
+def closest_approach(stop_lat: float, stop_lon: float, lat1: float, lon1: float,
+                     lat2: float, lon2: float) -> Tuple[float, float]:
+    """
+    Point du trajet entre deux positions le plus proche d'un arrêt :
+    (fraction du trajet 0..1, distance en mètres), dans un plan local centré sur l'arrêt
+    """
+    scale = METERS_PER_DEGREE * math.cos(math.radians(stop_lat))
+    x1, y1 = (lon1 - stop_lon) * scale, (lat1 - stop_lat) * METERS_PER_DEGREE
+    x2, y2 = (lon2 - stop_lon) * scale, (lat2 - stop_lat) * METERS_PER_DEGREE
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    fraction = min(max(-(x1 * dx + y1 * dy) / length2, 0.0), 1.0) if length2 > 0 else 1.0
+    return fraction, math.hypot(x1 + fraction * dx, y1 + fraction * dy)
+
+
+class BusStopState:
+    """
+    Progression d'un bus le long des arrêts de sa ligne
+    """
+
+    __slots__ = ('route_id', 'next_index', 'at_index', 'arrival_time', 'last_at_stop',
+                 'latitude', 'longitude', 'timestamp')
+
+    def __init__(self, route_id: int, next_index: int, latitude: float, longitude: float, timestamp: datetime):
+        self.route_id = route_id
+        self.next_index = next_index
+        self.at_index: Optional[int] = None  # Arrêt où le bus est à l'arrêt
+        self.arrival_time: Optional[datetime] = None
+        self.last_at_stop: Optional[datetime] = None  # Dernière position relevée à l'arrêt
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timestamp = timestamp
+
+
+class StopEventDetector:
+    """
+    Détection en continu des arrivées et départs des bus aux arrêts.
+
+    Chaque position est comparée uniquement aux STOP_EVENT_LOOKAHEAD prochains
+    arrêts attendus de la ligne (O(1) par position) : arrivée quand le trajet
+    depuis la position précédente passe à moins de STOP_ARRIVAL_RADIUS_M de
+    l'arrêt (heure interpolée), départ quand le bus s'en éloigne de plus de
+    STOP_DEPARTURE_RADIUS_M. Un arrêt franchi entre deux positions est
+    enregistré comme un passage sans arrêt (stopped=False, temps d'arrêt nul).
+    Les événements terminés sont écrits par lots dans stop_events toutes les
+    STOP_EVENT_FLUSH_SECONDS.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.arrival_radius = 40.0
+        self.departure_radius = 60.0
+        self.lookahead = 3
+        self.flush_interval = 5.0
+        self.refresh_seconds = 300
+        self._states: Dict[int, BusStopState] = {}
+        self._routes: Dict[int, Tuple[float, List[Tuple[int, int, float, float]]]] = {}
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Compteurs
+        self.updates = 0
+        self.arrivals = 0
+        self.departures = 0
+        self.passes = 0
+        self.stale = 0
+        self.written = 0
+        self.dropped = 0
+        self.flush_errors = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.arrival_radius = float(app.config.get('STOP_ARRIVAL_RADIUS_M', 40))
+        self.departure_radius = float(app.config.get('STOP_DEPARTURE_RADIUS_M', 60))
+        self.lookahead = app.config.get('STOP_EVENT_LOOKAHEAD', 3)
+        self.flush_interval = float(app.config.get('STOP_EVENT_FLUSH_SECONDS', 5))
+        self.refresh_seconds = app.config.get('ROUTE_GEOMETRY_REFRESH_SECONDS', 300)
+        app.stop_events = self
+
+        if self.flush_interval > 0:
+            self.start()
+            atexit.register(self.stop)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stop-events', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Arrête le thread et écrit les événements en attente
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        with self.app.app_context():
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                print(f"Erreur écriture événements d'arrêt: {e}")
+
+    # Arrêts des lignes
+
+    def route_stops(self, route_id: int) -> List[Tuple[int, int, float, float]]:
+        """
+        (séquence, stop_id, latitude, longitude) des arrêts d'une ligne, en cache
+        """
+        with self._lock:
+            cached = self._routes.get(route_id)
+        if cached and time.time() - cached[0] <= self.refresh_seconds:
+            return cached[1]
+
+        stops = _route_stop_rows(route_id)
+        with self._lock:
+            self._routes[route_id] = (time.time(), stops)
+        return stops
+
+    def invalidate(self, route_id: int):
+        with self._lock:
+            self._routes.pop(route_id, None)
+
+    @staticmethod
+    def _initial_index(bus_id: int, route_id: int, latitude: float, longitude: float,
+                       timestamp: Optional[datetime] = None) -> int:
+        """
+        Prochain arrêt attendu d'un bus dont on ne connaît pas la progression :
+        projection faite à la réception de cette position, sinon projection
+        sur le tracé (une seule fois)
+        """
+        store = getattr(current_app, 'latest_state', None)
+        projection = store.get_projection(bus_id) if store is not None else None
+        if projection is not None and projection['route_id'] == route_id and \
+                timestamp is not None and projection['timestamp'] == timestamp:
+            return projection['next_stop_index']
+        geometries = getattr(current_app, 'route_geometry', None)
+        located = geometries.locate(bus_id, route_id, latitude, longitude) if geometries is not None else None
+        if located is None:
+            return 0
+        geometry, along = located
+        return geometry.progress(along)[0]
+
+    # Détection
+
+    def update(self, row: dict, route_id: Optional[int]) -> List[dict]:
+        """
+        Intègre une position (colonnes de Position) du bus sur sa ligne actuelle ;
+        retourne les événements terminés par cette position
+        """
+        bus_id = row['bus_id']
+        if route_id is None:
+            self.forget(bus_id)
+            return []
+
+        stops = self.route_stops(route_id)
+        if not stops:
+            return []
+
+        latitude, longitude, timestamp = row['latitude'], row['longitude'], row['timestamp']
+        with self._lock:
+            self.updates += 1
+            state = self._states.get(bus_id)
+
+        if state is not None and state.route_id == route_id and timestamp <= state.timestamp:
+            # Position antérieure à l'état (rattrapage) : pas d'événement remontant le temps
+            with self._lock:
+                self.stale += 1
+            return []
+
+        if state is None or state.route_id != route_id or \
+                (timestamp - state.timestamp).total_seconds() > RESET_AFTER_SECONDS:
+            next_index = self._initial_index(bus_id, route_id, latitude, longitude, timestamp)
+            state = BusStopState(route_id, next_index, latitude, longitude, timestamp)
+
+        with self._lock:
+            self._states[bus_id] = state
+            events = self._advance(bus_id, state, stops, latitude, longitude, timestamp)
+            self._pending.extend(events)
+            if len(self._pending) > MAX_PENDING:
+                self.dropped += len(self._pending) - MAX_PENDING
+                del self._pending[:len(self._pending) - MAX_PENDING]
+        return events
+
+    def update_many(self, rows: Iterable[dict], route_ids: Dict[int, Optional[int]]) -> List[dict]:
+        """
+        Intègre des positions dans l'ordre chronologique de chaque bus
+        """
+        events = []
+        for row in sorted(rows, key=lambda r: r['timestamp']):
+            events.extend(self.update(row, route_ids.get(row['bus_id'])))
+        return events
+
+    def _event(self, bus_id: int, state: BusStopState, stop: Tuple[int, int, float, float],
+               arrival_time: datetime, departure_time: datetime, stopped: bool) -> dict:
+        return {
+            'bus_id': bus_id,
+            'route_id': state.route_id,
+            'stop_id': stop[1],
+            'sequence': stop[0],
+            'arrival_time': arrival_time,
+            'departure_time': departure_time,
+            'dwell_seconds': max((departure_time - arrival_time).total_seconds(), 0.0),
+            'stopped': stopped
+        }
+
+    def _advance(self, bus_id: int, state: BusStopState, stops: List[Tuple[int, int, float, float]],
+                 latitude: float, longitude: float, timestamp: datetime) -> List[dict]:
+        events = []
+        if state.at_index is not None and state.at_index >= len(stops):
+            state.at_index = None  # Arrêts de la ligne modifiés
+        if state.next_index >= len(stops):
+            state.next_index = 0  # Fin de ligne : nouveau trajet
+
+        # Bus à l'arrêt : toujours là, ou départ
+        if state.at_index is not None:
+            stop = stops[state.at_index]
+            if is_bus_at_stop(latitude, longitude, stop[2], stop[3], self.departure_radius):
+                state.last_at_stop = timestamp
+            else:
+                events.append(self._event(bus_id, state, stop, state.arrival_time, state.last_at_stop, True))
+                self.departures += 1
+                state.next_index = (state.at_index + 1) % len(stops)
+                state.at_index = None
+
+        # Prochains arrêts attendus : arrêt ou passage depuis la position précédente
+        if state.at_index is None:
+            elapsed = timestamp - state.timestamp
+            checked = 0
+            while checked < self.lookahead:
+                index = state.next_index + checked
+                if index >= len(stops):
+                    break
+                stop = stops[index]
+                fraction, distance = closest_approach(
+                    stop[2], stop[3], state.latitude, state.longitude, latitude, longitude
+                )
+                if distance > self.arrival_radius:
+                    checked += 1
+                    continue
+
+                arrival_time = state.timestamp + elapsed * fraction
+                state.next_index = index + 1
+                checked = 0
+                self.arrivals += 1
+                if is_bus_at_stop(latitude, longitude, stop[2], stop[3], self.arrival_radius):
+                    state.at_index = index
+                    state.arrival_time = arrival_time
+                    state.last_at_stop = timestamp
+                    break
+                # Arrêt franchi entre les deux positions
+                events.append(self._event(bus_id, state, stop, arrival_time, arrival_time, False))
+                self.passes += 1
+                if state.next_index >= len(stops):
+                    break
+
+        state.latitude, state.longitude, state.timestamp = latitude, longitude, timestamp
+        return events
+
+    def forget(self, bus_id: int):
+        with self._lock:
+            self._states.pop(bus_id, None)
+
+    # Lectures
+
+    def current(self, bus_id: int) -> Optional[Dict]:
+        """
+        Arrêt où le bus se trouve actuellement (None s'il roule)
+        """
+        with self._lock:
+            state = self._states.get(bus_id)
+            if state is None or state.at_index is None:
+                return None
+            cached = self._routes.get(state.route_id)
+            if cached is None or state.at_index >= len(cached[1]):
+                return None
+            sequence, stop_id, _, _ = cached[1][state.at_index]
+            return {
+                'stop_id': stop_id,
+                'sequence': sequence,
+                'arrival_time': state.arrival_time.isoformat()
+            }
+
+    # Écriture
+
+    def flush(self) -> int:
+        """
+        Écrit les événements terminés en un seul INSERT multi-lignes
+        """
+        with self._lock:
+            events = self._pending
+            self._pending = []
+        if not events:
+            return 0
+
+        try:
+            # Bus supprimés entre-temps : événements ignorés
+            bus_ids = {event['bus_id'] for event in events}
+            valid = {bus_id for (bus_id,) in db.session.query(Bus.id).filter(Bus.id.in_(bus_ids)).all()}
+            rows = [event for event in events if event['bus_id'] in valid]
+            if rows:
+                db.session.execute(db.insert(StopEvent), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erreur écriture événements d'arrêt: {e}")
+            with self._lock:
+                self.flush_errors += 1
+                self._pending = events + self._pending
+                if len(self._pending) > MAX_PENDING:
+                    self.dropped += len(self._pending) - MAX_PENDING
+                    del self._pending[:len(self._pending) - MAX_PENDING]
+            return 0
+
+        with self._lock:
+            self.written += len(rows)
+        return len(rows)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'tracked_buses': len(self._states),
+                'buses_at_stop': sum(1 for state in self._states.values() if state.at_index is not None),
+                'updates': self.updates,
+                'arrivals': self.arrivals,
+                'departures': self.departures,
+                'passes': self.passes,
+                'stale': self.stale,
+                'pending': len(self._pending),
+                'written': self.written,
+                'dropped': self.dropped,
+                'flush_errors': self.flush_errors
+            }
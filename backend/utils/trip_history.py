@@ -0,0 +1,394 @@
+import atexit
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from flask import current_app
+
+from models import db, Bus, TripHistory
+from utils.gps_utils import distances_from_point
+
+MAX_SPEED_KMH = 120.0  # Au-delà, saut GPS : la distance n'est pas comptée
+
+
+class OpenTrip:
+    """
+    Trajet en cours d'un bus, cumulé position par position
+    """
+
+    __slots__ = ('trip_id', 'bus_id', 'route_id', 'start_time', 'distance_km', 'total_passengers',
+                 'passenger_count', 'latitude', 'longitude', 'timestamp', 'end_time', 'dirty')
+
+    def __init__(self, bus_id: int, route_id: int, start_time: datetime, passenger_count: int = 0):
+        self.trip_id: Optional[int] = None
+        self.bus_id = bus_id
+        self.route_id = route_id
+        self.start_time = start_time
+        self.distance_km = 0.0
+        self.total_passengers = passenger_count  # Passagers à bord au départ, puis montées
+        self.passenger_count = passenger_count
+        self.latitude: Optional[float] = None
+        self.longitude: Optional[float] = None
+        self.timestamp: Optional[datetime] = None
+        self.end_time: Optional[datetime] = None
+        self.dirty = True
+
+    def add_fix(self, latitude: float, longitude: float, timestamp: datetime):
+        if self.timestamp is not None:
+            hours = (timestamp - self.timestamp).total_seconds() / 3600
+            if hours <= 0:
+                return
+            distance = float(distances_from_point(self.latitude, self.longitude, latitude, longitude))
+            if distance / hours <= MAX_SPEED_KMH:
+                self.distance_km += distance
+        self.latitude, self.longitude, self.timestamp = latitude, longitude, timestamp
+        self.dirty = True
+
+    def restart(self, start_time: datetime):
+        """
+        Trajet ouvert avant le départ du premier arrêt : repart de zéro
+        """
+        self.start_time = start_time
+        self.distance_km = 0.0
+        self.total_passengers = self.passenger_count or 0
+        self.dirty = True
+
+    def row(self) -> dict:
+        end = self.end_time or self.timestamp or self.start_time
+        hours = (end - self.start_time).total_seconds() / 3600
+        return {
+            'bus_id': self.bus_id,
+            'route_id': self.route_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'total_passengers': self.total_passengers,
+            'distance_km': round(self.distance_km, 3),
+            'average_speed': round(self.distance_km / hours, 2) if hours > 0 else 0.0
+        }
+
+
+class TripHistoryBuilder:
+    """
+    Construction automatique de trip_history à partir du flux de positions.
+
+    Un trajet s'ouvre au départ du premier arrêt de la ligne (ou à la première
+    position d'un bus en service dont le trajet est inconnu, par exemple après
+    un redémarrage) et se ferme à l'arrivée au terminus, au passage hors
+    service, au changement de ligne ou après TRIP_MAX_GAP_SECONDS sans
+    position. Distance et vitesse moyenne sont cumulées à chaque position,
+    les passagers à chaque mise à jour d'occupation (montées). Les trajets
+    sont écrits toutes les TRIP_HISTORY_FLUSH_SECONDS ; ceux de moins de
+    TRIP_MIN_DISTANCE_KM sont abandonnés.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.flush_interval = 30.0
+        self.min_distance_km = 0.5
+        self.max_gap_seconds = 1800
+        self._trips: Dict[int, OpenTrip] = {}  # bus_id -> trajet en cours
+        self._closed: List[OpenTrip] = []  # Trajets terminés pas encore écrits
+        self._discarded: List[int] = []  # Trajets trop courts déjà écrits
+        self._idle: Set[int] = set()  # Bus au terminus, en attente du départ du premier arrêt
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.hydrated = False
+
+        # Compteurs
+        self.opened = 0
+        self.closed = 0
+        self.discarded = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = float(app.config.get('TRIP_HISTORY_FLUSH_SECONDS', 30))
+        self.min_distance_km = app.config.get('TRIP_MIN_DISTANCE_KM', 0.5)
+        self.max_gap_seconds = app.config.get('TRIP_MAX_GAP_SECONDS', 1800)
+        app.trip_history = self
+
+        if self.flush_interval > 0:
+            self.start()
+            atexit.register(self.stop)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='trip-history', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Arrête le thread et écrit l'état des trajets
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        with self.app.app_context():
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                with self.app.app_context():
+                    self.close_stale()
+                    self.flush()
+            except Exception as e:
+                print(f"Erreur écriture trajets: {e}")
+
+    # Chargement
+
+    def hydrate(self):
+        """
+        Reprend les trajets restés ouverts en base (un par bus)
+        """
+        with self._lock:
+            self.hydrated = True
+            try:
+                records = TripHistory.query.filter(TripHistory.end_time.is_(None))\
+                    .order_by(TripHistory.start_time.asc()).all()
+            except Exception as e:
+                print(f"Erreur chargement trajets: {e}")
+                return
+
+            for record in records:
+                trip = OpenTrip(record.bus_id, record.route_id, record.start_time)
+                trip.trip_id = record.id
+                trip.distance_km = record.distance_km or 0.0
+                trip.total_passengers = record.total_passengers or 0
+                trip.passenger_count = None
+                trip.dirty = False
+                previous = self._trips.get(record.bus_id)
+                if previous is not None:
+                    # Doublon : le plus ancien est fermé à l'ouverture du suivant
+                    previous.end_time = record.start_time
+                    self._closed.append(previous)
+                self._trips[record.bus_id] = trip
+
+    def _ensure_hydrated(self):
+        if not self.hydrated:
+            self.hydrate()
+
+    # Ouverture / fermeture
+
+    @staticmethod
+    def _passenger_count(bus_id: int) -> int:
+        store = getattr(current_app, 'latest_state', None)
+        occupancy = store.get_occupancy(bus_id) if store is not None else None
+        return (occupancy['passenger_count'] or 0) if occupancy else 0
+
+    def _open(self, bus_id: int, route_id: int, start_time: datetime) -> OpenTrip:
+        trip = OpenTrip(bus_id, route_id, start_time, self._passenger_count(bus_id))
+        self._trips[bus_id] = trip
+        self._idle.discard(bus_id)
+        self.opened += 1
+        return trip
+
+    def _close(self, bus_id: int, end_time: Optional[datetime] = None):
+        trip = self._trips.pop(bus_id, None)
+        if trip is None:
+            return
+        trip.end_time = max(end_time or trip.timestamp or trip.start_time, trip.start_time)
+        trip.dirty = True
+        if trip.distance_km < self.min_distance_km:
+            self.discarded += 1
+            if trip.trip_id is not None:
+                self._discarded.append(trip.trip_id)
+            return
+        self._closed.append(trip)
+        self.closed += 1
+
+    def end_trip(self, bus_id: int):
+        """
+        Ferme le trajet en cours (bus hors service, changement de ligne, suppression)
+        """
+        with self._lock:
+            self._ensure_hydrated()
+            self._close(bus_id)
+            self._idle.discard(bus_id)
+
+    def close_stale(self):
+        """
+        Ferme les trajets sans position depuis TRIP_MAX_GAP_SECONDS
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            stale = [
+                bus_id for bus_id, trip in self._trips.items()
+                if (now - (trip.timestamp or trip.start_time)).total_seconds() > self.max_gap_seconds
+            ]
+            for bus_id in stale:
+                self._close(bus_id)
+
+    # Flux (ingestion)
+
+    def update(self, row: dict, route_id: Optional[int], events: Iterable[dict] = (), in_service: bool = True):
+        """
+        Intègre une position et les événements d'arrêt qu'elle a produits
+        (survenus avant elle) ; un bus hors service n'a pas de trajet
+        """
+        bus_id = row['bus_id']
+        with self._lock:
+            self._ensure_hydrated()
+            if not in_service:
+                self._close(bus_id)
+                self._idle.discard(bus_id)
+                return
+            trip = self._trips.get(bus_id)
+            if trip is not None and (trip.route_id != route_id or (
+                    trip.timestamp and (row['timestamp'] - trip.timestamp).total_seconds() > self.max_gap_seconds)):
+                self._close(bus_id)
+            if route_id is None:
+                return
+
+            for event in events:
+                self._on_stop_event(event)
+
+            trip = self._trips.get(bus_id)
+            if trip is None and bus_id not in self._idle:
+                trip = self._open(bus_id, route_id, row['timestamp'])
+            if trip is not None:
+                trip.add_fix(row['latitude'], row['longitude'], row['timestamp'])
+
+    def update_many(self, rows: Iterable[dict], route_ids: Dict[int, Optional[int]], events: Iterable[dict] = (),
+                    in_service: Optional[Set[int]] = None):
+        """
+        Intègre des positions dans l'ordre chronologique, puis leurs événements d'arrêt
+        in_service: bus en service (None : tous)
+        """
+        with self._lock:
+            for row in sorted(rows, key=lambda r: r['timestamp']):
+                self.update(row, route_ids.get(row['bus_id']),
+                            in_service=in_service is None or row['bus_id'] in in_service)
+            for event in sorted(events, key=lambda e: e['arrival_time']):
+                if in_service is None or event['bus_id'] in in_service:
+                    self._on_stop_event(event)
+
+    def _on_stop_event(self, event: dict):
+        stops = current_app.stop_events.route_stops(event['route_id'])
+        if not stops:
+            return
+        bus_id = event['bus_id']
+        trip = self._trips.get(bus_id)
+
+        if event['sequence'] == stops[-1][0]:
+            # Terminus : fin du trajet, attente du prochain départ
+            if trip is not None:
+                trip.add_fix(stops[-1][2], stops[-1][3], event['arrival_time'])
+            self._close(bus_id, event['arrival_time'])
+            self._idle.add(bus_id)
+        elif event['sequence'] == stops[0][0]:
+            # Départ du premier arrêt : début d'un trajet
+            if trip is not None and trip.distance_km < self.min_distance_km:
+                trip.restart(event['departure_time'])
+            else:
+                self._close(bus_id, event['arrival_time'])
+                trip = self._open(bus_id, event['route_id'], event['departure_time'])
+            trip.latitude, trip.longitude = stops[0][2], stops[0][3]
+            trip.timestamp = event['departure_time']
+        elif trip is None:
+            # Départ du premier arrêt manqué : le trajet commence au premier arrêt vu
+            trip = self._open(bus_id, event['route_id'], event['arrival_time'])
+            trip.latitude, trip.longitude = next((s[2], s[3]) for s in stops if s[0] == event['sequence'])
+            trip.timestamp = event['arrival_time']
+
+    def update_occupancy(self, bus_id: int, passenger_count: int):
+        """
+        Cumule les montées du trajet en cours
+        """
+        with self._lock:
+            self._ensure_hydrated()
+            trip = self._trips.get(bus_id)
+            if trip is None:
+                return
+            if trip.passenger_count is not None and passenger_count > trip.passenger_count:
+                trip.total_passengers += passenger_count - trip.passenger_count
+                trip.dirty = True
+            trip.passenger_count = passenger_count
+
+    # Lectures
+
+    def current(self, bus_id: int) -> Optional[Dict]:
+        with self._lock:
+            trip = self._trips.get(bus_id)
+            if trip is None:
+                return None
+            row = trip.row()
+            row['start_time'] = row['start_time'].isoformat()
+            row['id'] = trip.trip_id
+            return row
+
+    # Écriture
+
+    def flush(self) -> int:
+        """
+        Écrit les nouveaux trajets, met à jour les trajets modifiés (un UPDATE
+        groupé) et supprime les trajets abandonnés, en un seul commit
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            closed, self._closed = self._closed, []
+            discarded, self._discarded = self._discarded, []
+            trips = closed + [trip for trip in self._trips.values()
+                              if trip.dirty and trip.distance_km >= self.min_distance_km]
+            rows = [(trip, trip.row()) for trip in trips]
+            for trip in trips:
+                trip.dirty = False
+
+        if not rows and not discarded:
+            return 0
+
+        try:
+            bus_ids = {trip.bus_id for trip, _ in rows}
+            valid = {bus_id for (bus_id,) in db.session.query(Bus.id).filter(Bus.id.in_(bus_ids)).all()} \
+                if bus_ids else set()
+
+            inserts = [(trip, TripHistory(**row)) for trip, row in rows
+                       if trip.trip_id is None and trip.bus_id in valid]
+            updates = [dict(row, id=trip.trip_id) for trip, row in rows
+                       if trip.trip_id is not None and trip.bus_id in valid]
+            db.session.add_all([record for _, record in inserts])
+            if updates:
+                db.session.execute(db.update(TripHistory), updates)
+            if discarded:
+                TripHistory.query.filter(TripHistory.id.in_(discarded)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erreur écriture trajets: {e}")
+            with self._lock:
+                self.flush_errors += 1
+                self._closed = closed + self._closed
+                self._discarded = discarded + self._discarded
+                for trip in trips:
+                    trip.dirty = True
+            return 0
+
+        with self._lock:
+            for trip, record in inserts:
+                trip.trip_id = record.id
+            self.flushes += 1
+        return len(inserts) + len(updates)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'open_trips': len(self._trips),
+                'idle_at_terminus': len(self._idle),
+                'opened': self.opened,
+                'closed': self.closed,
+                'discarded': self.discarded,
+                'pending_closed': len(self._closed),
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors
+            }